@@ -0,0 +1,365 @@
+# Copyright (C) 2010  Agorabox. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''
+Benchmarks of the CouchedFileSystem hot paths.
+
+Every benchmark runs against a fresh database of an in-process fake CouchDB
+server, see fakecouchdb.py, and a fresh temporary mount point. Its fixtures
+are created first, then its operations are timed with a filesystem whose
+caches are cold, counting the requests received by the server.
+
+    python bench/bench_fs.py [--scale 1000] [--latency 0.001]
+                             [--baseline bench/baseline.json] [--save]
+
+The results are compared with the baseline if there is one: a benchmark
+regresses when it sends more requests per operation than the baseline, or
+when its throughput drops by more than the tolerance. The numbers of
+requests do not depend on the machine, but the throughputs do: they are
+only compared when the baseline was saved on the same host, so a CI job
+should regenerate its own baseline with --save. Exits with status 1 on
+regressions.
+'''
+
+import os
+import sys
+import time
+import json
+import shutil
+import platform
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fakecouchdb import FakeCouchDB
+from ufo.filesystem import CouchedFileSystem
+import ufo.acl as acl
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+class Benchmark(object):
+    '''
+    A benchmark creates its fixtures in 'setup' and returns the number of
+    operations done by 'run'.
+    '''
+
+    name = None
+
+    def __init__(self, scale):
+        self.scale = scale
+
+    def setup(self, fs):
+        pass
+
+    def run(self, fs):
+        raise NotImplementedError
+
+    def make_tree(self, fs, top, files, depth=1, fanout=1):
+        '''
+        Create 'files' empty files spread in a tree of 'depth' levels of
+        'fanout' directories, and import them with a few bulk requests.
+        '''
+
+        dirs = [ top ]
+        for level in range(depth - 1):
+            dirs = [ os.path.join(dirpath, "dir%d" % i)
+                     for dirpath in dirs for i in range(fanout) ]
+
+        for index in range(files):
+            path = fs.realfs.real_path(os.path.join(dirs[index % len(dirs)],
+                                                    "file%06d" % index))
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "w").close()
+
+        fs.populate_tree(top, processes=0)
+
+        return [ os.path.join(dirs[index % len(dirs)], "file%06d" % index)
+                 for index in range(files) ]
+
+
+class CreateBenchmark(Benchmark):
+    name = "create"
+
+    def setup(self, fs):
+        fs.mkdir("/create")
+
+    def run(self, fs):
+        for index in range(self.scale):
+            f = fs.open("/create/file%06d" % index, os.O_CREAT | os.O_WRONLY, mode=0644)
+            f.write("data")
+            f.close()
+        return self.scale
+
+
+class MkdirBenchmark(Benchmark):
+    name = "mkdir"
+
+    def setup(self, fs):
+        fs.mkdir("/mkdir")
+
+    def run(self, fs):
+        for index in range(self.scale):
+            fs.mkdir("/mkdir/dir%06d" % index)
+        return self.scale
+
+
+class StatBenchmark(Benchmark):
+    name = "stat"
+
+    def setup(self, fs):
+        self.paths = self.make_tree(fs, "/stat", self.scale, depth=3, fanout=4)
+
+    def run(self, fs):
+        for path in self.paths:
+            fs.stat(path)
+        return len(self.paths)
+
+
+class StatStormBenchmark(StatBenchmark):
+    name = "stat_storm"
+    passes = 10
+
+    def run(self, fs):
+        for i in range(self.passes):
+            for path in self.paths:
+                fs.stat(path)
+        return len(self.paths) * self.passes
+
+
+class ListdirBenchmark(Benchmark):
+    name = "listdir"
+    passes = 10
+
+    def setup(self, fs):
+        self.make_tree(fs, "/listdir", self.scale)
+
+    def run(self, fs):
+        for i in range(self.passes):
+            for doc in fs.listdir("/listdir"):
+                fs.stat(doc.path)
+        return self.passes
+
+
+class ReaddirplusBenchmark(ListdirBenchmark):
+    name = "readdirplus"
+
+    def run(self, fs):
+        for i in range(self.passes):
+            for name, stats in fs.readdirplus("/listdir"):
+                fs.stat(os.path.join("/listdir", name))
+        return self.passes
+
+
+class RenameBenchmark(Benchmark):
+    name = "rename_deep"
+
+    def setup(self, fs):
+        self.paths = self.make_tree(fs, "/rename", self.scale, depth=6, fanout=2)
+
+    def run(self, fs):
+        fs.rename("/rename", "/renamed")
+        return len(self.paths)
+
+
+class RmtreeBenchmark(Benchmark):
+    name = "rmtree"
+
+    def setup(self, fs):
+        self.paths = self.make_tree(fs, "/rmtree", self.scale, depth=4, fanout=3)
+
+    def run(self, fs):
+        fs.rmtree("/rmtree")
+        return len(self.paths)
+
+
+class ShareBenchmark(Benchmark):
+    name = "share"
+
+    def setup(self, fs):
+        self.paths = self.make_tree(fs, "/share", self.scale / 10, depth=4, fanout=2)
+
+        file_acl = acl.ACL.from_mode(0644)
+        file_acl.append(acl.ACE(acl.ACL_GROUP, acl.ACL_READ, 100))
+        file_acl.append(acl.ACE(acl.ACL_MASK, acl.ACL_READ))
+        self.xattr = file_acl.to_xattr()
+
+    def run(self, fs):
+        for path in self.paths:
+            fs.setxattr(path, acl.ACL_XATTR, self.xattr)
+        return len(self.paths)
+
+
+class DuBenchmark(Benchmark):
+    name = "du"
+    passes = 100
+
+    def setup(self, fs):
+        self.make_tree(fs, "/du", self.scale, depth=3, fanout=4)
+
+    def run(self, fs):
+        for i in range(self.passes):
+            fs.du("/du")
+            fs.df()
+        return self.passes * 2
+
+
+BENCHMARKS = [ CreateBenchmark, MkdirBenchmark, StatBenchmark, StatStormBenchmark,
+               ListdirBenchmark, ReaddirplusBenchmark, RenameBenchmark,
+               RmtreeBenchmark, ShareBenchmark, DuBenchmark ]
+
+def run_benchmark(server, benchmark, compact=False):
+    root = tempfile.mkdtemp(prefix="ufo-bench-")
+    db_name = "bench_%s" % benchmark.name
+    try:
+        options = { 'server' : server.url, 'watch_changes' : False,
+                    'compact_views' : compact }
+
+        fs = CouchedFileSystem(root, db_name, **options)
+        benchmark.setup(fs)
+        fs.close()
+
+        # Time the operations with cold caches
+        fs = CouchedFileSystem(root, db_name, **options)
+        server.stats(reset=True)
+
+        started = time.time()
+        ops = benchmark.run(fs)
+        elapsed = max(time.time() - started, 0.000001)
+
+        requests = server.stats(reset=True)
+        total = sum(requests.values())
+        fs.close()
+
+        # Let the server threads of the keep-alive connections terminate
+        fs.doc_helper.server.resource.session.close()
+
+        return { 'ops'             : ops,
+                 'seconds'         : elapsed,
+                 'ops_per_sec'     : ops / elapsed,
+                 'requests'        : requests,
+                 'requests_per_op' : float(total) / ops }
+
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def compare(results, baseline, tolerance, throughputs=True):
+    regressions = []
+    for name, result in sorted(results.items()):
+        reference = baseline.get(name)
+        if not reference:
+            continue
+
+        if result['requests_per_op'] > reference['requests_per_op'] + 0.01:
+            regressions.append("%s: %.2f requests/op instead of %.2f" %
+                               (name, result['requests_per_op'], reference['requests_per_op']))
+
+        if throughputs and result['ops_per_sec'] < reference['ops_per_sec'] * (1 - tolerance):
+            regressions.append("%s: %.1f ops/s instead of %.1f" %
+                               (name, result['ops_per_sec'], reference['ops_per_sec']))
+
+    return regressions
+
+def report(results, baseline):
+    print "%-12s %8s %10s %10s %10s %10s" % ("benchmark", "ops", "ops/s", "baseline",
+                                            "requests", "req/op")
+    for benchmark in BENCHMARKS:
+        result = results.get(benchmark.name)
+        if result is None:
+            continue
+
+        name = benchmark.name
+        reference = baseline.get(name, {}).get('ops_per_sec')
+        print "%-12s %8d %10.1f %10s %10d %10.2f" % \
+              (name, result['ops'], result['ops_per_sec'],
+               reference and "%.1f" % reference or "-",
+               sum(result['requests'].values()), result['requests_per_op'])
+
+        for request, count in sorted(result['requests'].items()):
+            print "%14s%-30s %d" % ("", request, count)
+
+def main():
+    parser = OptionParser(usage="%prog [options] [benchmark...]")
+    parser.add_option("--scale", type="int", default=1000,
+                      help="number of files of the benchmarks (default: %default)")
+    parser.add_option("--latency", type="float", default=0.0,
+                      help="seconds added to every database request (default: %default)")
+    parser.add_option("--jitter", type="float", default=0.0,
+                      help="random seconds added to the latency (default: %default)")
+    parser.add_option("--compact", action="store_true", default=False,
+                      help="use the compact views")
+    parser.add_option("--baseline", default=BASELINE,
+                      help="baseline to compare with (default: %default)")
+    parser.add_option("--tolerance", type="float", default=0.25,
+                      help="throughput drop tolerated (default: %default)")
+    parser.add_option("--save", action="store_true", default=False,
+                      help="save the results as the new baseline")
+    options, names = parser.parse_args()
+
+    params = { 'scale'   : options.scale,
+               'latency' : options.latency,
+               'jitter'  : options.jitter,
+               'compact' : options.compact }
+
+    baseline = {}
+    same_host = False
+    if os.path.exists(options.baseline):
+        stored = json.load(open(options.baseline))
+        if stored.get('params') == params:
+            baseline = stored['results']
+            same_host = stored.get('host') == platform.node()
+            if not same_host:
+                print "Not comparing the throughputs with %s, saved on %s" % \
+                      (options.baseline, stored.get('host') or "another host")
+        else:
+            print "Not comparing with %s, made with %s" % (options.baseline, stored.get('params'))
+
+    server = FakeCouchDB(options.latency, options.jitter)
+    server.start()
+
+    results = {}
+    try:
+        for benchmark in BENCHMARKS:
+            if names and benchmark.name not in names:
+                continue
+            results[benchmark.name] = run_benchmark(server, benchmark(options.scale),
+                                                    options.compact)
+
+    finally:
+        server.stop()
+
+    report(results, baseline)
+
+    if options.save:
+        if baseline and same_host:
+            baseline.update(results)
+            results = baseline
+        stored = open(options.baseline, "w")
+        json.dump({ 'host' : platform.node(), 'params' : params, 'results' : results },
+                  stored, indent=1, sort_keys=True)
+        stored.close()
+        return 0
+
+    regressions = compare(results, baseline, options.tolerance, same_host)
+    for regression in regressions:
+        print "REGRESSION", regression
+
+    return regressions and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,734 @@
+# Copyright (C) 2010  Agorabox. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''
+In-process stand-in for a CouchDB server, for the benchmarks.
+
+It speaks enough of the CouchDB HTTP API for couchdb-python and the
+DocumentHelper: databases, documents, _bulk_docs, _all_docs, the changes
+feed, continuous or not, and the views of the SyncDocument,
+CompactSyncDocument, FilenameSearchDocument and FriendDocument design
+documents, whose map functions are reimplemented in Python and indexed
+incrementally.
+
+The tests use it too, from the tests directory.
+'''
+
+import time
+import json
+import random
+import socket
+import bisect
+import urllib
+import threading
+import BaseHTTPServer
+import SocketServer
+from uuid import uuid4
+from urlparse import urlsplit, parse_qsl
+
+# Linux only
+QUICKACK = getattr(socket, 'TCP_QUICKACK', None)
+
+# Greater than any document id
+MAX_ID = u"\uffff\uffff"
+
+def collate(value):
+    '''
+    Sort key of a JSON value, following the CouchDB view collation:
+    null, false, true, numbers, strings, arrays and objects.
+    '''
+
+    if value is None:
+        return (0,)
+    if value is False:
+        return (1,)
+    if value is True:
+        return (2,)
+    if isinstance(value, (int, long, float)):
+        return (3, value)
+    if isinstance(value, basestring):
+        return (4, value)
+    if isinstance(value, list):
+        return (5, tuple([ collate(item) for item in value ]))
+    return (6, tuple([ (key, collate(item)) for key, item in sorted(value.items()) ]))
+
+def endpoint(parts):
+    '''
+    Name of the endpoint of a request, the view name for the views.
+    '''
+
+    if not parts:
+        return '/'
+    if len(parts) == 1:
+        return '_db'
+    if parts[1] == '_design' and len(parts) == 5 and parts[3] == '_view':
+        return str(parts[4])
+    if parts[1] in ('_bulk_docs', '_all_docs', '_changes'):
+        return parts[1]
+    return '_doc'
+
+def _prefixes(dirpath):
+    # The ancestors emitted by the *_by_dir_prefix views
+    current = dirpath
+    last = u''
+    while current != u'/' and current != last:
+        yield current
+        last = current
+        current = current[:current.rfind(u'/')]
+
+def _path(doc):
+    if doc['dirpath'] == u'/':
+        return u'/' + doc['filename']
+    return doc['dirpath'] + u'/' + doc['filename']
+
+def _filename_trigrams(doc):
+    name = doc['filename'].lower() + u'//'
+    return sorted(set([ name[i:i + 3] for i in range(len(name) - 2) ]))
+
+def map_by_path(doc):
+    return [ (_path(doc), doc) ]
+
+def map_by_type(doc):
+    if doc.get('type') != 'application/x-directory':
+        return [ (doc['type'].split('/'), doc) ]
+    return []
+
+def map_by_dir(doc):
+    return [ (doc['dirpath'], doc) ]
+
+def map_by_dir_prefix(doc):
+    return [ (current, doc) for current in _prefixes(doc['dirpath']) ]
+
+def map_revs_by_dir_prefix(doc):
+    return [ (current, doc['_rev']) for current in _prefixes(doc['dirpath']) ]
+
+def map_usage_by_dir(doc):
+    if doc.get('type') == 'application/x-directory':
+        usage = [ 0, 0, 1 ]
+    else:
+        usage = [ (doc.get('stats') or {}).get('st_size', 0), 1, 0 ]
+    return [ (current, usage) for current in _prefixes(doc['dirpath']) ] + [ (u'/', usage) ]
+
+def map_by_tag(doc):
+    return [ ([ tag, doc['stats']['st_uid'] ], doc) for tag in doc.get('tags') or [] ]
+
+def map_by_provider_and_participant(doc):
+    if doc['dirpath'] == u'/':
+        path = doc['dirpath'] + doc['filename']
+    else:
+        path = _path(doc)
+    return [ ([ doc['stats']['st_uid'], ace.get('qualifier'), path ], doc)
+             for ace in doc.get('acl') or [] ]
+
+def map_by_trigram(doc):
+    return [ (trigram, None) for trigram in _filename_trigrams(doc) ]
+
+def map_by_filename(doc):
+    return [ (doc['filename'].lower(), None) ]
+
+def map_by_login(doc):
+    return [ (doc.get('login'), doc) ]
+
+def map_by_login_and_status(doc):
+    if doc.get('status'):
+        return [ ([ doc.get('login'), doc['status'] ], doc) ]
+    return []
+
+def map_by_status(doc):
+    if doc.get('status'):
+        return [ (doc['status'], doc) ]
+    return []
+
+def reduce_count(keys, values):
+    return len(values)
+
+def reduce_sum(keys, values):
+    if values and isinstance(values[0], list):
+        return [ sum(column) for column in zip(*values) ]
+    return sum(values)
+
+# Map and reduce functions of the views of the SyncDocument designs
+VIEWS = { 'by_path'                     : (map_by_path, None),
+          'by_type'                     : (map_by_type, reduce_count),
+          'by_dir'                      : (map_by_dir, None),
+          'by_dir_prefix'               : (map_by_dir_prefix, None),
+          'revs_by_dir_prefix'          : (map_revs_by_dir_prefix, None),
+          'usage_by_dir'                : (map_usage_by_dir, reduce_sum),
+          'by_tag'                      : (map_by_tag, reduce_count),
+          'by_provider_and_participant' : (map_by_provider_and_participant, reduce_count) }
+
+SEARCH_VIEWS = { 'by_trigram'  : (map_by_trigram, None),
+                 'by_filename' : (map_by_filename, None) }
+
+FRIEND_VIEWS = { 'by_login'            : (map_by_login, None),
+                 'by_login_and_status' : (map_by_login_and_status, None),
+                 'by_status'           : (map_by_status, None) }
+
+# Design name: indexed doctype, views, and whether the views emit
+# null instead of the documents, as the compact design does
+DESIGNS = { 'syncdocument'         : ('SyncDocument', VIEWS, False),
+            'syncdocument_compact' : ('SyncDocument', VIEWS, True),
+            'search'               : ('SyncDocument', SEARCH_VIEWS, False),
+            'friend'               : ('FriendDocument', FRIEND_VIEWS, False) }
+
+
+class NotFound(Exception):
+    status = 404
+    error = "not_found"
+
+class Conflict(Exception):
+    status = 409
+    error = "conflict"
+
+class PreconditionFailed(Exception):
+    status = 412
+    error = "file_exists"
+
+class BadRequest(Exception):
+    status = 400
+    error = "bad_request"
+
+
+class ViewIndex(object):
+    '''
+    Rows of a view, sorted by key and document id, maintained as the
+    documents are written.
+    '''
+
+    def __init__(self, doctype, map_fun, reduce_fun=None, compact=False):
+        self.doctype = doctype
+        self.map_fun = map_fun
+        self.reduce_fun = reduce_fun
+        self.compact = compact
+
+        self.rows = []
+        self.rows_by_doc = {}
+
+    def update(self, docid, doc):
+        for row in self.rows_by_doc.pop(docid, ()):
+            index = bisect.bisect_left(self.rows, row)
+            del self.rows[index]
+
+        if doc is None or doc.get('doctype') != self.doctype:
+            return
+
+        rows = []
+        for key, value in self.map_fun(doc):
+            if self.compact and value is doc:
+                value = None
+            row = (collate(key), docid, key, value)
+            bisect.insort(self.rows, row)
+            rows.append(row)
+
+        self.rows_by_doc[docid] = rows
+
+    def query(self, docs, options, keys=None):
+        if keys is not None:
+            rows = []
+            for key in keys:
+                rows.extend(self._range({ 'key' : key }))
+        else:
+            rows = self._range(options, options.get('descending', False))
+
+        if options.get('reduce', self.reduce_fun is not None):
+            if self.reduce_fun is None:
+                raise BadRequest("Reduce is invalid for map-only views.")
+            return { 'rows' : self._reduce(rows, options) }
+
+        skip = options.get('skip', 0)
+        limit = options.get('limit')
+        if limit is not None:
+            rows = rows[skip:skip + limit]
+        else:
+            rows = rows[skip:]
+
+        result = []
+        for sortkey, docid, key, value in rows:
+            row = { 'id' : docid, 'key' : key, 'value' : value }
+            if options.get('include_docs'):
+                row['doc'] = docs.get(docid)
+            result.append(row)
+
+        return { 'total_rows' : len(self.rows), 'offset' : 0, 'rows' : result }
+
+    def _range(self, options, descending=False):
+        if options.has_key('key'):
+            options = dict(options, startkey=options['key'], endkey=options['key'])
+
+        startkey = ( 'startkey', options.get('startkey_docid', u'') )
+        endkey = ( 'endkey', options.get('endkey_docid', MAX_ID) )
+        if descending:
+            startkey, endkey = ( 'endkey', options.get('endkey_docid', u'') ), \
+                               ( 'startkey', options.get('startkey_docid', MAX_ID) )
+
+        low = 0
+        if options.has_key(startkey[0]):
+            low = bisect.bisect_left(self.rows, (collate(options[startkey[0]]), startkey[1]))
+
+        high = len(self.rows)
+        if options.has_key(endkey[0]):
+            if options.get('inclusive_end', True):
+                high = bisect.bisect_right(self.rows, (collate(options[endkey[0]]), endkey[1]))
+            else:
+                high = bisect.bisect_left(self.rows, (collate(options[endkey[0]]),))
+
+        rows = self.rows[low:high]
+        if descending:
+            rows.reverse()
+        return rows
+
+    def _reduce(self, rows, options):
+        level = options.get('group_level')
+        if options.get('group'):
+            level = None
+        elif level is None:
+            if not rows:
+                return []
+            values = [ value for sortkey, docid, key, value in rows ]
+            return [ { 'key' : None, 'value' : self.reduce_fun(None, values) } ]
+
+        groups = []
+        for sortkey, docid, key, value in rows:
+            if level is not None and isinstance(key, list):
+                key = key[:level]
+            if groups and groups[-1][0] == key:
+                groups[-1][1].append(value)
+            else:
+                groups.append((key, [ value ]))
+
+        return [ { 'key' : key, 'value' : self.reduce_fun(None, values) }
+                 for key, values in groups ]
+
+
+class Database(object):
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.seq = 0
+
+        # Last change of every document, by document id
+        self.changes = {}
+
+        self.views = {}
+        for design, (doctype, views, compact) in DESIGNS.items():
+            for view, (map_fun, reduce_fun) in views.items():
+                self.views[(design, view)] = ViewIndex(doctype, map_fun, reduce_fun, compact)
+
+    def get(self, docid):
+        if not self.docs.has_key(docid):
+            raise NotFound("missing")
+        return self.docs[docid]
+
+    def put(self, doc):
+        docid = doc.get('_id') or uuid4().hex
+        current = self.docs.get(docid)
+        if (current and current['_rev'] != doc.get('_rev')) or \
+           (not current and doc.get('_rev')):
+            raise Conflict("Document update conflict.")
+
+        generation = current and int(current['_rev'].split('-')[0]) or 0
+        self.seq += 1
+
+        if doc.get('_deleted'):
+            if not current:
+                raise NotFound("missing")
+            del self.docs[docid]
+            doc = None
+            rev = "%d-%s" % (generation + 1, uuid4().hex)
+        else:
+            doc = dict(doc, _id=docid)
+            doc['_rev'] = rev = "%d-%s" % (generation + 1, uuid4().hex)
+            self.docs[docid] = doc
+
+        for index in self.views.values():
+            index.update(docid, doc)
+
+        self.changes[docid] = (self.seq, rev, doc is None)
+
+        return docid, rev
+
+    def changes_since(self, since, include_docs=False):
+        '''
+        Return the changes after the sequence number 'since', the last
+        one of every document only, like CouchDB.
+        '''
+
+        results = []
+        for docid, (seq, rev, deleted) in self.changes.items():
+            if seq <= since:
+                continue
+
+            change = { 'seq' : seq, 'id' : docid, 'changes' : [ { 'rev' : rev } ] }
+            if deleted:
+                change['deleted'] = True
+            if include_docs:
+                change['doc'] = self.docs.get(docid) or \
+                                { '_id' : docid, '_rev' : rev, '_deleted' : True }
+            results.append(change)
+
+        results.sort(key=lambda change: change['seq'])
+        return results
+
+    def delete(self, docid, rev):
+        return self.put({ '_id' : docid, '_rev' : rev, '_deleted' : True })
+
+    def all_docs(self, options, keys=None):
+        if keys is None:
+            keys = sorted(self.docs)
+            if options.has_key('startkey'):
+                keys = [ key for key in keys if key >= options['startkey'] ]
+            if options.has_key('endkey'):
+                keys = [ key for key in keys if key <= options['endkey'] ]
+
+        rows = []
+        for key in keys:
+            doc = self.docs.get(key)
+            if doc is None:
+                rows.append({ 'key' : key, 'error' : 'not_found' })
+                continue
+
+            row = { 'id' : key, 'key' : key, 'value' : { 'rev' : doc['_rev'] } }
+            if options.get('include_docs'):
+                row['doc'] = doc
+            rows.append(row)
+
+        return { 'total_rows' : len(self.docs), 'offset' : 0, 'rows' : rows }
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Send the responses in one piece, the unbuffered writes of the
+    # headers would add the delayed ACKs to the latency of every request
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            # The client went away while the response was sent, as the
+            # stopped changes watchers do
+            self.close_connection = 1
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            # The client went away, as the stopped changes watchers do
+            self.rfile.close()
+
+    def do_HEAD(self):
+        self.handle_request("HEAD")
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def handle_request(self, method):
+        couchdb = self.server.couchdb
+
+        body = None
+        length = int(self.headers.get('content-length') or 0)
+        if length:
+            # httplib sends the body apart from the headers, acknowledge
+            # them right away instead of waiting for the delayed ACK
+            if QUICKACK:
+                self.connection.setsockopt(socket.IPPROTO_TCP, QUICKACK, 1)
+            body = json.loads(self.rfile.read(length))
+
+        url = urlsplit(self.path)
+        parts = [ urllib.unquote(part).decode('utf-8') for part in url.path.split('/') if part ]
+        options = {}
+        for name, value in parse_qsl(url.query):
+            if name in ('startkey_docid', 'endkey_docid', 'rev', 'stale', 'feed'):
+                options[name] = value.decode('utf-8')
+            else:
+                options[name] = json.loads(value)
+
+        couchdb.wait()
+
+        if len(parts) == 2 and parts[1] == '_changes' and options.get('feed') == 'continuous':
+            couchdb.count(method, endpoint(parts))
+            self.send_changes(couchdb, parts[0], options)
+            return
+
+        try:
+            status, result = couchdb.handle(method, parts, options, body)
+        except (NotFound, Conflict, PreconditionFailed, BadRequest), e:
+            status, result = e.status, { 'error' : e.error, 'reason' : str(e) }
+
+        couchdb.count(method, endpoint(parts))
+
+        data = json.dumps(result)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if method != "HEAD":
+            self.wfile.write(data)
+
+    def send_changes(self, couchdb, name, options):
+        '''
+        Stream the continuous changes feed, one change per chunk, and
+        newlines as heartbeats, until the server stops or the client
+        goes away.
+        '''
+
+        self.close_connection = 1
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.wfile.flush()
+
+        since = options.get('since', 0)
+        include_docs = options.get('include_docs', False)
+        heartbeat = options.get('heartbeat')
+        timeout = heartbeat and heartbeat / 1000.0 or 60
+
+        try:
+            while True:
+                changes = couchdb.changes(name, since, include_docs, timeout)
+                if changes is None:
+                    break
+
+                if not changes and heartbeat:
+                    self.write_chunk("\n")
+
+                for change in changes:
+                    self.write_chunk(json.dumps(change) + "\n")
+                    since = change['seq']
+
+                self.wfile.flush()
+
+            self.write_chunk("")
+            self.wfile.flush()
+
+        except socket.error:
+            pass
+
+    def write_chunk(self, data):
+        self.wfile.write("%x\r\n%s\r\n" % (len(data), data))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeCouchDB(object):
+    '''
+    CouchDB stand-in listening on a local port, served from a background
+    thread. Every request waits 'latency' seconds, plus up to 'jitter'
+    seconds, before being processed. The requests are counted by HTTP verb
+    and endpoint, the view name for the view requests.
+    '''
+
+    def __init__(self, latency=0.0, jitter=0.0, port=0):
+        self.latency = latency
+        self.jitter = jitter
+
+        self.databases = {}
+        self.requests = {}
+        self.lock = threading.RLock()
+
+        # Notified on every write, for the continuous changes feeds
+        self.changed = threading.Condition(self.lock)
+        self.stopped = False
+
+        self.httpd = HTTPServer(('127.0.0.1', port), RequestHandler)
+        self.httpd.couchdb = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.httpd.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.lock.acquire()
+        try:
+            self.stopped = True
+            self.changed.notifyAll()
+
+        finally:
+            self.lock.release()
+
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def wait(self):
+        delay = self.latency
+        if self.jitter:
+            delay += random.random() * self.jitter
+        if delay:
+            time.sleep(delay)
+
+    def count(self, method, endpoint):
+        self.lock.acquire()
+        try:
+            key = "%s %s" % (method, endpoint)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+        finally:
+            self.lock.release()
+
+    def stats(self, reset=False):
+        '''
+        Return the number of requests by verb and endpoint.
+        '''
+
+        self.lock.acquire()
+        try:
+            requests = self.requests.copy()
+            if reset:
+                self.requests = {}
+            return requests
+
+        finally:
+            self.lock.release()
+
+    def changes(self, name, since, include_docs=False, timeout=60):
+        '''
+        Return the changes of a database after 'since', waiting up to
+        'timeout' seconds for one, or None once the server is stopped or
+        the database deleted.
+        '''
+
+        self.lock.acquire()
+        try:
+            waited = False
+            while not self.stopped:
+                database = self.databases.get(name)
+                if database is None:
+                    return None
+
+                changes = database.changes_since(since, include_docs)
+                if changes or waited:
+                    return changes
+
+                self.changed.wait(timeout)
+                waited = True
+
+            return None
+
+        finally:
+            self.lock.release()
+
+    def handle(self, method, parts, options, body):
+        self.lock.acquire()
+        try:
+            if not parts:
+                return 200, { 'couchdb' : 'Welcome', 'version' : '1.0.1' }
+
+            name = parts[0]
+            if len(parts) == 1:
+                return self._handle_database(method, name)
+
+            database = self.databases.get(name)
+            if database is None:
+                raise NotFound("no_db_file")
+
+            if parts[1] == '_bulk_docs' and method == 'POST':
+                results = []
+                for doc in body['docs']:
+                    try:
+                        docid, rev = database.put(doc)
+                        results.append({ 'id' : docid, 'rev' : rev })
+                    except (Conflict, NotFound), e:
+                        results.append({ 'id' : doc.get('_id'), 'error' : e.error,
+                                         'reason' : str(e) })
+                return 201, results
+
+            if parts[1] == '_all_docs':
+                return 200, database.all_docs(options, body and body.get('keys'))
+
+            if parts[1] == '_changes':
+                return 200, { 'results'  : database.changes_since(options.get('since', 0),
+                                                                  options.get('include_docs', False)),
+                              'last_seq' : database.seq }
+
+            if parts[1] == '_design' and len(parts) == 5 and parts[3] == '_view':
+                index = database.views.get((parts[2], parts[4]))
+                if index is None:
+                    raise NotFound("missing_named_view")
+                return 200, index.query(database.docs, options, body and body.get('keys'))
+
+            docid = '/'.join(parts[1:])
+            return self._handle_document(method, database, docid, options, body)
+
+        finally:
+            if method not in ('GET', 'HEAD'):
+                self.changed.notifyAll()
+            self.lock.release()
+
+    def _handle_database(self, method, name):
+        if method == 'PUT':
+            if self.databases.has_key(name):
+                raise PreconditionFailed("The database could not be created, the file already exists.")
+            self.databases[name] = Database(name)
+            return 201, { 'ok' : True }
+
+        database = self.databases.get(name)
+        if database is None:
+            raise NotFound("no_db_file")
+
+        if method == 'DELETE':
+            del self.databases[name]
+            return 200, { 'ok' : True }
+
+        return 200, { 'db_name'    : name,
+                      'doc_count'  : len(database.docs),
+                      'update_seq' : database.seq }
+
+    def _handle_document(self, method, database, docid, options, body):
+        if method in ('GET', 'HEAD'):
+            return 200, database.get(docid)
+
+        if method == 'PUT':
+            docid, rev = database.put(dict(body, _id=docid))
+            return 201, { 'ok' : True, 'id' : docid, 'rev' : rev }
+
+        if method == 'POST':
+            docid, rev = database.put(body)
+            return 201, { 'ok' : True, 'id' : docid, 'rev' : rev }
+
+        if method == 'DELETE':
+            docid, rev = database.delete(docid, options.get('rev'))
+            return 200, { 'ok' : True, 'id' : docid, 'rev' : rev }
+
+        raise BadRequest("Unsupported method %s" % method)
@@ -0,0 +1,64 @@
+'''
+Fixtures of the tests running against the fake CouchDB server of the
+benchmarks, started once per process.
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+
+from fakecouchdb import FakeCouchDB
+from ufo.filesystem import CouchedFileSystem
+
+_server = None
+
+def fake_server():
+    global _server
+    if _server is None:
+        _server = FakeCouchDB()
+        _server.start()
+    return _server
+
+
+class FakeServerTestCase(unittest.TestCase):
+    '''
+    Test case with a CouchedFileSystem on a fresh database of the fake
+    server, and a fresh temporary mount point. The file systems do not
+    follow the changes feed unless 'fs_options' tells otherwise.
+    '''
+
+    fs_options = {}
+
+    def setUp(self):
+        self.server = fake_server()
+        self.root = tempfile.mkdtemp(prefix="ufo-test-")
+        self.db_name = "test_%s" % uuid4().hex
+        self.fs = self.create_fs()
+
+    def tearDown(self):
+        self.fs.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def create_fs(self, **options):
+        options = dict(self.fs_options, **options)
+        options.setdefault('watch_changes', False)
+        return CouchedFileSystem(self.root, self.db_name, server=self.server.url, **options)
+
+    def create_file(self, path, data=""):
+        f = self.fs.open(path, os.O_CREAT | os.O_WRONLY, mode=0644)
+        if data:
+            f.write(data)
+        f.close()
+
+    def requests(self):
+        '''
+        Return the requests received since the last call, by verb and
+        endpoint.
+        '''
+
+        return self.server.stats(reset=True)
@@ -0,0 +1,63 @@
+import struct
+import unittest
+from ufo.acl import *
+
+class ACLDiffTestCase(unittest.TestCase):
+    def setUp(self):
+        self.old = ACL.from_mode(0750)
+        self.old.append(ACE(ACL_USER, ACL_READ, 1000))
+        self.old.append(ACE(ACL_USER, ACL_READ, 1001))
+        self.old.check()
+
+        self.new = ACL.from_mode(0750)
+        self.new.append(ACE(ACL_USER, ACL_READ | ACL_WRITE, 1000))
+        self.new.append(ACE(ACL_USER, ACL_READ, 1002))
+        self.new.check()
+
+    def test_diff(self):
+        changes = diff(self.old, self.new)
+        assert [ ace._qualifier for ace in changes.added ] == [ 1002 ]
+        assert [ ace._qualifier for ace in changes.removed ] == [ 1001 ]
+        assert [ new._perms for old, new in changes.changed
+                 if new.kind == ACL_USER ] == [ ACL_READ | ACL_WRITE ]
+        assert not diff(self.old, self.old.freeze())
+
+    def test_apply(self):
+        result = diff(self.old, self.new).apply(self.old)
+        assert result.to_xattr() == self.new.to_xattr()
+        assert result.get(ACL_MASK)._perms == ACL_READ | ACL_WRITE | ACL_EXECUTE
+
+class NFS4EncodingTestCase(unittest.TestCase):
+    def test_xattr(self):
+        acl = ACL.from_mode(0640)
+        value = acl.to_nfs4_xattr()
+        assert value == struct.pack(">I", 3) + \
+                        struct.pack(">IIII", 0, 0, 0x7, 6) + "OWNER@\0\0" + \
+                        struct.pack(">IIII", 0, 0x40, 0x1, 6) + "GROUP@\0\0" + \
+                        struct.pack(">IIII", 0, 0, 0x0, 9) + "EVERYONE@\0\0\0"
+        assert acl.freeze().to_nfs4_xattr() == value
+
+    def test_mask_skipped(self):
+        acl = ACL.from_mode(0750)
+        acl.append(ACE(ACL_USER, ACL_READ, 0))
+        acl.check()
+        assert struct.unpack(">I", acl.to_nfs4_xattr()[:4]) == (4,)
+
+class FrozenACLTestCase(unittest.TestCase):
+    def test_json_copies(self):
+        acl = ACL.from_mode(0750)
+        acl.append(ACE(ACL_USER, ACL_READ, 1000))
+        acl.check()
+        frozen = acl.freeze()
+
+        entries = frozen.to_json()
+        entries[0]['privileges'].append("write")
+        entries[0]['qualifier'] = 1001
+        assert frozen.to_json() == [ { 'qualifier' : 1000, 'privileges' : [ "read" ] } ]
+
+suite = unittest.TestSuite([ unittest.TestLoader().loadTestsFromTestCase(ACLDiffTestCase),
+                             unittest.TestLoader().loadTestsFromTestCase(NFS4EncodingTestCase),
+                             unittest.TestLoader().loadTestsFromTestCase(FrozenACLTestCase) ])
+
+if __name__ == '__main__':
+    unittest.main()
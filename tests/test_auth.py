@@ -0,0 +1,134 @@
+import time
+import httplib
+import threading
+import unittest
+import SocketServer
+import BaseHTTPServer
+
+from ufo.auth import SPNEGOAuthenticator
+from ufo.database import ConnectionPool
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Accepts the negotiation token and the 'AuthSession=new' cookie it
+    issues, answers the other requests with a 401.
+    '''
+
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get('content-length') or 0))
+        self.server.requests.append((self.headers.get('authorization'),
+                                     self.headers.get('cookie'), body))
+
+        if self.headers.get('authorization') == "Negotiate token" or \
+           self.headers.get('cookie') == "AuthSession=new":
+            self.send_response(200)
+            for cookie in self.server.cookies:
+                self.send_header('Set-Cookie', cookie)
+        else:
+            self.send_response(401)
+
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class Authenticator(SPNEGOAuthenticator):
+    def negotiate(self, service, host):
+        return { "Authorization" : "Negotiate token" }
+
+
+class SPNEGOTestCase(unittest.TestCase):
+    def setUp(self):
+        self.httpd = HTTPServer(('127.0.0.1', 0), RequestHandler)
+        self.httpd.requests = []
+        self.httpd.cookies = [ "AuthSession=new; Max-Age=600; Path=/" ]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+        self.auth = Authenticator()
+        self.host = "127.0.0.1:%d" % self.httpd.server_address[1]
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def put(self, body="{}", service="couchdb"):
+        conn = httplib.HTTPConnection(self.host)
+        self.auth.bind(conn, service, "127.0.0.1")
+        conn.request("PUT", "/db/doc", body)
+        response = conn.getresponse()
+        data = response.read()
+        conn.close()
+        return response.status, data
+
+    def expire_session(self):
+        self.auth.sessions[("couchdb", "127.0.0.1")] = ("AuthSession=old", time.time() + 600)
+
+    def test_session_reuse(self):
+        self.put()
+        self.put()
+        self.assertEquals(self.auth.stats()["127.0.0.1"],
+                          { 'negotiations' : 1, 'reuses' : 1 })
+        self.assertEquals(self.httpd.requests[1], (None, "AuthSession=new", "{}"))
+
+    def test_replay_rejected_session(self):
+        self.expire_session()
+        self.assertEquals(self.put('{"a": 1}'), (200, '{"a": 1}'))
+        self.assertEquals(self.httpd.requests,
+                          [ (None, "AuthSession=old", '{"a": 1}'),
+                            ("Negotiate token", None, '{"a": 1}') ])
+        self.assertEquals(self.auth.sessions[("couchdb", "127.0.0.1")][0], "AuthSession=new")
+
+    def test_replay_once(self):
+        self.expire_session()
+        self.httpd.cookies = []
+        self.auth.negotiate = lambda service, host: { "Authorization" : "Negotiate bad" }
+        self.assertEquals(self.put()[0], 401)
+        self.assertEquals(len(self.httpd.requests), 2)
+
+    def test_session_body_replay(self):
+        # The couchdb session writes the body to the socket itself
+        self.expire_session()
+        pool = ConnectionPool(auth=self.auth)
+        status, headers, data = pool.request("PUT", "http://%s/db/doc" % self.host,
+                                             body='{"b": 2}')
+        self.assertEquals(status, 200)
+        self.assertEquals([ request[0] for request in self.httpd.requests ],
+                          [ None, "Negotiate token" ])
+        self.assertEquals(self.httpd.requests[1][2], '{"b": 2}')
+        pool.close()
+
+    def test_other_cookies(self):
+        self.httpd.cookies = [ "other=1; Path=/" ]
+        self.put()
+        self.assertFalse(self.auth.sessions.has_key(("couchdb", "127.0.0.1")))
+
+    def test_invalid_max_age(self):
+        self.httpd.cookies = [ "AuthSession=new; Max-Age=soon" ]
+        self.put()
+        cookie, expires = self.auth.sessions[("couchdb", "127.0.0.1")]
+        self.assertEquals(cookie, "AuthSession=new")
+        self.assertTrue(expires > time.time() + 500)
+
+    def test_session_ended(self):
+        self.put()
+        self.httpd.cookies = [ "AuthSession=; Max-Age=0" ]
+        self.put()
+        self.assertFalse(self.auth.sessions.has_key(("couchdb", "127.0.0.1")))
+
+suite = unittest.TestLoader().loadTestsFromTestCase(SPNEGOTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import os
+import time
+import types
+import tempfile
+import threading
+import unittest
+
+import ufo.utils
+from ufo.utils import LRUCache, IdentityCache, MimeDetector
+
+class Item:
+    def __init__(self, id):
+        self.id = id
+
+class LRUCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = LRUCache(max_size=2, negative_timeout=0.1,
+                              identify=lambda item: item.id)
+
+    def test_eviction(self):
+        self.cache.cache("/a", Item("a"))
+        self.cache.cache("/b", Item("b"))
+        self.cache.lookup("/a")
+        self.cache.cache("/c", Item("c"))
+        assert self.cache.lookup("/a")[0]
+        assert not self.cache.lookup("/b")[0]
+        assert self.cache.stats()["evictions"] == 1
+
+    def test_negative(self):
+        self.cache.cache("/missing", None)
+        assert self.cache.lookup("/missing") == (True, None)
+        time.sleep(0.2)
+        assert self.cache.lookup("/missing") == (False, None)
+
+    def test_invalidate_id(self):
+        item = Item("a")
+        self.cache.cache("/a", item)
+        assert self.cache.find("a") is item
+        self.cache.invalidate_id("a")
+        assert not self.cache.has_key("/a")
+        assert self.cache.find("a") is None
+
+class IdentityCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.identities = IdentityCache(negative_timeout=0.1)
+
+    def test_lazy_groups(self):
+        infos = self.identities.resolve(uid=0)
+        assert not infos.has_key('groups')
+        assert infos['gid'] in infos['groups']
+        assert self.identities.resolve(login=infos['login']) is infos
+
+    def test_negative(self):
+        self.identities.resolve(login="nosuchuser")
+        assert self.identities.resolve(login="nosuchuser")['uid'] == -1
+        assert self.identities.stats()['hits'] == 1
+
+class Magic:
+    loaded = 0
+
+    def load(self):
+        Magic.loaded += 1
+
+    def file(self, path):
+        return "text/plain; charset=us-ascii"
+
+    def buffer(self, buffer):
+        return "application/octet-stream; charset=binary"
+
+class MimeDetectorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.magic = ufo.utils.magic
+        ufo.utils.magic = types.ModuleType("magic")
+        ufo.utils.magic.MAGIC_MIME = 0x10
+        ufo.utils.magic.open = lambda flags: Magic()
+        Magic.loaded = 0
+
+        self.detector = MimeDetector()
+        self.detections = []
+        detect_file = self.detector._detect_file
+        def count(path):
+            self.detections.append(path)
+            return detect_file(path)
+        self.detector._detect_file = count
+
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, "text")
+        os.close(fd)
+
+    def tearDown(self):
+        ufo.utils.magic = self.magic
+        os.unlink(self.path)
+
+    def test_cached(self):
+        assert self.detector.detect(self.path) == "text/plain"
+        assert self.detector.detect(self.path) == "text/plain"
+        assert len(self.detections) == 1
+
+        # The size changed
+        f = open(self.path, "a")
+        f.write("more")
+        f.close()
+        assert self.detector.detect(self.path) == "text/plain"
+        assert len(self.detections) == 2
+
+    def test_buffer(self):
+        assert self.detector.detect(self.path, buffer="\0\1") == "application/octet-stream"
+        assert self.detections == []
+        assert self.detector.detect(self.path) == "application/octet-stream"
+
+    def test_extensions(self):
+        detector = MimeDetector(use_extensions=True)
+        assert detector.detect("/missing/file.html") == "text/html"
+        assert Magic.loaded == 0
+
+    def test_handle_per_thread(self):
+        handles = [ self.detector._get_magic() ]
+        assert self.detector._get_magic() is handles[0]
+        thread = threading.Thread(target=lambda: handles.append(self.detector._get_magic()))
+        thread.start()
+        thread.join()
+        assert handles[1] is not handles[0]
+        assert Magic.loaded == 2
+
+suite = unittest.TestSuite([ unittest.TestLoader().loadTestsFromTestCase(LRUCacheTestCase),
+                             unittest.TestLoader().loadTestsFromTestCase(IdentityCacheTestCase),
+                             unittest.TestLoader().loadTestsFromTestCase(MimeDetectorTestCase) ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import time
+import unittest
+
+from fakeserver import fake_server
+from ufo.database import DocumentHelper, ConnectionPool
+from ufo.constants import FriendshipStatus
+from ufo.sharing import FriendDocument
+from ufo.user import ContactStore
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class ContactStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.stop()
+
+        for store in self.stores:
+            if store.watcher is not None:
+                store.watcher.join(5)
+
+            # Ends the feeds the fake server still streams to the watchers
+            helper = store.friend_helper
+            del helper.server[helper.database.name]
+
+    def create_store(self, name, watch_changes=True):
+        helper = DocumentHelper(FriendDocument, name, fake_server().url)
+        store = ContactStore(helper, watch_changes=watch_changes)
+        self.stores.append(store)
+        return helper, store
+
+    def test_watch_changes(self):
+        helper, store = self.create_store("test_contacts_watch")
+
+        helper.create(login=u"sam", uid=1000, status=FriendshipStatus.FRIEND)
+        self.assertTrue(wait_for(lambda: store.get(u"sam") is not None))
+        self.assertEquals(store.by_uid[1000].login, u"sam")
+        self.assertTrue(store.with_status(FriendshipStatus.FRIEND).has_key(u"sam"))
+
+    def test_watchers_do_not_hold_the_pool(self):
+        helper, store = self.create_store("test_contacts_pool_0")
+        pool = helper.server.resource.session
+        self.assertTrue(isinstance(pool, ConnectionPool))
+
+        for index in range(1, pool.max_size + 4):
+            self.create_store("test_contacts_pool_%d" % index)
+
+        self.assertEquals(pool.stats()['waits'], 0)
+        self.assertTrue(pool.stats()['active'] < pool.max_size)
+
+        helper.create(login=u"ken", uid=1001, status=FriendshipStatus.FRIEND)
+        self.assertTrue(wait_for(lambda: store.get(u"ken") is not None))
+
+    def test_stop(self):
+        helper, store = self.create_store("test_contacts_stop")
+        watcher = store.watcher
+        self.assertTrue(wait_for(lambda: watcher.session.stats()['active'] == 1))
+
+        started = time.time()
+        store.stop()
+        watcher.join(5)
+        self.assertFalse(watcher.isAlive())
+        self.assertTrue(time.time() - started < 1)
+
+    def test_indexes_are_copied(self):
+        helper, store = self.create_store("test_contacts_copies", watch_changes=False)
+        helper.create(login=u"bob", uid=1002, status=FriendshipStatus.FRIEND)
+        store = ContactStore(helper)
+
+        friends = store.with_status(FriendshipStatus.FRIEND)
+        friends.clear()
+        self.assertEquals(store.with_status(FriendshipStatus.FRIEND).keys(), [ u"bob" ])
+
+        by_uid = store.with_uid()
+        by_uid.clear()
+        self.assertEquals(store.with_uid().keys(), [ 1002 ])
+
+        self.assertEquals(store.with_status(FriendshipStatus.BLOCKED_USER), {})
+        self.assertFalse(store.by_status.has_key(FriendshipStatus.BLOCKED_USER))
+
+suite = unittest.TestLoader().loadTestsFromTestCase(ContactStoreTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import os
+import sys
+import time
+import threading
+import unittest
+from uuid import uuid4
+
+from fakeserver import fake_server
+from ufo.auth import NullAuthenticator
+from ufo.database import DocumentHelper, ConnectionPool
+from couchdb.client import Server
+from ufo.constants import FriendshipStatus
+from ufo.sharing import FriendDocument
+from ufo.filesystem import SyncDocument
+
+
+class IterViewTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = fake_server()
+        self.helper = DocumentHelper(FriendDocument, "test_%s" % uuid4().hex, self.server.url)
+        self.logins = [ u"user%d" % index for index in range(5) ]
+        for index, login in enumerate(self.logins):
+            status = index % 2 and FriendshipStatus.FRIEND or FriendshipStatus.BLOCKED_USER
+            self.helper.create(login=login, uid=1000 + index, status=status)
+        self.server.stats(reset=True)
+
+    def logins_of(self, documents):
+        return [ document.login for document in documents ]
+
+    def test_pages(self):
+        for prefetch in (False, True):
+            documents = list(self.helper.iterview('by_login', 2, prefetch=prefetch))
+            self.assertEquals(self.logins_of(documents), self.logins)
+            self.assertTrue(isinstance(documents[0], FriendDocument))
+            self.assertEquals(self.server.stats(reset=True), { "GET by_login" : 3 })
+
+    def test_exact_pages(self):
+        self.assertEquals(self.logins_of(self.helper.iterview('by_login', 5)), self.logins)
+        self.assertEquals(self.server.stats(reset=True), { "GET by_login" : 1 })
+
+    def test_key_and_wrapper(self):
+        rows = list(self.helper.iterview('by_status', 1, key=FriendshipStatus.FRIEND,
+                                         wrapper=lambda row: row.id))
+        self.assertEquals(len(rows), 2)
+        self.assertEquals(self.server.stats(reset=True), { "GET by_status" : 2 })
+
+    def test_updates_while_iterating(self):
+        logins = []
+        for document in self.helper.iterview('by_login', 2):
+            logins.append(document.login)
+            document.firstname = u"updated"
+            self.helper.update(document)
+
+        self.assertEquals(logins, self.logins)
+
+    def test_error(self):
+        view = self.helper.database.view
+        calls = []
+        def failing_view(*args, **kwargs):
+            calls.append(args)
+            if len(calls) > 1:
+                raise IOError("connection lost")
+            return view(*args, **kwargs)
+        self.helper.database.view = failing_view
+
+        for prefetch in (False, True):
+            del calls[:]
+            documents = self.helper.iterview('by_login', 2, prefetch=prefetch)
+            self.assertEquals(documents.next().login, self.logins[0])
+            documents.next()
+            self.assertRaises(IOError, documents.next)
+
+class Authenticator(NullAuthenticator):
+    def get_headers(self, service, host):
+        return {}
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = fake_server()
+
+    def test_shared_by_helpers(self):
+        helpers = [ DocumentHelper(FriendDocument, "test_%s" % uuid4().hex, self.server.url)
+                    for index in range(2) ]
+        self.assertTrue(helpers[0].server is helpers[1].server)
+        self.assertTrue(isinstance(helpers[0].server.resource.session, ConnectionPool))
+
+        other = DocumentHelper(FriendDocument, "test_%s" % uuid4().hex, self.server.url,
+                               auth=Authenticator())
+        self.assertTrue(other.server is not helpers[0].server)
+
+    def test_keep_alive(self):
+        pool = ConnectionPool()
+        server = Server(self.server.url, session=pool)
+        for index in range(5):
+            server.version()
+        self.assertEquals(pool.stats()['created'], 1)
+        self.assertEquals(pool.stats()['idle'], 1)
+        pool.close()
+
+    def test_max_size(self):
+        pool = ConnectionPool(max_size=2)
+        server = Server(self.server.url, session=pool)
+
+        def requests():
+            for index in range(5):
+                server.version()
+
+        threads = [ threading.Thread(target=requests) for index in range(5) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(pool.stats()['created'] <= 2)
+        self.assertEquals(pool.stats()['active'], 0)
+        pool.close()
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(idle_timeout=0)
+        server = Server(self.server.url, session=pool)
+        server.version()
+        time.sleep(0.01)
+        server.version()
+        self.assertEquals(pool.stats()['evictions'], 1)
+        self.assertEquals(pool.stats()['created'], 2)
+        pool.close()
+
+class SyncTestCase(unittest.TestCase):
+    def test_retired_views(self):
+        helper = DocumentHelper(SyncDocument, "test_%s" % uuid4().hex, fake_server().url)
+        helper.database.save({ '_id' : "_design/syncdocument",
+                               'language' : "javascript",
+                               'views' : { 'by_keyword' : { 'map' : "function (doc) {}" } } })
+
+        helper.sync()
+        views = helper.database["_design/syncdocument"]['views']
+        self.assertFalse(views.has_key('by_keyword'))
+        self.assertTrue(views.has_key('by_path'))
+
+        # Nothing left to remove
+        helper.sync()
+
+suite = unittest.TestSuite([ unittest.TestLoader().loadTestsFromTestCase(IterViewTestCase),
+                             unittest.TestLoader().loadTestsFromTestCase(ConnectionPoolTestCase),
+                             unittest.TestLoader().loadTestsFromTestCase(SyncTestCase) ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+import os
+import errno
+import socket
+import httplib
+import unittest
+import threading
+
+from ufo.fsbackend.dav import WebDAVFile, WebDAVFileSystem
+
+
+class Response(object):
+    def __init__(self, status=201, body=""):
+        self.status = status
+        self.reason = "Reason"
+        self.body = body
+
+    def read(self, length=None):
+        if length is None:
+            length = len(self.body)
+        data, self.body = self.body[:length], self.body[length:]
+        return data
+
+    def isclosed(self):
+        return not self.body
+
+
+class Connection(object):
+    def __init__(self, responses=None):
+        self.requests = []
+        self.responses = responses or []
+
+    def request(self, method, path, body=None, headers={}):
+        self.requests.append((method, path, body, headers))
+
+    def getresponse(self):
+        if self.responses:
+            return self.responses.pop(0)
+        return Response()
+
+    def close(self):
+        pass
+
+
+class StaleConnection(Connection):
+    '''
+    Connection that already served a request, and fails the next ones
+    with the given errors until it is closed.
+    '''
+
+    def __init__(self, errors, responses=None):
+        Connection.__init__(self, responses)
+        self.sock = object()
+        self.errors = errors
+
+    def request(self, method, path, body=None, headers={}):
+        Connection.request(self, method, path, body, headers)
+        if self.sock is None:
+            self.sock = object()
+        elif self.errors:
+            raise self.errors.pop(0)
+
+    def close(self):
+        self.sock = None
+
+
+class Resource(object):
+    def __init__(self, path):
+        self.path = path
+
+
+class FileSystem(object):
+    '''
+    WebDAVFileSystem stand-in handing out a single connection.
+    '''
+
+    def __init__(self, files=None):
+        self.files = files or {}
+        self.connection = Connection()
+        self.invalidated = []
+
+    def lstat(self, path):
+        if not self.files.has_key(path):
+            raise OSError(errno.ENOENT, "No such file or directory: '%s'" % path)
+        return os.stat_result((0100644, 0, 0, 1, 0, 0, self.files[path], 0, 0, 0))
+
+    def get_connection(self):
+        return self.connection
+
+    def release_connection(self, connection):
+        pass
+
+    def invalidate(self, path, subtree=False):
+        self.invalidated.append(path)
+
+
+class WebDAVFileTestCase(unittest.TestCase):
+    def open(self, fs, path, flags):
+        return WebDAVFile(Resource(path), flags, 0644, fs, path)
+
+    def test_create_without_truncate(self):
+        fs = FileSystem()
+        f = self.open(fs, "/new", os.O_CREAT | os.O_WRONLY)
+        f.write("hello")
+        f.close()
+
+        self.assertEquals(fs.connection.requests,
+                          [ ("PUT", "/new", "hello", { "Content-Range" : "bytes 0-4/5" }) ])
+        self.assertTrue("/new" in fs.invalidated)
+
+    def test_write_missing_file(self):
+        fs = FileSystem()
+        f = self.open(fs, "/missing", os.O_WRONLY)
+        self.assertRaises(OSError, f.write, "hello")
+
+    def test_buffered_writes(self):
+        fs = FileSystem({ "/file" : 10 })
+        f = self.open(fs, "/file", os.O_WRONLY)
+        f.seek(8)
+        f.write("ab")
+        f.write("cd")
+        f.close()
+
+        self.assertEquals(fs.connection.requests,
+                          [ ("PUT", "/file", "abcd", { "Content-Range" : "bytes 8-11/12" }) ])
+
+    def test_reused_connection_closed(self):
+        fs = FileSystem({ "/file" : 5 })
+        fs.connection = StaleConnection([ httplib.BadStatusLine("") ],
+                                        [ Response(206, "hello") ])
+        f = self.open(fs, "/file", os.O_RDONLY)
+        self.assertEquals(f.read(5), "hello")
+        self.assertEquals(len(fs.connection.requests), 2)
+
+    def test_reused_connection_broken_pipe(self):
+        fs = FileSystem({ "/file" : 0 })
+        fs.connection = StaleConnection([ socket.error(errno.EPIPE, "Broken pipe") ])
+        f = self.open(fs, "/file", os.O_WRONLY)
+        f.write("hello")
+        f.close()
+        self.assertEquals([ request[0] for request in fs.connection.requests ], [ "PUT", "PUT" ])
+
+    def test_retried_once(self):
+        def getresponse():
+            raise httplib.BadStatusLine("")
+
+        fs = FileSystem({ "/file" : 5 })
+        fs.connection = StaleConnection([])
+        fs.connection.getresponse = getresponse
+        f = self.open(fs, "/file", os.O_RDONLY)
+        self.assertRaises(httplib.BadStatusLine, f.read, 5)
+        self.assertEquals(len(fs.connection.requests), 2)
+
+        # A new connection has no reason to be closed
+        fs.connection = Connection()
+        fs.connection.getresponse = getresponse
+        f = self.open(fs, "/file", os.O_RDONLY)
+        self.assertRaises(httplib.BadStatusLine, f.read, 5)
+        self.assertEquals(len(fs.connection.requests), 1)
+
+    def test_other_errors_not_retried(self):
+        fs = FileSystem({ "/file" : 5 })
+        fs.connection = StaleConnection([ socket.error(errno.ETIMEDOUT, "Timed out") ])
+        f = self.open(fs, "/file", os.O_RDONLY)
+        self.assertRaises(socket.error, f.read, 5)
+        self.assertEquals(len(fs.connection.requests), 1)
+
+class StorersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fs = WebDAVFileSystem("http://127.0.0.1:1/webdav")
+
+    def in_thread(self, func, *args):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(func(*args)))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_per_thread(self):
+        storer = self.fs._resource("/a")
+        self.assertTrue(self.fs._resource("/a") is storer)
+        self.assertTrue(self.fs._collection("/") is not None)
+
+        other = self.in_thread(self.fs._resource, "/a")
+        self.assertTrue(other is not storer)
+        self.assertTrue(other.connection is not storer.connection)
+        self.assertTrue(self.fs._collection("/").connection is storer.connection)
+
+    def test_invalidate_all_threads(self):
+        thread_storers = []
+        def create():
+            local = self.fs._storers()
+            self.fs._resource("/dir/a")
+            thread_storers.append(local.resources)
+            ready.set()
+            done.wait(5)
+
+        ready, done = threading.Event(), threading.Event()
+        thread = threading.Thread(target=create)
+        thread.start()
+        ready.wait(5)
+
+        self.fs._resource("/dir/b")
+        self.fs.invalidate("/dir", subtree=True)
+        self.assertFalse(thread_storers[0].has_key("/dir/a"))
+        self.assertFalse(self.fs._storers().resources.has_key("/dir/b"))
+
+        done.set()
+        thread.join()
+
+suite = unittest.TestSuite([ unittest.TestLoader().loadTestsFromTestCase(WebDAVFileTestCase),
+                             unittest.TestLoader().loadTestsFromTestCase(StorersTestCase) ])
+
+if __name__ == '__main__':
+    unittest.main()
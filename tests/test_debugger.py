@@ -0,0 +1,65 @@
+import unittest
+
+import ufo.debugger
+from ufo import config
+from ufo.debugger import Debugger
+
+
+class Formatted(object):
+    '''
+    Argument counting how many times it is formatted.
+    '''
+
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return "formatted"
+
+
+class DebuggerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.patched = (config.debug_mode, config.debug_sampling,
+                        ufo.debugger.syslog, ufo.debugger._opened)
+        self.messages = []
+        ufo.debugger.syslog = lambda level, message: self.messages.append(message)
+        ufo.debugger._opened = True
+        config.debug_sampling = 1
+
+    def tearDown(self):
+        (config.debug_mode, config.debug_sampling,
+         ufo.debugger.syslog, ufo.debugger._opened) = self.patched
+
+    def test_disabled(self):
+        config.debug_mode = False
+        argument = Formatted()
+        Debugger().debug("value: %s", argument)
+        self.assertEquals(argument.formatted, 0)
+        self.assertEquals(self.messages, [])
+
+    def test_enabled(self):
+        config.debug_mode = True
+        argument = Formatted()
+        Debugger().debug("value: %s", argument)
+        self.assertEquals(argument.formatted, 1)
+        self.assertEquals(self.messages, [ "Debugger(test_enabled): value: formatted" ])
+
+    def test_without_arguments(self):
+        config.debug_mode = True
+        Debugger().debug("100%")
+        Debugger().debug("x" * 300)
+        self.assertEquals(self.messages[0], "Debugger(test_without_arguments): 100%")
+        self.assertEquals(len(self.messages[1]), 255)
+
+    def test_sampling(self):
+        config.debug_mode = True
+        config.debug_sampling = 0
+        argument = Formatted()
+        Debugger().debug("value: %s", argument)
+        self.assertEquals(argument.formatted, 0)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(DebuggerTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import unittest
+
+from fakeserver import FakeServerTestCase
+from ufo.utils import MimeDetector
+
+
+class HeadTestCase(FakeServerTestCase):
+    def open(self, path):
+        return self.fs.open(path, os.O_CREAT | os.O_WRONLY, mode=0644)
+
+    def test_sequential(self):
+        f = self.open("/file")
+        f.write("a" * (MimeDetector.head_size - 1))
+        f.write("bc")
+        f.write("d")
+        self.assertEquals(f.head, "a" * (MimeDetector.head_size - 1) + "b")
+        f.close()
+
+    def test_overwritten(self):
+        f = self.open("/file")
+        f.write("a" * MimeDetector.head_size)
+        f.seek(10)
+        f.write("b")
+        self.assertEquals(f.head, None)
+        f.close()
+
+    def test_written_after_head(self):
+        f = self.open("/file")
+        f.write("a" * MimeDetector.head_size)
+        f.seek(MimeDetector.head_size + 10)
+        f.write("b")
+        self.assertEquals(len(f.head), MimeDetector.head_size)
+        f.close()
+
+    def test_gap(self):
+        f = self.open("/file")
+        f.seek(10)
+        f.write("b")
+        self.assertEquals(f.head, None)
+        f.close()
+
+suite = unittest.TestLoader().loadTestsFromTestCase(HeadTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
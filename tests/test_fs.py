@@ -7,7 +7,7 @@ JOHN_ID = 123456
 
 class FileSystemTestCase(unittest.TestCase):
     def setUp(self):
-        self.fs = fs = CouchedFileSystem("/tmp", "test_fs")
+        self.fs = fs = CouchedFileSystem("/tmp", "test_fs", watch_changes=False)
         fs.doc_helper.sync()
 
         if not fs.exists("/test"):
@@ -18,6 +18,9 @@ class FileSystemTestCase(unittest.TestCase):
         f.stats.st_size = 1000
         self.fs.doc_helper.update(f)
 
+    def tearDown(self):
+        self.fs.close()
+
     def test_acl(self):
         f = self.fs["/test/image.png"]
         posix_acl = f.posix_acl
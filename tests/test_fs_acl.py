@@ -0,0 +1,93 @@
+import unittest
+
+import ufo.acl
+import ufo.user
+from ufo.acl import ACL, ACE, ACL_USER, ACL_MASK, ACL_READ, ACL_WRITE, ACL_EXECUTE
+
+from fakeserver import FakeServerTestCase
+
+logins = { 1001 : "ken", 1002 : "bob" }
+
+
+class Friend(object):
+    def __init__(self):
+        self.pending_shares = {}
+
+
+class FriendHelper(object):
+    def update(self, friend):
+        pass
+
+
+class User(object):
+    '''
+    Current user whose only friend is 'ken'.
+    '''
+
+    def __init__(self):
+        self.friends = { "ken" : Friend() }
+        self.pending_friends = {}
+        self.friend_helper = FriendHelper()
+
+    def request_friend(self, login):
+        self.pending_friends[login] = Friend()
+        return self.pending_friends[login]
+
+
+class SetACLTestCase(FakeServerTestCase):
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.patched = ufo.user.user, ufo.acl.get_user_infos
+        ufo.user.user = User()
+        ufo.acl.get_user_infos = lambda login=None, uid=None: { 'login' : logins[uid] }
+        self.create_file("/file")
+
+        self.acls = []
+        self.fs.realfs.set_acl = lambda path, acl: self.acls.append(acl)
+
+    def tearDown(self):
+        ufo.user.user, ufo.acl.get_user_infos = self.patched
+        FakeServerTestCase.tearDown(self)
+
+    def setacl(self, *aces):
+        new_acl = ACL.from_mode(0640)
+        for ace in aces:
+            new_acl.append(ace)
+        self.fs.setxattr("/file", "system.posix_acl_access", new_acl.to_xattr(), db_only=False)
+        return self.fs["/file"]
+
+    def test_pending_share(self):
+        document = self.setacl(ACE(ACL_USER, ACL_READ | ACL_WRITE, 1001),
+                               ACE(ACL_USER, ACL_READ | ACL_EXECUTE, 1002))
+
+        self.assertEquals([ ace['qualifier'] for ace in document.acl ], [ 1001 ])
+        self.assertEquals(ufo.user.user.pending_friends["bob"].pending_shares,
+                          { document.id : "RX" })
+
+        # The mask no longer grants what only the pending share had
+        self.assertEquals([ ace._qualifier for ace in self.acls[0].get(ACL_USER) ], [ 1001 ])
+        self.assertEquals(self.acls[0].get(ACL_MASK)._perms, ACL_READ | ACL_WRITE)
+        self.assertEquals(document.mode & 0777, 0640)
+
+    def test_remove_share(self):
+        self.setacl(ACE(ACL_USER, ACL_READ, 1001))
+        document = self.setacl()
+        self.assertFalse(document.acl)
+        self.assertEquals(self.acls[1].get(ACL_USER), [])
+
+    def test_frozen_acl_cached(self):
+        document = self.fs["/file"]
+        frozen = document.frozen_acl
+        self.assertTrue(document.frozen_acl is frozen)
+
+        document.acl = [ { 'qualifier' : 1001, 'privileges' : [ "read" ] } ]
+        self.assertEquals([ ace._qualifier for ace in document.frozen_acl if ace.kind == ACL_USER ],
+                          [ 1001 ])
+
+        document.mode = 0100600
+        self.assertEquals(document.frozen_acl.mode, 0100600)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(SetACLTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import os
+import time
+import errno
+import unittest
+
+from fakeserver import FakeServerTestCase
+from ufo.database import BulkUpdateError
+
+
+class ListingCacheTestCase(FakeServerTestCase):
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.fs.mkdir("/src")
+        self.create_file("/src/a")
+
+    def test_readdirplus(self):
+        self.assertEquals([ name for name, stats in self.fs.readdirplus("/src") ], [ "a" ])
+        self.assertTrue(self.fs.listing_complete("/src"))
+
+        self.requests()
+        self.fs.stat("/src/a")
+        self.assertRaises(OSError, self.fs.stat, "/src/missing")
+        self.assertEquals(self.requests(), {})
+
+    def test_listing_expires_without_watcher(self):
+        fs = self.create_fs(negative_timeout=0.2)
+        try:
+            fs.readdirplus("/src")
+            self.assertTrue(fs.listing_complete("/src"))
+
+            # Created by another client
+            self.create_file("/src/b")
+            self.assertRaises(OSError, fs.stat, "/src/b")
+
+            time.sleep(0.3)
+            self.assertFalse(fs.listing_complete("/src"))
+            fs.stat("/src/b")
+
+        finally:
+            fs.close()
+
+    def test_listing_invalidated_by_changes(self):
+        fs = self.create_fs(watch_changes=True)
+        try:
+            fs.readdirplus("/src")
+            self.create_file("/src/b")
+
+            deadline = time.time() + 5
+            while fs.listing_complete("/src") and time.time() < deadline:
+                time.sleep(0.01)
+            fs.stat("/src/b")
+
+        finally:
+            fs.close()
+
+    def test_readdirplus_missing_directory(self):
+        self.assertEquals(self.fs.readdirplus("/target"), [])
+        self.assertFalse(self.fs.listing_complete("/target"))
+
+        self.fs.rename("/src", "/target")
+        self.assertEquals(self.fs.stat("/target/a").st_mode & 0644, 0644)
+
+    def test_rename_over_complete_listing(self):
+        self.fs._completeListings.cache("/target", True)
+        self.fs._completeListings.cache("/target/sub", True)
+
+        self.fs.rename("/src", "/target")
+        self.assertFalse(self.fs.listing_complete("/target/sub"))
+        self.fs.stat("/target/a")
+
+    def test_create_over_complete_listing(self):
+        self.fs._completeListings.cache("/new", True)
+        self.fs._completeListings.cache("/new/sub", True)
+
+        self.fs.mkdir("/new")
+        self.assertFalse(self.fs.listing_complete("/new/sub"))
+
+    def test_rmdir_known_empty(self):
+        fs = self.create_fs(watch_changes=True)
+        try:
+            fs.mkdir("/empty")
+            self.assertEquals(fs.readdirplus("/empty"), [])
+            self.assertTrue(fs.listing_complete("/empty"))
+
+            self.requests()
+            fs.rmdir("/empty")
+            self.assertFalse(self.requests().has_key("GET revs_by_dir_prefix"))
+            self.assertRaises(OSError, fs.stat, "/empty")
+
+        finally:
+            fs.close()
+
+    def test_rmdir_listing_not_followed(self):
+        self.fs.mkdir("/empty")
+        self.fs.readdirplus("/empty")
+
+        self.requests()
+        self.fs.rmdir("/empty")
+        self.assertTrue(self.requests().has_key("GET revs_by_dir_prefix"))
+
+    def test_rmtree_queries_subtree(self):
+        self.fs.readdirplus("/src")
+        self.requests()
+        self.fs.rmtree("/src")
+        self.assertTrue(self.requests().has_key("GET revs_by_dir_prefix"))
+        self.assertRaises(OSError, self.fs.stat, "/src/a")
+
+    def test_rmtree_partial_failure(self):
+        self.fs.readdirplus("/src")
+
+        def bulk_update(*args, **kwargs):
+            raise BulkUpdateError({ "doc" : "conflict" })
+        self.fs.doc_helper.bulk_update = bulk_update
+
+        self.assertRaises(BulkUpdateError, self.fs.rmtree, "/src")
+        self.assertFalse(self.fs.listing_complete("/src"))
+        self.assertEquals(self.fs._cachedMetaDatas.lookup("/src/a")[0], False)
+
+    def test_rename_partial_failure(self):
+        self.fs.mkdir("/src/sub")
+        self.fs.readdirplus("/src")
+        self.fs.readdirplus("/src/sub")
+
+        def bulk_update(*args, **kwargs):
+            raise BulkUpdateError({ "doc" : "conflict" })
+        self.fs.doc_helper.bulk_update = bulk_update
+
+        self.assertRaises(BulkUpdateError, self.fs.rename, "/src", "/dst")
+        self.assertFalse(self.fs.listing_complete("/src"))
+        self.assertFalse(self.fs.listing_complete("/src/sub"))
+        self.assertEquals(self.fs._cachedMetaDatas.lookup("/src")[0], False)
+        self.assertEquals(self.fs._cachedMetaDatas.lookup("/src/a")[0], False)
+
+    def test_rename_several_pages(self):
+        self.fs.page_size = 2
+        names = [ "f%d" % index for index in range(5) ]
+        for name in names:
+            self.create_file("/src/" + name)
+
+        self.requests()
+        self.fs.rename("/src", "/dst")
+        self.assertTrue(self.requests()["GET by_dir_prefix"] > 1)
+
+        self.assertEquals(sorted([ name for name, stats in self.fs.readdirplus("/dst") ]),
+                          [ "a" ] + names)
+        self.assertRaises(OSError, self.fs.stat, "/src")
+        for name in names:
+            self.fs.stat("/dst/" + name)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(ListingCacheTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
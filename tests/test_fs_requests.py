@@ -0,0 +1,124 @@
+import os
+import errno
+import unittest
+
+from fakeserver import FakeServerTestCase
+
+
+class GetManyTestCase(FakeServerTestCase):
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.fs.mkdir("/dir")
+        self.create_file("/dir/a")
+        self.create_file("/dir/b")
+        self.fs._cachedMetaDatas.clear()
+        self.fs._completeListings.clear()
+        self.requests()
+
+    def test_one_request(self):
+        found, missing = self.fs.get_many([ "/dir/a", "/dir/b/", "/dir/missing" ])
+        self.assertEquals(sorted(found.keys()), [ "/dir/a", "/dir/b" ])
+        self.assertEquals(found["/dir/a"].filename, "a")
+        self.assertEquals(missing, [ "/dir/missing" ])
+        self.assertEquals(self.requests(), { "POST by_path" : 1 })
+
+        # Found and missing paths are both cached
+        found, missing = self.fs.get_many([ "/dir/a", "/dir/missing" ])
+        self.assertEquals(found.keys(), [ "/dir/a" ])
+        self.assertEquals(missing, [ "/dir/missing" ])
+        self.fs.stat("/dir/b")
+        self.assertEquals(self.requests(), {})
+
+    def test_complete_listing(self):
+        self.fs.readdirplus("/dir")
+        self.requests()
+
+        found, missing = self.fs.get_many([ "/dir/a", "/dir/other", "/" ])
+        self.assertEquals(sorted(found.keys()), [ "/", "/dir/a" ])
+        self.assertEquals(missing, [ "/dir/other" ])
+        self.assertEquals(self.requests(), {})
+
+    def test_no_paths(self):
+        self.assertEquals(self.fs.get_many([]), ({}, []))
+        self.assertEquals(self.requests(), {})
+
+class CompactViewsTestCase(FakeServerTestCase):
+    fs_options = { 'compact_views' : True }
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.fs.mkdir("/dir")
+        self.create_file("/dir/a", "data")
+        self.fs._cachedMetaDatas.clear()
+        self.fs._completeListings.clear()
+
+    def test_rows_without_documents(self):
+        rows = list(self.fs.doc_helper.database.view("syncdocument_compact/by_path", key="/dir/a"))
+        self.assertEquals([ row.value for row in rows ], [ None ])
+
+    def test_lookups(self):
+        self.assertEquals(self.fs.stat("/dir/a").st_size, 4)
+        self.assertRaises(OSError, self.fs.stat, "/dir/missing")
+
+        self.fs._cachedMetaDatas.clear()
+        found, missing = self.fs.get_many([ "/dir/a", "/dir/missing" ])
+        self.assertEquals(found["/dir/a"].filename, "a")
+        self.assertEquals(missing, [ "/dir/missing" ])
+
+        self.assertEquals([ name for name, stats in self.fs.readdirplus("/dir") ], [ "a" ])
+
+    def test_subtree(self):
+        self.fs.rename("/dir", "/moved")
+        self.assertEquals(self.fs.stat("/moved/a").st_size, 4)
+
+        self.fs.rmtree("/moved")
+        self.assertRaises(OSError, self.fs.stat, "/moved/a")
+        self.assertEquals(list(self.fs.doc_helper.by_dir_prefix(key="/moved")), [])
+
+class UsageTestCase(FakeServerTestCase):
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.fs.mkdir("/dir")
+        self.fs.mkdir("/dir/sub")
+        self.create_file("/dir/a", "12345")
+        self.create_file("/dir/sub/b", "123")
+        self.create_file("/c", "1")
+
+    def test_usage(self):
+        self.assertEquals(self.fs.usage("/dir"),
+                          { 'bytes' : 8, 'files' : 2, 'directories' : 1 })
+        self.assertEquals(self.fs.du("/dir/sub/"), 3)
+        self.assertEquals(self.fs.df(),
+                          { 'bytes' : 9, 'files' : 3, 'directories' : 2 })
+
+    def test_one_reduced_request(self):
+        self.fs.stat("/dir")
+        self.requests()
+        self.fs.du("/dir")
+        self.assertEquals(self.requests(), { "GET usage_by_dir" : 1 })
+
+    def test_updates(self):
+        self.fs.unlink("/dir/a")
+        self.assertEquals(self.fs.du("/dir"), 3)
+
+        self.fs.rename("/dir/sub", "/sub")
+        self.assertEquals(self.fs.usage("/dir"),
+                          { 'bytes' : 0, 'files' : 0, 'directories' : 0 })
+        self.assertEquals(self.fs.du("/sub"), 3)
+
+    def test_empty_and_missing(self):
+        self.fs.mkdir("/empty")
+        self.assertEquals(self.fs.du("/empty"), 0)
+
+        try:
+            self.fs.du("/missing")
+            self.fail()
+        except OSError, e:
+            self.assertEquals(e.errno, errno.ENOENT)
+
+suite = unittest.TestSuite([ unittest.TestLoader().loadTestsFromTestCase(GetManyTestCase),
+                             unittest.TestLoader().loadTestsFromTestCase(CompactViewsTestCase),
+                             unittest.TestLoader().loadTestsFromTestCase(UsageTestCase) ])
+
+if __name__ == '__main__':
+    unittest.main()
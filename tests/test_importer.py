@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+
+from fakeserver import FakeServerTestCase
+from ufo.importer import Importer
+
+
+class ImporterTestCase(FakeServerTestCase):
+    paths = [ "/caf\xc3\xa9", "/caf\xc3\xa9/a", "/caf\xc3\xa9/b", "/z\xc3\xa9bre" ]
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        os.mkdir(os.path.join(self.root, "caf\xc3\xa9"))
+        for path in self.paths[1:]:
+            open(self.root + path, "w").close()
+
+        self.checkpoint = tempfile.mktemp()
+
+    def tearDown(self):
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        FakeServerTestCase.tearDown(self)
+
+    def test_import(self):
+        stats = Importer(self.fs, processes=0).run()
+        self.assertEquals(stats['imported'], 4)
+        for path in self.paths:
+            self.assertTrue(self.fs.exists(path))
+
+        stats = Importer(self.fs, processes=0).run()
+        self.assertEquals(stats['skipped'], 4)
+
+    def test_invalid_names(self):
+        open(self.root + "/caf\xe9", "w").close()
+        os.mkdir(self.root + "/d\xe9j\xe0")
+        open(self.root + "/d\xe9j\xe0/file", "w").close()
+
+        stats = Importer(self.fs, processes=0).run()
+        self.assertEquals(stats['failed'], 3)
+        self.assertEquals(stats['imported'], 4)
+        self.assertTrue(self.fs.exists("/z\xc3\xa9bre"))
+
+    def test_pool(self):
+        open(self.root + "/caf\xc3\xa9/a", "w").write("Some text\n")
+
+        stats = Importer(self.fs, processes=2).run()
+        self.assertEquals(stats['imported'], 4)
+        self.assertEquals(self.fs["/caf\xc3\xa9/a"].type, "text/plain")
+        self.assertEquals(self.fs["/caf\xc3\xa9"].type, "application/x-directory")
+
+    def test_save_checkpoint(self):
+        checkpoints = []
+        def progress(stats):
+            checkpoints.append(open(self.checkpoint, "rb").read())
+
+        importer = Importer(self.fs, processes=0, checkpoint=self.checkpoint)
+        importer.batch_size = 2
+        importer.run(progress=progress)
+
+        self.assertEquals(checkpoints, [ "/caf\xc3\xa9/a", "/z\xc3\xa9bre" ])
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_resume_checkpoint(self):
+        open(self.checkpoint, "wb").write("/caf\xc3\xa9/a")
+
+        stats = Importer(self.fs, processes=0, checkpoint=self.checkpoint).run()
+        self.assertEquals(stats['imported'], 2)
+        self.assertFalse(self.fs.exists("/caf\xc3\xa9/a"))
+        self.assertTrue(self.fs.exists("/caf\xc3\xa9/b"))
+        self.assertTrue(self.fs.exists("/z\xc3\xa9bre"))
+
+suite = unittest.TestLoader().loadTestsFromTestCase(ImporterTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
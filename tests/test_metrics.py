@@ -0,0 +1,171 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+
+from ufo import config
+from ufo.metrics import Histogram, metrics, operation, TimedObject
+from fakeserver import FakeServerTestCase
+
+
+class Backend(object):
+    def slow(self):
+        time.sleep(0.01)
+        return "done"
+
+
+class FileSystem(object):
+    def __init__(self):
+        self.realfs = TimedObject(Backend())
+
+    @operation("read")
+    def read(self):
+        metrics.cached(True)
+        metrics.cached(False)
+        return self.realfs.slow()
+
+    @operation("update")
+    def update(self):
+        started = time.time()
+        time.sleep(0.01)
+        metrics.timed('db', 'by_path.GET', started)
+        return self.read()
+
+    @operation("listdir")
+    def listdir(self):
+        for i in range(3):
+            yield self.realfs.slow()
+
+    @operation("opendir")
+    def opendir(self):
+        self.entries = self.listdir()
+
+    @operation("readdir")
+    def readdir(self):
+        return list(self.entries)
+
+    @operation("rmtree")
+    def rmtree(self):
+        def worker(frame):
+            started = time.time()
+            time.sleep(0.01)
+            metrics.timed('db', '_bulk_docs.POST', started, frame)
+
+        thread = threading.Thread(target=worker, args=(metrics.frame(),))
+        thread.start()
+        thread.join()
+
+    def mkdir(self):
+        pass
+    mkdir.op = 'create'
+    mkdir = operation("mkdir")(mkdir)
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        metrics.enabled = True
+        metrics.reset()
+        self.fs = FileSystem()
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for seconds in (0.001, 0.001, 0.002, 0.1):
+            histogram.record(seconds)
+
+        snapshot = histogram.snapshot()
+        self.assertEquals(snapshot['count'], 4)
+        self.assertEquals(snapshot['max'], 0.1)
+        self.assertEquals(snapshot['min'], 0.001)
+        self.assertTrue(0.001 <= snapshot['p50'] <= 0.002)
+        self.assertEquals(snapshot['p99'], 0.1)
+
+    def test_operation(self):
+        self.assertEquals(self.fs.read(), "done")
+
+        snapshot = metrics.snapshot()
+        histograms = snapshot['histograms']
+        self.assertEquals(histograms['op.read']['count'], 1)
+        self.assertEquals(histograms['fs.slow']['count'], 1)
+        self.assertTrue(histograms['op.read.fs']['total'] >= 0.01)
+        self.assertEquals(histograms['op.read.db']['total'], 0)
+        self.assertEquals(snapshot['counters']['op.read.cache_hits'], 1)
+        self.assertEquals(snapshot['counters']['op.read.cache_misses'], 1)
+
+    def test_nested_operation(self):
+        self.fs.update()
+
+        histograms = metrics.snapshot()['histograms']
+        self.assertEquals(histograms['op.read']['count'], 1)
+        self.assertEquals(histograms['db.by_path.GET']['count'], 1)
+        self.assertTrue(histograms['op.update.fs']['total'] >= 0.01)
+        self.assertTrue(histograms['op.update.db']['total'] >= 0.01)
+        self.assertTrue(histograms['op.update']['total'] >= 0.02)
+
+    def test_generator_operation(self):
+        self.assertEquals(len(list(self.fs.listdir())), 3)
+
+        histograms = metrics.snapshot()['histograms']
+        self.assertEquals(histograms['op.listdir']['count'], 1)
+        self.assertTrue(histograms['op.listdir']['total'] >= 0.03)
+
+    def test_generator_exhausted_later(self):
+        self.fs.opendir()
+        self.assertEquals(len(self.fs.readdir()), 3)
+
+        histograms = metrics.snapshot()['histograms']
+        self.assertEquals(histograms['op.listdir']['count'], 1)
+        self.assertEquals(histograms['op.readdir.fs']['total'], 0.0)
+
+    def test_worker_threads(self):
+        self.fs.rmtree()
+
+        histograms = metrics.snapshot()['histograms']
+        self.assertEquals(histograms['db._bulk_docs.POST']['count'], 1)
+        self.assertTrue(histograms['op.rmtree.db']['total'] >= 0.01)
+
+    def test_attributes(self):
+        self.assertEquals(self.fs.mkdir.op, 'create')
+        self.assertEquals(self.fs.mkdir.__name__, 'mkdir')
+
+    def test_disabled(self):
+        metrics.enabled = False
+        self.fs.update()
+        self.assertEquals(metrics.snapshot()['histograms'], {})
+
+    def test_dump(self):
+        self.fs.read()
+        path = tempfile.mktemp()
+        metrics.dump(path, reset=True)
+        try:
+            self.assertTrue('op.read' in open(path).read())
+            self.assertEquals(metrics.snapshot()['histograms'], {})
+        finally:
+            os.remove(path)
+
+
+
+class MetricsDumpTestCase(FakeServerTestCase):
+    def setUp(self):
+        self.path = tempfile.mktemp()
+        config.metrics_dump = self.path
+        FakeServerTestCase.setUp(self)
+
+    def tearDown(self):
+        FakeServerTestCase.tearDown(self)
+        config.metrics_dump = None
+        metrics.stop_dump()
+
+    def test_started_once(self):
+        dumper = metrics._dumper
+        self.assertTrue(dumper is not None)
+
+        self.create_fs().close()
+        self.assertTrue(metrics._dumper is dumper)
+        self.assertTrue(dumper.isAlive())
+
+suite = unittest.TestSuite([ unittest.TestLoader().loadTestsFromTestCase(MetricsTestCase),
+                             unittest.TestLoader().loadTestsFromTestCase(MetricsDumpTestCase) ])
+
+if __name__ == '__main__':
+    unittest.main()
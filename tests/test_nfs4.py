@@ -0,0 +1,104 @@
+import sys
+import types
+import unittest
+
+import ufo.user
+import ufo.fsbackend.nfs4 as nfs4
+from ufo.acl import ACL, NFS4_ACL_XATTR
+
+
+class Process(object):
+    calls = []
+
+    def __init__(self, args, stdin=None, stderr=None):
+        self.args = args
+        self.returncode = 0
+
+    def communicate(self, input):
+        Process.calls.append((self.args, input))
+        return "", ""
+
+
+class CountingACL(ACL):
+    '''
+    ACL counting how many times it is encoded.
+    '''
+
+    def __init__(self, *args):
+        ACL.__init__(self, *args)
+        self.encodings = 0
+
+    def to_nfs4(self):
+        self.encodings += 1
+        return "A::OWNER@:rwax\n"
+
+    def to_nfs4_xattr(self):
+        self.encodings += 1
+        return "xdr"
+
+    def __repr__(self):
+        self.encodings += 1
+        return "user::rw-"
+
+
+class Login(object):
+    login = "sam"
+
+
+class NFS4ACLTestCase(unittest.TestCase):
+    def setUp(self):
+        self.xattr = types.ModuleType("xattr")
+        self.xattr.calls = []
+        self.xattr.setxattr = lambda path, key, value: self.xattr.calls.append((path, key, value))
+
+        self.patched = (nfs4.subprocess.Popen, nfs4.patched_acl, ufo.user.user,
+                        sys.modules.get("xattr"))
+        nfs4.subprocess.Popen = Process
+        ufo.user.user = Login()
+        sys.modules["xattr"] = self.xattr
+        Process.calls = []
+
+        self.fs = nfs4.NFS4FileSystem("/mnt")
+        self.acl = CountingACL()
+
+    def tearDown(self):
+        nfs4.subprocess.Popen, nfs4.patched_acl, ufo.user.user, xattr = self.patched
+        if xattr is None:
+            del sys.modules["xattr"]
+        else:
+            sys.modules["xattr"] = xattr
+
+    def test_native(self):
+        self.fs.native_acl = True
+        self.fs.set_acl_many([ "/a", "/b" ], self.acl)
+        self.assertEquals(self.xattr.calls, [ ("/mnt/a", NFS4_ACL_XATTR, "xdr"),
+                                              ("/mnt/b", NFS4_ACL_XATTR, "xdr") ])
+        self.assertEquals(self.acl.encodings, 1)
+        self.assertEquals(Process.calls, [])
+
+    def test_subprocess(self):
+        self.fs.native_acl = False
+        self.fs.set_acl_many([ "/a", "/b" ], self.acl)
+        self.assertEquals(Process.calls,
+                          [ ([ "nfs4_setfacl", "-S", "-", "/mnt/a" ], "A::OWNER@:rwax\n"),
+                            ([ "nfs4_setfacl", "-S", "-", "/mnt/b" ], "A::OWNER@:rwax\n") ])
+        self.assertEquals(self.acl.encodings, 1)
+
+    def test_patched_acl(self):
+        nfs4.patched_acl = True
+        for native_acl in (True, False):
+            Process.calls = []
+            self.fs.native_acl = native_acl
+            self.fs.set_acl_many([ "/a", "/b" ], self.acl)
+            self.assertEquals([ args for args, input in Process.calls ],
+                              [ [ "setfacl", "--restore=-" ] ] * 2)
+            self.assertEquals(Process.calls[1][1],
+                              "# file: /b\n# owner: sam\n# group: sam\nuser::rw-\n")
+
+        self.assertEquals(self.xattr.calls, [])
+        self.assertEquals(self.acl.encodings, 2)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(NFS4ACLTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+from fakeserver import FakeServerTestCase
+
+
+class SearchTestCase(FakeServerTestCase):
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.fs.mkdir("/docs")
+        for name in ("Hello.txt", "yellow.png", "abaxbab", "photo3", "Photo1", "photo2", "photo4"):
+            self.create_file("/docs/" + name)
+
+    def search(self, query, **kw):
+        return sorted([ doc.filename for doc in self.fs.search(query, **kw) ])
+
+    def test_sync(self):
+        self.fs.search("hello")
+        self.assertTrue(self.server.databases[self.db_name].docs.has_key("_design/search"))
+
+    def test_same_server(self):
+        self.fs.search("hello")
+        self.assertTrue(self.fs._filename_index.helper.server is self.fs.doc_helper.server)
+
+    def test_substring(self):
+        self.assertEquals(self.search("ELL"), [ "Hello.txt", "yellow.png" ])
+        self.assertEquals(self.search("llo.t"), [ "Hello.txt" ])
+        self.assertEquals(self.search("missing"), [])
+
+    def test_short_query(self):
+        self.assertEquals(self.search("he"), [ "Hello.txt" ])
+        self.assertEquals(self.search("g"), [ "yellow.png" ])
+
+    def test_short_query_bounded(self):
+        for index in range(10):
+            self.create_file("/docs/o%d" % index)
+
+        self.assertEquals(len(self.fs.search("o", limit=3, skip=2)), 3)
+        self.assertEquals(len(self.fs.search("o")), 17)
+
+        index = self.fs._filename_index
+        index.fetch_size = 2
+
+        rows = []
+        view = index.helper.database.view
+        def counting_view(name, *args, **kwargs):
+            result = list(view(name, *args, **kwargs))
+            if name == 'search/by_trigram':
+                rows.extend(result)
+            return result
+        index.helper.database.view = counting_view
+
+        self.assertEquals(len(self.fs.search("o", limit=1)), 1)
+        self.assertTrue(len(rows) <= index.fetch_size + 1)
+
+    def test_trigrams_out_of_order(self):
+        self.assertEquals(self.search("abab"), [])
+        self.assertEquals(self.search("xbab"), [ "abaxbab" ])
+
+    def test_limit_and_skip(self):
+        results = [ doc.filename for doc in self.fs.search("hoto", limit=2, skip=1) ]
+        self.assertEquals(len(results), 2)
+        self.assertEquals(len(self.fs.search("hoto", limit=10, skip=3)), 1)
+
+    def test_prefix(self):
+        results = self.fs.search("PHOTO", prefix=True, limit=2, skip=1)
+        self.assertEquals([ doc.filename for doc in results ], [ "photo2", "photo3" ])
+        self.assertEquals(len(self.fs.search("photo", prefix=True)), 4)
+        self.assertEquals(self.fs.search("hoto", prefix=True), [])
+
+suite = unittest.TestLoader().loadTestsFromTestCase(SearchTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
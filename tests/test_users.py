@@ -0,0 +1,80 @@
+import unittest
+
+import ufo.user
+from ufo.user import LazyUser
+
+
+class Store(object):
+    def __init__(self):
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+class User(object):
+    '''
+    Stand-in of ufo.user.User registering a contact store per login.
+    '''
+
+    _user_cache = {}
+    _contact_stores = {}
+
+    def __init__(self, db, login, reuse_cache=False):
+        self.login = login
+        User._user_cache[login] = db
+        User._contact_stores[login] = Store()
+
+
+class DocumentHelper(object):
+    def __init__(self, doc_class, name):
+        self.database = name
+
+
+class LazyUserTestCase(unittest.TestCase):
+    def setUp(self):
+        self.patched = ufo.user.User, ufo.user.DocumentHelper
+        ufo.user.User, ufo.user.DocumentHelper = User, DocumentHelper
+        User._user_cache.clear()
+        User._contact_stores.clear()
+
+        self.users = LazyUser()
+        self.users.__dict__['max_users'] = 2
+
+    def tearDown(self):
+        ufo.user.User, ufo.user.DocumentHelper = self.patched
+
+    def test_shared(self):
+        user = self.users.get_user("sam")
+        self.assertTrue(self.users.get_user("sam") is user)
+
+    def test_eviction(self):
+        self.users.get_user("sam")
+        store = User._contact_stores["sam"]
+        self.users.get_user("ken")
+        self.users.get_user("bob")
+
+        self.assertEquals(len(self.users._users), 2)
+        self.assertTrue(store.stopped)
+        self.assertEquals(sorted(User._contact_stores.keys()), [ "bob", "ken" ])
+        self.assertFalse(User._user_cache.has_key("sam"))
+
+    def test_invalidate(self):
+        self.users.get_user("sam")
+        stores = [ User._contact_stores["sam"] ]
+        self.users.get_user("ken")
+        stores.append(User._contact_stores["ken"])
+
+        self.users.invalidate("sam")
+        self.assertTrue(stores[0].stopped)
+        self.assertFalse(stores[1].stopped)
+
+        self.users.invalidate()
+        self.assertTrue(stores[1].stopped)
+        self.assertEquals(len(self.users._users), 0)
+        self.assertEquals(User._contact_stores, {})
+
+suite = unittest.TestLoader().loadTestsFromTestCase(LazyUserTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,7 +6,7 @@ from ufo.acl import *
 JOHN_ID = 123456
 
 def setup_db():
-    fs = CouchedFileSystem("/tmp", "test_views")
+    fs = CouchedFileSystem("/tmp", "test_views", watch_changes=False)
     fs.doc_helper.sync()
 
     f = fs.open("/image.png", os.O_CREAT | os.O_WRONLY)
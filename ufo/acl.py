@@ -43,6 +43,21 @@ json_perms = ( ( ACL_READ, "read" ),
                ( ACL_WRITE, "write" ),
                ( ACL_EXECUTE, "execute" ) )
 
+NFS4_ACL_XATTR = "system.nfs4_acl"
+
+NFS4_ACE_ACCESS_ALLOWED_ACE_TYPE = 0x0
+NFS4_ACE_IDENTIFIER_GROUP = 0x40
+
+NFS4_ACE_READ_DATA = 0x01
+NFS4_ACE_WRITE_DATA = 0x02
+NFS4_ACE_APPEND_DATA = 0x04
+NFS4_ACE_EXECUTE = 0x20
+
+# Same permissions as the 'r', 'wa' and 'x' of the NFSv4 text form
+nfs4_perms = ( ( ACL_READ, NFS4_ACE_READ_DATA ),
+               ( ACL_WRITE, NFS4_ACE_WRITE_DATA | NFS4_ACE_APPEND_DATA ),
+               ( ACL_EXECUTE, NFS4_ACE_EXECUTE ) )
+
 class ACL(list):
     default_domain = "agorabox.org"
 
@@ -69,6 +84,10 @@ class ACL(list):
                 s += ace.to_nfs4() + "\n"
         return s
 
+    def to_nfs4_xattr(self):
+        return FrozenACL([ (ace.kind, ace._perms, ace._qualifier) for ace in self ],
+                         self.mode).to_nfs4_xattr()
+
     @staticmethod
     def from_xattr(data):
         index = 4
@@ -134,10 +153,9 @@ class ACL(list):
         self.check()
         if len(self) == 0:
             return None
-        s = struct.pack("I", ACL_EA_VERSION)
-        for ace in self:
-            s += struct.pack("HHI", ace.kind, ace._perms, ace._qualifier)
-        return s
+        return struct.pack("I", ACL_EA_VERSION) + \
+               "".join([ struct.pack("HHI", ace.kind, ace._perms, ace._qualifier)
+                         for ace in self ])
 
     def to_json(self):
         self.sort()
@@ -181,7 +199,117 @@ class ACL(list):
     def __eq__(self, acl):
         return repr(self) == repr(acl)
 
-class ACE:
+    def freeze(self):
+        '''
+        Return an immutable copy of the ACL, completed and sorted.
+        '''
+
+        self.sort()
+        self.check()
+        return FrozenACL([ (ace.kind, ace._perms, ace._qualifier) for ace in self ],
+                         self.mode)
+
+class FrozenACL(object):
+    '''
+    Immutable ACL, stored as a tuple of (kind, perms, qualifier) triples,
+    whose encodings are computed once. It has the read only interface of
+    ACL, 'thaw' returns a mutable copy.
+    '''
+
+    __slots__ = ( 'entries', 'mode', '_xattr', '_nfs4', '_nfs4_xattr', '_json', '_repr' )
+
+    def __init__(self, entries, mode=None):
+        self.entries = tuple(entries)
+        self.mode = mode
+        self._xattr = self._nfs4 = self._nfs4_xattr = self._json = self._repr = None
+
+    def __iter__(self):
+        for entry in self.entries:
+            yield ACE(*entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __nonzero__(self):
+        return len(self.entries) != 0
+
+    def __repr__(self):
+        if self._repr is None:
+            self._repr = "\n".join(map(repr, self))
+        return self._repr
+
+    def __contains__(self, ace):
+        if isinstance(ace, ACE):
+            return (ace.kind, ace._perms, ace._qualifier) in self.entries
+        else:
+            for _ace in self:
+                if _ace.kind & ACL_USER and _ace.qualifier == ace:
+                    return True
+            return False
+
+    def __eq__(self, acl):
+        if isinstance(acl, FrozenACL):
+            return self.entries == acl.entries
+        return repr(self) == repr(acl)
+
+    def __ne__(self, acl):
+        return not self == acl
+
+    def get(self, kind):
+        aces = filter(lambda ace: ace.kind == kind, self)
+        if kind not in (ACL_USER, ACL_GROUP):
+            return aces[0]
+        return aces
+
+    def is_extended(self):
+        for kind, perms, qualifier in self.entries:
+            if kind in [ ACL_MASK, ACL_USER, ACL_GROUP ]:
+                return True
+        return False
+
+    def to_xattr(self):
+        if not self.entries:
+            return None
+        if self._xattr is None:
+            self._xattr = struct.pack("I", ACL_EA_VERSION) + \
+                          "".join([ struct.pack("HHI", *entry) for entry in self.entries ])
+        return self._xattr
+
+    def to_nfs4(self):
+        if self._nfs4 is None:
+            self._nfs4 = "".join([ ace.to_nfs4() + "\n" for ace in self
+                                   if ace.kind != ACL_MASK ])
+        return self._nfs4
+
+    def to_nfs4_xattr(self):
+        '''
+        Return the XDR encoded value of the NFSv4 ACL extended attribute,
+        the binary form of what 'to_nfs4' returns.
+        '''
+
+        if self._nfs4_xattr is None:
+            aces = [ ace for ace in self if ace.kind != ACL_MASK ]
+            self._nfs4_xattr = struct.pack(">I", len(aces)) + \
+                               "".join(map(ACE.to_nfs4_xdr, aces))
+        return self._nfs4_xattr
+
+    def to_json(self):
+        if not self.entries:
+            return None
+        if self._json is None:
+            self._json = map(ACE.to_json, [ ace for ace in self if ace.kind == ACL_USER ])
+        # The caller may store it into a document and modify it
+        return [ dict(ace, privileges=list(ace['privileges'])) for ace in self._json ]
+
+    def thaw(self):
+        acl = ACL(mode=self.mode)
+        for entry in self.entries:
+            acl.append(ACE(*entry), False)
+        return acl
+
+class ACE(object):
+    __slots__ = ( 'kind', '_perms', '_qualifier' )
+
     def __init__(self, kind, perms=0, qualifier=ACL_UNQUALIFIED):
         self.kind = kind
         self._perms = perms
@@ -195,11 +323,25 @@ class ACE:
         return "%s:%s:%s" % (acl_types[self.kind], qualifier, self.perms)
 
     def to_nfs4(self):
-        if self._qualifier != (1 << 32) - 1:
-            qualifier = get_user_infos(uid=self._qualifier)['login'] + '@' + ACL.default_domain
-        else:
-            qualifier = nfs4_acl_types[self.kind]
-        return "A::%s:%s" % (qualifier, self.nfs4_perms)
+        return "A::%s:%s" % (self.nfs4_who, self.nfs4_perms)
+
+    def to_nfs4_xdr(self):
+        who = self.nfs4_who
+        if isinstance(who, unicode):
+            who = who.encode('utf-8')
+
+        flags = 0
+        if self.kind in (ACL_GROUP_OBJ, ACL_GROUP):
+            flags = NFS4_ACE_IDENTIFIER_GROUP
+
+        mask = 0
+        for perm, bits in nfs4_perms:
+            if self._perms & perm:
+                mask |= bits
+
+        # Strings are padded to a multiple of 4 bytes
+        return struct.pack(">IIII", NFS4_ACE_ACCESS_ALLOWED_ACE_TYPE, flags, mask, len(who)) + \
+               who + "\0" * (-len(who) % 4)
 
     def to_json(self):
         return dict(qualifier=self._qualifier,
@@ -208,6 +350,9 @@ class ACE:
     def __eq__(self, ace):
         return self.kind == ace.kind and self._perms == ace._perms and self._qualifier == ace._qualifier
 
+    def __ne__(self, ace):
+        return not self == ace
+
     @staticmethod
     def from_string(s):
         kind, qualifier, perms = s.split(':')
@@ -270,6 +415,12 @@ class ACE:
                perms += "-"
         return perms
 
+    @property
+    def nfs4_who(self):
+        if self._qualifier != (1 << 32) - 1:
+            return get_user_infos(uid=self._qualifier)['login'] + '@' + ACL.default_domain
+        return nfs4_acl_types[self.kind]
+
     @property
     def nfs4_perms(self):
         perms = ""
@@ -286,3 +437,70 @@ class ACE:
                perms.append(s)
         return perms
 
+class ACLDiff(object):
+    '''
+    Differences between two ACLs. The entries are matched by kind and
+    qualifier, so no user or group name is ever resolved.
+
+    'added' and 'removed' are lists of ACEs, 'changed' is a list of
+    (old ACE, new ACE) tuples whose permissions differ.
+    '''
+
+    def __init__(self, added, removed, changed):
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def __nonzero__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __repr__(self):
+        return "\n".join([ "+%r" % (ace,) for ace in self.added ] +
+                         [ "-%r" % (ace,) for ace in self.removed ] +
+                         [ "!%r" % (new,) for old, new in self.changed ])
+
+    def apply(self, acl, mode=None):
+        '''
+        Return a new ACL made of 'acl' with the differences applied.
+        '''
+
+        removed = set([ (ace.kind, ace._qualifier) for ace in self.removed ])
+        changed = dict([ ((new.kind, new._qualifier), new) for old, new in self.changed ])
+
+        if mode is None:
+            mode = acl.mode
+
+        result = ACL(mode=mode)
+        for ace in acl:
+            key = (ace.kind, ace._qualifier)
+            if key in removed or ace.kind == ACL_MASK:
+                continue
+            ace = changed.get(key, ace)
+            result.append(ACE(ace.kind, ace._perms, ace._qualifier), False)
+
+        for ace in self.added:
+            if ace.kind != ACL_MASK:
+                result.append(ACE(ace.kind, ace._perms, ace._qualifier), False)
+
+        # The mask depends on the entries
+        if result.is_extended():
+            result.calc_mask()
+        result.sort()
+        return result
+
+def diff(old, new):
+    '''
+    Return the ACLDiff turning the ACL 'old' into 'new'.
+    '''
+
+    old_aces = dict([ ((ace.kind, ace._qualifier), ace) for ace in old ])
+    new_aces = dict([ ((ace.kind, ace._qualifier), ace) for ace in new ])
+
+    added = [ ace for key, ace in new_aces.items() if key not in old_aces ]
+    removed = [ ace for key, ace in old_aces.items() if key not in new_aces ]
+    changed = [ (old_aces[key], ace) for key, ace in new_aces.items()
+                if key in old_aces and old_aces[key]._perms != ace._perms ]
+
+    return ACLDiff(sorted(added, key=lambda ace: (ace.kind, ace._qualifier)),
+                   sorted(removed, key=lambda ace: (ace.kind, ace._qualifier)),
+                   changed)
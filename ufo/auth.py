@@ -1,4 +1,8 @@
 import new
+import time
+import email.utils
+import calendar
+import threading
 import urlparse
 import urllib
 import Cookie
@@ -36,22 +40,248 @@ class NullAuthenticator(Debugger):
             except TypeError:
                 return _self.__class__.endheaders(_self)
 
+        def getresponse(_self, *args, **kw):
+            response = _self.__class__.getresponse(_self, *args, **kw)
+            self.response_received(service, host, response)
+            return response
+
         conn._service = service
         conn._host = host
         conn.endheaders = new.instancemethod(endheaders, conn)
+        conn.getresponse = new.instancemethod(getresponse, conn)
+
+    def response_received(self, service, host, response):
+        pass
+
+    def session_rejected(self):
+        '''
+        Tell if the last response received by the current thread rejected
+        a session that could not be replayed.
+        '''
+
+        return False
 
 
 class SPNEGOAuthenticator(NullAuthenticator):
+    '''
+    Kerberos authentication through the Negotiate HTTP scheme.
+
+    Negotiating a security context is much more expensive than a request,
+    so the session cookies issued by the servers after a successful
+    negotiation (the CouchDB AuthSession, the WebDAV session) are cached
+    per (service, host) and sent instead. A context is negotiated again
+    only when there is no valid cookie, when the cookie is about to expire,
+    or after the server rejected it with a 401. A request whose cookie is
+    rejected is sent again once with a new negotiation, if its body was
+    handed to the connection; otherwise 'session_rejected' tells the
+    caller to send it again.
+    '''
+
+    # Lifetime of the cookies that do not tell when they expire,
+    # CouchDB sessions last 10 minutes by default
+    session_timeout = 600
+
+    # Renegotiate a bit before the expiration of a cookie
+    refresh_margin = 60
+
+    # Name of the session cookie of a service, the other cookies set by
+    # its responses are ignored. Any cookie is a session for the other
+    # services.
+    session_cookies = { "couchdb" : "AuthSession" }
+
     def __init__(self):
         NullAuthenticator.__init__(self)
+        self.sessions = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
 
     def login(self):
         # TODO: get TGT ticket from credentials
         return NullAuthenticator.login(self)
 
+    def logout(self):
+        self.lock.acquire()
+        try:
+            self.sessions.clear()
+        finally:
+            self.lock.release()
+
+        NullAuthenticator.logout(self)
+
     def get_headers(self, service, host):
         self.ensure_login()
 
+        self.lock.acquire()
+        try:
+            counters = self.counters.setdefault(host, { 'negotiations' : 0,
+                                                        'reuses'       : 0 })
+            session = self.sessions.get((service, host))
+            if session and session[1] - self.refresh_margin > time.time():
+                counters['reuses'] += 1
+                return { "Cookie" : session[0] }
+
+            counters['negotiations'] += 1
+
+        finally:
+            self.lock.release()
+
+        return self.negotiate(service, host)
+
+    def bind(self, conn, service="HTTP", host=""):
+        '''
+        Add the session cookie or the negotiation token to the requests
+        of a connection, and send again the requests whose cookie is
+        rejected. The request line, headers and body are recorded for
+        that, the bodies written to the socket directly are not.
+        '''
+
+        if not host:
+            host = conn.host
+
+        def putrequest(_self, *args, **kw):
+            _self._request = (args, kw, [], None)
+            _self._session_sent = False
+            self.local.rejected = False
+            _self.__class__.putrequest(_self, *args, **kw)
+
+            # The headers put by putrequest itself are put again by it
+            del _self._request[2][:]
+
+        def putheader(_self, header, *values):
+            _self._request[2].append((header,) + values)
+            return _self.__class__.putheader(_self, header, *values)
+
+        def endheaders(_self, body=None):
+            self.ensure_login()
+
+            headers = self.get_headers(service, host)
+            _self._session_sent = headers.has_key("Cookie")
+            _self._request = _self._request[:3] + (body,)
+            for header, value in headers.items():
+                _self.__class__.putheader(_self, header, value)
+
+            try:
+                return _self.__class__.endheaders(_self, body)
+            except TypeError:
+                return _self.__class__.endheaders(_self)
+
+        def getresponse(_self, *args, **kw):
+            response = _self.__class__.getresponse(_self, *args, **kw)
+            self.response_received(service, host, response)
+
+            if response.status != 401 or not _self._session_sent:
+                return response
+
+            request, options, headers, body = _self._request
+            if not self._replayable(headers, body):
+                self.local.rejected = True
+                return response
+
+            # The session was invalidated, the request is sent again
+            # with a negotiation, once
+            self.debug("Sending %s %s to %s@%s again", request[0], request[1], service, host)
+            response.read()
+            _self.putrequest(*request, **options)
+            for header in headers:
+                _self.putheader(*header)
+            _self.endheaders(body)
+            return _self.getresponse(*args, **kw)
+
+        conn._service = service
+        conn._host = host
+        conn.putrequest = new.instancemethod(putrequest, conn)
+        conn.putheader = new.instancemethod(putheader, conn)
+        conn.endheaders = new.instancemethod(endheaders, conn)
+        conn.getresponse = new.instancemethod(getresponse, conn)
+
+    @staticmethod
+    def _replayable(headers, body):
+        if body is not None:
+            return isinstance(body, str)
+
+        for header in headers:
+            name = header[0].lower()
+            if name == "transfer-encoding" or \
+               (name == "content-length" and str(header[1]) != "0"):
+                return False
+
+        return True
+
+    def session_rejected(self):
+        rejected = getattr(self.local, 'rejected', False)
+        self.local.rejected = False
+        return rejected
+
+    def response_received(self, service, host, response):
+        if response.status == 401:
+            self.debug("Session for %s@%s rejected, negotiating again", service, host)
+            self.invalidate(service, host)
+            return
+
+        cookie = Cookie.SimpleCookie()
+        for header in response.msg.getheaders("set-cookie"):
+            try:
+                cookie.load(header)
+            except Cookie.CookieError:
+                pass
+
+        name = self.session_cookies.get(service)
+        if name is not None:
+            morsels = [ morsel for morsel in cookie.values() if morsel.key == name ]
+        else:
+            morsels = cookie.values()
+
+        if not morsels:
+            return
+
+        expires = time.time() + self.session_timeout
+        for morsel in morsels:
+            if morsel["max-age"]:
+                try:
+                    expires = min(expires, time.time() + int(morsel["max-age"]))
+                except ValueError:
+                    pass
+            elif morsel["expires"]:
+                try:
+                    expires = min(expires, calendar.timegm(
+                                     email.utils.parsedate(morsel["expires"])))
+                except TypeError:
+                    pass
+
+        # An empty or expired cookie ends the session
+        if expires <= time.time() or not [ morsel for morsel in morsels if morsel.value ]:
+            self.invalidate(service, host)
+            return
+
+        self.lock.acquire()
+        try:
+            self.sessions[(service, host)] = \
+                ("; ".join([ "%s=%s" % (morsel.key, morsel.coded_value)
+                             for morsel in morsels ]), expires)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, service, host):
+        self.lock.acquire()
+        try:
+            self.sessions.pop((service, host), None)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        '''
+        Return the number of negotiations and session reuses per host.
+        '''
+
+        self.lock.acquire()
+        try:
+            return dict([ (host, dict(counters))
+                          for host, counters in self.counters.items() ])
+        finally:
+            self.lock.release()
+
+    def negotiate(self, service, host):
         import kerberos as k
 
         result, context = k.authGSSClientInit("%s@%s" % (service, host),
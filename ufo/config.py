@@ -16,3 +16,12 @@
 
 debug_mode = False
 
+# Fraction of the debug messages actually logged, lowering it allows to
+# keep debugging enabled on a busy filesystem
+debug_sampling = 1.0
+
+# Latency instrumentation of the filesystem operations, see ufo.metrics,
+# and file the metrics are dumped to every 'metrics_dump_interval' seconds
+metrics_enabled = True
+metrics_dump = None
+metrics_dump_interval = 60
@@ -17,21 +17,29 @@
 '''UFO client library.'''
 
 import os
-import socket
 import new
+import time
+import Queue
+import socket
+import select
+import weakref
+import threading
 from uuid import uuid4
 from urlparse import urlsplit
 
 import ufo.auth
 from debugger import Debugger
+from metrics import metrics
 from errors import ConflictError
 
-from couchdb.http import ResourceNotFound, ServerError, ResourceConflict, Session
-from couchdb.client import Server
+from couchdb.http import ResourceNotFound, ServerError, ResourceConflict, Session, \
+                         HTTPConnection, HTTPSConnection, Unauthorized
+from couchdb.client import Server, Database
 from couchdb.design import ViewDefinition, FilterFunction, sync_docs
 from couchdb.mapping import *
 
 couchdb_servers = {}
+couchdb_servers_lock = threading.Lock()
 
 
 class UTF8Document(Document):
@@ -123,21 +131,18 @@ class DocumentHelper(Debugger):
 
     def __init__(self, doc_class, db, server="http://localhost:5984", auth=None, batch=False):
         try:
-            # Creating server object
-            if not couchdb_servers.has_key(server):
-                couchdb_servers[server] = (Server(server), {})
-
-            def _get_connection(self, url):
-                conn = Session._get_connection(self, url)
-                auth.bind(conn, service="couchdb")
-                return conn
+            # Creating server object, sharing a connection pool with all
+            # the helpers using the same server and credentials
+            couchdb_servers_lock.acquire()
+            try:
+                if not couchdb_servers.has_key((server, auth)):
+                    couchdb_servers[(server, auth)] = \
+                        (Server(server, session=ConnectionPool(auth=auth)), {})
 
-            self.server, databases = couchdb_servers[server]
+                self.server, databases = couchdb_servers[(server, auth)]
 
-            if auth:
-                # Hook the _get_connection method to used authenticated requests
-                self.server.resource.session._get_connection = new.instancemethod(_get_connection,
-                                                                                  self.server.resource.session)
+            finally:
+                couchdb_servers_lock.release()
 
             # Creating database if needed
             if type(db) in (str, unicode):
@@ -151,11 +156,6 @@ class DocumentHelper(Debugger):
                     finally:
                         databases[db] = self.database
 
-                    if auth:
-                        # Hook the _get_connection method again
-                        self.database.resource.session._get_connection = new.instancemethod(_get_connection,
-                                                                                            self.database.resource.session)
-
             else:
                 self.database = db
 
@@ -195,8 +195,36 @@ class DocumentHelper(Debugger):
         ViewDefinition.sync_many(self.database, views)
         sync_docs(self.database, [self.doc_class])
 
+        # sync_many never removes a view, the existing databases would
+        # keep building the indexes of the views we dropped
+        for design, names in getattr(self.doc_class, 'retired_views', {}).items():
+            self._remove_views(design, names)
+
+    def _remove_views(self, design, names):
+        try:
+            doc = self.database['_design/' + design]
+        except ResourceNotFound:
+            return
+
+        views = doc.get('views', {})
+        retired = [ name for name in names if views.has_key(name) ]
+        if not retired:
+            return
+
+        self.debug("%s: Removing the views %s from the design %s",
+                   self, ", ".join(retired), design)
+
+        for name in retired:
+            del views[name]
+
+        try:
+            self.database.save(doc)
+        except ResourceConflict:
+            # Removed by another client at the same time
+            pass
+
     def commit(self):
-      self.debug("%s: Syncing changes" % (self))
+      self.debug("%s: Syncing changes", self)
 
       self.database.commit()
 
@@ -208,28 +236,32 @@ class DocumentHelper(Debugger):
         else:
             doc._data['_id'] = uuid4().hex
 
-        self.debug("%s: Creating %s:%s (batch=%s)"
-                   % (self, doc.doctype, doc.id, str(self.batchmode)))
+        self.debug("%s: Creating %s:%s (batch=%s)",
+                   self, doc.doctype, doc.id, self.batchmode)
 
         opts = {}
         # Can't get the new generated _rev number when batch mode...
         if False and self.batchmode:
             opts['batch'] = 'ok'
 
+        started = time.time()
         try:
             doc._data['_id'], doc._data['_rev'] = self.database.save(doc._data, **opts)
 
         except ResourceConflict, e:
             raise ConflictError
 
+        finally:
+            metrics.timed('db', '_doc.PUT', started)
+
         return doc
 
     def update(self, documents):
         if not isinstance(documents, list):
             documents = [documents]
 
-        self.debug("%s: Updating %s documents (batch=%s): %s"
-                   % (self, len(documents), str(self.batchmode), str(documents)))
+        self.debug("%s: Updating %s documents (batch=%s): %s",
+                   self, len(documents), self.batchmode, documents)
 
         # Build a document dict indexed by doc ids
         docs_by_id = {}
@@ -241,15 +273,107 @@ class DocumentHelper(Debugger):
           opts['batch'] = 'ok'
 
         # Update docs and fill rev fields with new ones
-        for success, id, rev in self.database.update(documents, **opts):
+        started = time.time()
+        try:
+            results = self.database.update(documents, **opts)
+        finally:
+            metrics.timed('db', '_bulk_docs.POST', started)
+
+        for success, id, rev in results:
             docs_by_id[id]['_rev'] = rev
 
         return documents
 
+    def bulk_update(self, documents, chunk_size=500, workers=4, progress=None):
+        '''
+        Send documents to the database with _bulk_docs requests of
+        'chunk_size' documents, with up to 'workers' requests in flight.
+
+        'documents' can be any iterable, only the chunks being sent are kept
+        in memory. 'progress' is called with the number of documents sent so
+        far after every request. Returns the number of documents sent, and
+        raises a BulkUpdateError once everything is sent if some documents
+        could not be saved.
+        '''
+
+        self.debug("%s: Bulk updating documents (chunk_size=%d, workers=%d)",
+                   self, chunk_size, workers)
+
+        opts = {}
+        if self.batchmode:
+          opts['batch'] = 'ok'
+
+        chunks = Queue.Queue(workers)
+        lock = threading.Lock()
+        failures = {}
+        sent = [ 0 ]
+
+        # The requests are accounted to the operation of the caller
+        frame = metrics.frame()
+
+        def send_chunks():
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+
+                started = time.time()
+                try:
+                    results = self.database.update(chunk, **opts)
+                except Exception, e:
+                    results = [ (False, doc['_id'], e) for doc in chunk ]
+                metrics.timed('db', '_bulk_docs.POST', started, frame)
+
+                lock.acquire()
+                try:
+                    for (success, id, rev), doc in zip(results, chunk):
+                        if success:
+                            doc['_rev'] = rev
+                        else:
+                            failures[id] = rev
+
+                    sent[0] += len(chunk)
+                    if progress:
+                        progress(sent[0])
+
+                finally:
+                    lock.release()
+
+        threads = [ threading.Thread(target=send_chunks) for i in range(workers) ]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+
+        try:
+            chunk = []
+            for doc in documents:
+                chunk.append(doc)
+                if len(chunk) == chunk_size:
+                    chunks.put(chunk)
+                    chunk = []
+
+            if chunk:
+                chunks.put(chunk)
+
+        finally:
+            for thread in threads:
+                chunks.put(None)
+            for thread in threads:
+                thread.join()
+
+        if failures:
+            raise BulkUpdateError(failures)
+
+        return sent[0]
+
     def delete(self, document):
-        self.debug("%s: Deleting %s:%s" % (self, document.doctype, document.id))
+        self.debug("%s: Deleting %s:%s", self, document.doctype, document.id)
 
-        self.database.delete(document)
+        started = time.time()
+        try:
+            self.database.delete(document)
+        finally:
+            metrics.timed('db', '_doc.DELETE', started)
 
     def replicate(self, db_name, server="http://localhost:5984", auth=None, reverse=False, **opts):
         if auth:
@@ -275,10 +399,125 @@ class DocumentHelper(Debugger):
             raise DocumentException("Can not replicate %s to %s (%s)" %
                                     (src, dest, e.message))
 
+    def get_many(self, view, keys, **opts):
+        '''
+        Fetch the documents emitted by a view for several keys with a
+        single request, returns a dict of the documents indexed by key.
+        '''
+
+        if not keys:
+            return {}
+
+        view_def = getattr(self.doc_class, view)
+        opts = self._view_options(view, opts)
+
+        self.debug("%s: Calling view %s:%s for %d keys",
+                   self, self.doc_class.__name__, view, len(keys))
+
+        started = time.time()
+        try:
+            rows = self.database.view('%s/%s' % (view_def.design, view_def.name),
+                                      keys=list(keys), **opts).rows
+        finally:
+            metrics.timed('db', view + '.POST', started)
+
+        documents = {}
+        for row in rows:
+            key = row.key
+            if isinstance(key, unicode):
+                key = key.encode('utf-8')
+            if not documents.has_key(key):
+                documents[key] = self.doc_class._wrap_row(row)
+
+        return documents
+
+    def iterview(self, view, page_size=1000, prefetch=False, wrapper=None, **opts):
+        '''
+        Iterate lazily over the rows of a view with requests of at most
+        'page_size' rows, so that the memory used does not depend on the
+        size of the result. With 'prefetch', the next page is requested in
+        the background while the current one is being consumed.
+
+        The rows are converted with 'wrapper' if given, or returned in the
+        same form as the regular view calls otherwise.
+        '''
+
+        view_def = getattr(self.doc_class, view)
+        name = '%s/%s' % (view_def.design, view_def.name)
+
+        if wrapper is None:
+            wrapper = lambda row: self._wrap_row(view_def.wrapper(dict(row)))
+
+        options = view_def.defaults.copy()
+        options.update(self._view_options(view, opts))
+        options.pop('pk', None)
+        if options.has_key('key'):
+            options['startkey'] = options['endkey'] = options.pop('key')
+
+        def fetch(options, result, frame=None):
+            started = time.time()
+            try:
+                result.append(list(self.database.view(name, limit=page_size + 1, **options)))
+            except Exception, e:
+                result.append(e)
+            metrics.timed('db', view + '.GET', started, frame)
+
+        self.debug("%s: Iterating over view %s:%s(%s) by pages of %d rows",
+                   self, self.doc_class.__name__, view, opts, page_size)
+
+        page = []
+        fetch(options, page)
+        while True:
+            rows = page.pop()
+            if isinstance(rows, Exception):
+                raise rows
+
+            # The extra row is the first one of the next page, this way
+            # the documents that leave the view while we are iterating,
+            # because they are updated, do not shift the pages.
+            fetcher = None
+            if len(rows) > page_size:
+                options = options.copy()
+                options['startkey'] = rows[-1].key
+                if rows[-1].id is not None:
+                    options['startkey_docid'] = rows[-1].id
+
+                if prefetch:
+                    # Accounted to the operation consuming the rows
+                    fetcher = threading.Thread(target=fetch,
+                                               args=(options, page, metrics.frame()))
+                    fetcher.setDaemon(True)
+                    fetcher.start()
+
+            for row in rows[:page_size]:
+                yield wrapper(row)
+
+            if len(rows) <= page_size:
+                break
+
+            if fetcher:
+                fetcher.join()
+            else:
+                fetch(options, page)
+
+    def _view_options(self, view, opts):
+        # The views that do not emit documents need them to be fetched
+        # along with the rows, unless the caller decides otherwise
+        if (view in getattr(self.doc_class, 'keys_only_views', ()) and
+            not opts.get('reduce') and not opts.has_key('include_docs')):
+            opts = dict(opts, include_docs=True)
+
+        return opts
+
     def _pk_view(self, view, **opts):
         try:
             key = opts.pop('key')
-            return getattr(self.doc_class, view)(self.database, key=key, **opts).rows[0]
+            started = time.time()
+            try:
+                rows = getattr(self.doc_class, view)(self.database, key=key, **opts).rows
+            finally:
+                metrics.timed('db', view + '.GET', started)
+            return rows[0]
 
         except KeyError, e:
             raise DocumentException("You must specify a key for %s.%s()" %
@@ -293,21 +532,28 @@ class DocumentHelper(Debugger):
         if isinstance(getattr(self.doc_class, attr), ViewDefinition):
             
             def view_wrapper(**opts):
-                self.debug("%s: Calling view %s:%s(%s)"
-                           % (self, self.doc_class.__name__, attr, str(opts)))
+                self.debug("%s: Calling view %s:%s(%s)",
+                           self, self.doc_class.__name__, attr, opts)
+
+                opts = self._view_options(attr, opts)
 
                 if opts.get("pk"):
                     return self._pk_view(attr, **opts)
 
+                if opts.has_key("page_size"):
+                    return self.iterview(attr, **opts)
+
                 def iterate_view():
-                    for row in getattr(self.doc_class, attr).__call__(self.database, **opts):
-                        if type(row) == dict:
-                            if type(row["value"]) == dict:
-                                yield row["key"], self.doc_class(**row["value"])
-                            else:
-                                yield row["key"], row["value"]
-                        else:
-                            yield row
+                    # The request is sent when the rows are first accessed
+                    started = time.time()
+                    try:
+                        rows = getattr(self.doc_class, attr).__call__(self.database, **opts).rows
+                    finally:
+                        metrics.timed('db', attr + (opts.has_key('keys') and '.POST' or '.GET'),
+                                      started)
+
+                    for row in rows:
+                        yield self._wrap_row(row)
 
                 return iterate_view()
 
@@ -315,9 +561,25 @@ class DocumentHelper(Debugger):
 
         return lambda *args, **kw: getattr(self.doc_class, attr).__call__(self.database, *args, **kw)
 
+    def _wrap_row(self, row):
+        # Raw rows of the views with a bypass wrapper are returned as
+        # (key, value) tuples, the value being a document if possible
+        if type(row) == dict:
+            value = row.get("doc") or row["value"]
+            if type(value) == dict:
+                return row["key"], self.doc_class(**value)
+            return row["key"], value
+
+        return row
+
     def __getitem__(self, key):
-        item = self.database[key]
-        if item["doctype"] != self.doc_class.__name__:
+        started = time.time()
+        try:
+            item = self.database[key]
+        finally:
+            metrics.timed('db', '_doc.GET', started)
+        doctype = getattr(getattr(self.doc_class, 'doctype', None), 'default', None)
+        if item["doctype"] not in (doctype, self.doc_class.__name__):
             raise DocumentException("Invalid document type %s (wanted %s)" %
                                     (item["type"], self.doc_class.__name__))
         obj = self.doc_class(item['_id'], **item)
@@ -327,6 +589,13 @@ class DocumentHelper(Debugger):
             obj._data['_rev'] = item['_rev']
         return obj
 
+    def pool_stats(self):
+        '''
+        Return the statistics of the connection pool of the server.
+        '''
+
+        return self.server.resource.session.stats()
+
     def __str__(self):
         return '<DocumentHelper class: %s server: %s database: %s>' % \
                (self.doc_class.__name__, self.server, self.database.name)
@@ -335,5 +604,296 @@ class DocumentHelper(Debugger):
         return str(self)
 
 
+class ChangesWatcher(Debugger, threading.Thread):
+    '''
+    Background thread following the continuous changes feed of a database
+    and handing every change to a callback.
+
+    The feed holds its connection for as long as it is followed, so it
+    gets a connection pool of its own instead of taking one of the shared
+    pool for good.
+    '''
+
+    retry_delay = 5
+
+    def __init__(self, database, callback, since=None, include_docs=False, heartbeat=30000):
+        threading.Thread.__init__(self, name="ChangesWatcher(%s)" % database.name)
+        self.setDaemon(True)
+
+        self.database = database
+        self.session = ConnectionPool(auth=getattr(database.resource.session, 'auth', None),
+                                      max_size=1)
+        resource = database.resource()
+        resource.session = self.session
+        self.feed = Database(resource, database.name)
+
+        self.callback = callback
+        self.include_docs = include_docs
+        self.heartbeat = heartbeat
+        self.stopped = False
+        self.wakeup = threading.Event()
+
+        if since is None:
+            since = self.database.info()['update_seq']
+        self.since = since
+
+    def run(self):
+        while not self.stopped:
+            try:
+                for change in self.feed.changes(feed='continuous',
+                                                since=self.since,
+                                                heartbeat=self.heartbeat,
+                                                include_docs=self.include_docs):
+                    if self.stopped:
+                        break
+
+                    if change.has_key('last_seq'):
+                        self.since = change['last_seq']
+                        continue
+
+                    self.since = change['seq']
+                    self.callback(change)
+
+            except Exception, e:
+                if self.stopped:
+                    break
+
+                self.debug("%s: Changes feed interrupted at %s (%s)",
+                           self.name, self.since, e)
+                self.wakeup.wait(self.retry_delay)
+
+        self.session.close()
+
+    def stop(self):
+        '''
+        Stop following the feed, interrupting the request waiting for the
+        next change.
+        '''
+
+        self.stopped = True
+        self.wakeup.set()
+        self.session.abort()
+
+
+class ConnectionPool(Debugger, Session):
+    '''
+    Thread safe pool of keep-alive HTTP connections, shared by all the
+    helpers of a server and credentials.
+
+    At most 'max_size' connections per host are handed out at the same time,
+    other requests wait for a connection to be returned. Idle connections
+    are closed after 'idle_timeout' seconds, and the ones closed by the
+    server are reconnected before being reused. The authenticator, if any,
+    is bound once to every new connection.
+    '''
+
+    max_size = 16
+    idle_timeout = 60
+    wait_timeout = 30
+
+    def __init__(self, auth=None, max_size=None, idle_timeout=None, wait_timeout=None, **kw):
+        Session.__init__(self, **kw)
+
+        self.auth = auth
+        if max_size is not None:
+            self.max_size = max_size
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        if wait_timeout is not None:
+            self.wait_timeout = wait_timeout
+
+        # Idle connections are kept with the time they were returned. The
+        # connections in use are weakly referenced, as the session drops
+        # them without returning them on errors.
+        self.idle = {}
+        self.active = {}
+        self.condition = threading.Condition(self.lock)
+
+        self.aborted = False
+
+        self.created = 0
+        self.waits = 0
+        self.reconnects = 0
+        self.evictions = 0
+
+    def request(self, method, url, body=None, headers=None, credentials=None,
+                num_redirects=0):
+        try:
+            return Session.request(self, method, url, body, headers, credentials,
+                                   num_redirects)
+
+        except Unauthorized:
+            # The authenticator could not send the body written by the
+            # session again after rejecting its session, send it again
+            if not self.auth or not self.auth.session_rejected() or \
+               not (body is None or isinstance(body, str)):
+                raise
+
+            return Session.request(self, method, url, body, headers, credentials,
+                                   num_redirects)
+
+    def _get_connection(self, url):
+        scheme, host = urlsplit(url, 'http', False)[:2]
+        key = (scheme, host)
+
+        self.condition.acquire()
+        try:
+            if self.aborted:
+                raise DocumentException("The connections to %s were aborted" % host)
+
+            idle = self.idle.setdefault(key, [])
+            active = self.active.setdefault(key, weakref.WeakKeyDictionary())
+
+            self._evict_idle(idle)
+
+            deadline = None
+            while not idle and len(active) >= self.max_size:
+                if deadline is None:
+                    self.waits += 1
+                    deadline = time.time() + self.wait_timeout
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout("No connection available to %s after %d seconds"
+                                      % (host, self.wait_timeout))
+                # Leaked connections are only noticed when garbage collected,
+                # so do not wait for a notification forever
+                self.condition.wait(min(remaining, 1))
+
+            if idle:
+                conn, returned = idle.pop()
+                if not self._is_healthy(conn):
+                    conn.close()
+                    self.reconnects += 1
+            else:
+                conn = self._create_connection(scheme, host)
+
+            active[conn] = True
+            return conn
+
+        finally:
+            self.condition.release()
+
+    def _return_connection(self, url, conn):
+        scheme, host = urlsplit(url, 'http', False)[:2]
+        key = (scheme, host)
+
+        self.condition.acquire()
+        try:
+            self.active.setdefault(key, weakref.WeakKeyDictionary()).pop(conn, None)
+            self.idle.setdefault(key, []).append((conn, time.time()))
+            self.condition.notify()
+
+        finally:
+            self.condition.release()
+
+    def _create_connection(self, scheme, host):
+        if scheme == 'http':
+            cls = HTTPConnection
+        elif scheme == 'https':
+            cls = HTTPSConnection
+        else:
+            raise ValueError('%s is not a supported scheme' % scheme)
+
+        conn = cls(host)
+        if self.auth:
+            self.auth.bind(conn, service="couchdb")
+
+        # Connections still connecting when the pool is aborted are shut
+        # down once connected
+        pool = self
+        def connect(_self):
+            _self.__class__.connect(_self)
+            pool.condition.acquire()
+            try:
+                if pool.aborted:
+                    pool._shutdown(_self)
+
+            finally:
+                pool.condition.release()
+
+        conn.connect = new.instancemethod(connect, conn)
+
+        self.created += 1
+        return conn
+
+    def _evict_idle(self, idle):
+        limit = time.time() - self.idle_timeout
+        while idle and idle[0][1] < limit:
+            conn, returned = idle.pop(0)
+            conn.close()
+            self.evictions += 1
+
+    def _is_healthy(self, conn):
+        # A keep-alive connection must not be readable while idle, otherwise
+        # the server closed it or sent garbage
+        if conn.sock is None:
+            return True
+
+        try:
+            readable, writable, errors = select.select([ conn.sock ], [], [], 0)
+        except (select.error, socket.error):
+            return False
+
+        return not readable
+
+    def close(self):
+        self.condition.acquire()
+        try:
+            for idle in self.idle.values():
+                for conn, returned in idle:
+                    conn.close()
+            self.idle.clear()
+
+        finally:
+            self.condition.release()
+
+    def abort(self):
+        '''
+        Shut down the connections in use, the requests waiting for a
+        response on them fail right away, and refuse the next ones.
+        '''
+
+        self.condition.acquire()
+        try:
+            self.aborted = True
+            for active in self.active.values():
+                for conn in active.keys():
+                    self._shutdown(conn)
+
+        finally:
+            self.condition.release()
+
+    def _shutdown(self, conn):
+        try:
+            if conn.sock is not None:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def stats(self):
+        self.condition.acquire()
+        try:
+            return { 'active'     : sum([ len(active) for active in self.active.values() ]),
+                     'idle'       : sum([ len(idle) for idle in self.idle.values() ]),
+                     'created'    : self.created,
+                     'waits'      : self.waits,
+                     'reconnects' : self.reconnects,
+                     'evictions'  : self.evictions }
+
+        finally:
+            self.condition.release()
+
+
 class DocumentException(Exception):
     pass
+
+
+class PoolTimeout(DocumentException):
+    pass
+
+
+class BulkUpdateError(DocumentException):
+    def __init__(self, failures):
+        DocumentException.__init__(self, "%d documents could not be updated (%s)"
+                                   % (len(failures), ", ".join(failures.keys()[:10])))
+        self.failures = failures
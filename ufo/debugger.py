@@ -18,6 +18,8 @@ from ufo import config
 
 import os
 import sys
+import random
+import threading
 import traceback
 
 # Windows...
@@ -35,6 +37,21 @@ else:
 
     LOG_WARNING = 6
 
+_opened = False
+_openlog_lock = threading.Lock()
+
+def _openlog(name):
+  global _opened
+
+  _openlog_lock.acquire()
+  try:
+    if not _opened:
+      openlog(name)
+      _opened = True
+
+  finally:
+    _openlog_lock.release()
+
 
 class Debugger(object):
   '''
@@ -43,7 +60,6 @@ class Debugger(object):
   '''
 
   _name   = None
-  _opened = False
 
   def _setName(self, name):
     '''
@@ -70,41 +86,56 @@ class Debugger(object):
     self._validateName()
     return self._name
 
-  def debug(self, args):
+  def debug(self, message, *args):
     '''
     Quick method to output some debugging information which states the
     thread name a colon, and whatever arguments have been passed to
     it.
 
     Args:
-      args: a list of additional arguments to pass, much like what
-        print() takes.
+      message: the message, or its format if there are arguments.
+      args: the arguments of the format, it is only applied when the
+        message is actually logged.
     '''
 
-    self._validateName()
+    if not config.debug_mode:
+      return
 
-    if config.debug_mode:
-      if not self._opened:
-          openlog(self._getName() + ".log")
+    if config.debug_sampling < 1 and random.random() >= config.debug_sampling:
+      return
 
-      name = '%s(%s)' % (self._getName(), self._getCaller()[2])
-      s = '%s: %s' % (name, args)
-      if len(s) > 252:
-        s = s[:252] + '...'
+    if not _opened:
+      _openlog(self._getName() + ".log")
 
-      syslog(LOG_WARNING, s)
+    if args:
+      message = message % args
+
+    s = '%s(%s): %s' % (self._getName(), self._getCallerName(), message)
+    if len(s) > 252:
+      s = s[:252] + '...'
+
+    syslog(LOG_WARNING, s)
 
   def debug_exception(self):
     if config.debug_mode:
       exc_info = sys.exc_info()
 
       self.debug('*** Unhandled exception occurred')
-      self.debug('***     Type: %s' % str(exc_info[0]))
-      self.debug('***    Value: %s' % str(exc_info[1]))
+      self.debug('***     Type: %s', exc_info[0])
+      self.debug('***    Value: %s', exc_info[1])
       self.debug('*** Traceback:')
 
       for line in traceback.extract_tb(exc_info[2]):
-        self.debug('***    %s(%d) in %s: %s' % line)
+        self.debug('***    %s(%d) in %s: %s', *line)
+
+  def _getCallerName(self):
+    '''
+    Return the name of the function that called debug, without
+    extracting the whole stack.
+    '''
+
+    # debug itself is the first frame
+    return sys._getframe(2).f_code.co_name
 
   def _getCaller(self, backsteps=1):
     '''
@@ -20,14 +20,15 @@ import os
 import stat
 import errno
 import shutil
-import difflib
 
 # Fuse paths are UNIX-like whatever the operating system
 import posixpath
 
-from ufo.utils import MutableStat, CacheDict, get_user_infos
+from ufo.utils import MutableStat, CacheDict, LRUCache, MimeDetector, get_user_infos
 from ufo.debugger import Debugger
 from ufo.database import *
+from ufo.metrics import metrics, operation, TimedObject
+from ufo import config
 import ufo.acl as acl
 
 def _wrap_bypass(row):
@@ -45,6 +46,9 @@ def norm2path(func):
 
 class SyncDocument(UTF8Document):
 
+    # Views of former versions, removed from the design documents on sync
+    retired_views = { 'syncdocument' : ( 'by_keyword', ) }
+
     doctype  = TextField(default="SyncDocument")
     filename = TextField()
     dirpath  = TextField()
@@ -110,6 +114,10 @@ class SyncDocument(UTF8Document):
             return self.__dict__[attr]
 
     def __setattr__(self, attr, value):
+        # The ACL field is only ever assigned as a whole
+        if attr == "acl":
+            self.__dict__.pop('_frozen_acl', None)
+
         if attr == "stats" and type(value) != dict:
             stat_result = {}
             for field in SyncDocument.stats.mapping._fields.keys():
@@ -124,11 +132,29 @@ class SyncDocument(UTF8Document):
         object.__setattr__(self, attr, value)
 
     @property
-    def posix_acl(self):
-       if self.acl:
-           return acl.ACL.from_json(self.acl, self.mode)
+    def frozen_acl(self):
+        '''
+        Immutable ACL of the document, parsed once per revision and mode,
+        and again when the ACL field is assigned.
+        '''
+
+        key = (self.rev, self.mode)
 
-       return acl.ACL.from_mode(self.mode)
+        cached = self.__dict__.get('_frozen_acl')
+        if cached and cached[0] == key:
+            return cached[1]
+
+        if self.acl:
+            frozen = acl.ACL.from_json(self.acl, self.mode).freeze()
+        else:
+            frozen = acl.ACL.from_mode(self.mode).freeze()
+
+        self.__dict__['_frozen_acl'] = (key, frozen)
+        return frozen
+
+    @property
+    def posix_acl(self):
+        return self.frozen_acl.thaw()
 
     def __str__(self):
         return ('<%s id:%s path:%s type:%s>'
@@ -203,22 +229,42 @@ class SyncDocument(UTF8Document):
                                             "}" \
                                           "}" \
                                         "}",
-                              reduce_fun = "function (keys,values,rereduce) {" \
-                                             "if(rereduce == false) {" \
-                                               "var size = 0;" \
-                                               "for (var i = 0; i<values.length; i++) {" \
-                                                 "if (values[i].stats)" \
-                                                   "size += values[i].stats.st_size;" \
-                                               "}" \
-                                               "return size;" \
-                                             "}" \
-                                             "else {" \
-                                               "return sum(values);" \
-                                             "}" \
-                                           "}",
-                              reduce = False,
                               wrapper = _wrap_bypass)
 
+    revs_by_dir_prefix = ViewField('syncdocument',
+                                   language = 'javascript',
+                                   map_fun = "function (doc) {" \
+                                               "if (doc.doctype === 'SyncDocument') {" \
+                                                 "var last = '';" \
+                                                 "var current = doc.dirpath;" \
+                                                 "while (current !='/' && current != last) {" \
+                                                   "emit(current, doc._rev);" \
+                                                   "current = current.slice(0, current.lastIndexOf('/'));" \
+                                                 "}" \
+                                               "}" \
+                                             "}",
+                                   wrapper = _wrap_bypass)
+
+    usage_by_dir = ViewField('syncdocument',
+                             language = 'javascript',
+                             map_fun = "function (doc) {" \
+                                         "if (doc.doctype === 'SyncDocument') {" \
+                                           "var usage = [ doc.stats ? doc.stats.st_size : 0, 1, 0 ];" \
+                                           "if (doc.type === 'application/x-directory') {" \
+                                             "usage = [ 0, 0, 1 ];" \
+                                           "}" \
+                                           "var last = '';" \
+                                           "var current = doc.dirpath;" \
+                                           "while (current !='/' && current != last) {" \
+                                             "emit(current, usage);" \
+                                             "current = current.slice(0, current.lastIndexOf('/'));" \
+                                           "}" \
+                                           "emit('/', usage);" \
+                                         "}" \
+                                       "}",
+                             reduce_fun = "_sum",
+                             wrapper = _wrap_bypass)
+
     by_tag = ViewField('syncdocument',
                        language = 'javascript',
                        map_fun = "function (doc) {" \
@@ -232,25 +278,117 @@ class SyncDocument(UTF8Document):
                        reduce = False,
                        wrapper = _wrap_bypass)
 
-    by_keyword = ViewField('syncdocument',
+    by_provider_and_participant = ViewField('syncdocument',
+                                            language = 'javascript',
+                                            map_fun = "function (doc) {" \
+                                                        "if (doc.doctype === 'SyncDocument' && doc.acl) {" \
+                                                          "for (var i=0; i<doc.acl.length; i++) {" \
+                                                            "if (doc.dirpath === '/') {" \
+                                                              "emit([doc.stats.st_uid, doc.acl[i].qualifier, doc.dirpath+doc.filename], doc);" \
+                                                            "} else {" \
+                                                              "emit([doc.stats.st_uid, doc.acl[i].qualifier, doc.dirpath+'/'+doc.filename], doc);" \
+                                                            "}" \
+                                                          "}" \
+                                                        "}" \
+                                                      "}",
+                                            reduce_fun = "_count",
+                                            reduce = False,
+                                            wrapper=_wrap_bypass)
+
+class CompactSyncDocument(SyncDocument):
+    '''
+    SyncDocument whose views do not emit the whole document but null or
+    the few values needed by their reduce function. The documents are
+    fetched along with the rows with 'include_docs' when querying the views
+    listed in 'keys_only_views', which makes the indexes much smaller.
+
+    by_dir_prefix emits null as well, the sizes of the directories come
+    from usage_by_dir.
+    '''
+
+    keys_only_views = ( 'by_path', 'by_type', 'by_dir', 'by_dir_prefix',
+                        'by_tag', 'by_provider_and_participant' )
+
+    retired_views = { 'syncdocument_compact' : ( 'by_keyword', ) }
+
+    by_path = ViewField('syncdocument_compact',
+                        language = 'javascript',
+                        map_fun = "function (doc) {" \
+                                    "if (doc.doctype === 'SyncDocument') {" \
+                                      "if (doc.dirpath === '/') {" \
+                                        "emit('/' + doc.filename, null);" \
+                                      "} else {" \
+                                        "emit(doc.dirpath + '/' + doc.filename, null);" \
+                                      "}" \
+                                    "}" \
+                                  "}")
+
+    by_type = ViewField('syncdocument_compact',
+                        language = 'javascript',
+                        map_fun = "function (doc) {" \
+                                    "if (doc.doctype === 'SyncDocument' && doc.type != 'application/x-directory') {" \
+                                      "emit(doc.type.split('/'), null);" \
+                                    "}" \
+                                  "}",
+                        reduce_fun = "_count",
+                        reduce = False,
+                        wrapper = _wrap_bypass)
+
+    by_dir = ViewField('syncdocument_compact',
                        language = 'javascript',
                        map_fun = "function (doc) {" \
                                    "if (doc.doctype === 'SyncDocument') {" \
-                                     "for (var i=0; i<doc.filename.length-2; i++) {" \
-                                       "emit(doc.filename.slice(i).toLowerCase(), doc);" \
-                                     "}" \
+                                     "emit(doc.dirpath, null);" \
                                    "}" \
                                  "}")
 
-    by_provider_and_participant = ViewField('syncdocument',
+    by_dir_prefix = ViewField('syncdocument_compact',
+                              language = 'javascript',
+                              map_fun = "function (doc) {" \
+                                          "if (doc.doctype === 'SyncDocument') {" \
+                                            "var last = '';" \
+                                            "var current = doc.dirpath;" \
+                                            "while (current !='/' && current != last) {" \
+                                              "emit(current, null);" \
+                                              "current = current.slice(0, current.lastIndexOf('/'));" \
+                                            "}" \
+                                          "}" \
+                                        "}",
+                              wrapper = _wrap_bypass)
+
+    revs_by_dir_prefix = ViewField('syncdocument_compact',
+                                   language = 'javascript',
+                                   map_fun = SyncDocument.revs_by_dir_prefix.map_fun,
+                                   wrapper = _wrap_bypass)
+
+    usage_by_dir = ViewField('syncdocument_compact',
+                             language = 'javascript',
+                             map_fun = SyncDocument.usage_by_dir.map_fun,
+                             reduce_fun = "_sum",
+                             wrapper = _wrap_bypass)
+
+    by_tag = ViewField('syncdocument_compact',
+                       language = 'javascript',
+                       map_fun = "function (doc) {" \
+                                   "if (doc.doctype === 'SyncDocument' && doc.tags) {" \
+                                     "for (var i=0; i<doc.tags.length; i++) {" \
+                                       "emit([doc.tags[i], doc.stats.st_uid], null);" \
+                                     "}" \
+                                   "}" \
+                                 "}",
+                       reduce_fun = "_count",
+                       reduce = False,
+                       wrapper = _wrap_bypass)
+
+    by_provider_and_participant = ViewField('syncdocument_compact',
                                             language = 'javascript',
                                             map_fun = "function (doc) {" \
                                                         "if (doc.doctype === 'SyncDocument' && doc.acl) {" \
                                                           "for (var i=0; i<doc.acl.length; i++) {" \
                                                             "if (doc.dirpath === '/') {" \
-                                                              "emit([doc.stats.st_uid, doc.acl[i].qualifier, doc.dirpath+doc.filename], doc);" \
+                                                              "emit([doc.stats.st_uid, doc.acl[i].qualifier, doc.dirpath+doc.filename], null);" \
                                                             "} else {" \
-                                                              "emit([doc.stats.st_uid, doc.acl[i].qualifier, doc.dirpath+'/'+doc.filename], doc);" \
+                                                              "emit([doc.stats.st_uid, doc.acl[i].qualifier, doc.dirpath+'/'+doc.filename], null);" \
                                                             "}" \
                                                           "}" \
                                                         "}" \
@@ -265,6 +403,11 @@ def create(func):
         docs = func(self, *args, **kw)
         for doc in docs:
             self._cachedMetaDatas.cache(doc.path, doc)
+
+            # Nothing was known to be there
+            self._completeListings.invalidate(doc.path)
+            if doc.isdir():
+                self._completeListings.invalidate_prefix(doc.path + '/')
         return docs
     cache_create.op = 'create'
     return cache_create
@@ -274,6 +417,7 @@ def create_file(func):
         if not self.caching: return
         file = func(self, *args, **kw)
         self._cachedMetaDatas.cache(file.document.path, file.document)
+        self._completeListings.invalidate(file.document.path)
         return file
     cache_create_file.op = 'create'
     return cache_create_file
@@ -298,17 +442,30 @@ def update(func):
 
 def rename(func):
     def cache_rename(self, old, new, *args, **kw):
-        rename = False
-        for doc in func(self, old, new, *args, **kw):
-            if not rename:
-                oldkey = old
-                rename = True
-            else:
-                oldkey = posixpath.join(doc.dirpath.replace(new, old, 1),
-                                      doc.filename)
+        # The caches are cleared even if the subtree is partially updated
+        docs = []
+        try:
+            docs = func(self, old, new, *args, **kw)
+            return docs
+
+        finally:
+            # Forget the old path and the whole subtree below it
+            old = posixpath.normpath(old)
+            self._cachedMetaDatas.invalidate(old)
+            self._cachedMetaDatas.invalidate_prefix(old + '/')
+            self._completeListings.invalidate(old)
+            self._completeListings.invalidate_prefix(old + '/')
+
+            # The renamed entries are not in the cache under their new path,
+            # where a failed lookup or an empty listing may have been cached
+            new = posixpath.normpath(new)
+            self._cachedMetaDatas.invalidate_prefix(new + '/')
+            self._completeListings.invalidate(new)
+            self._completeListings.invalidate_prefix(new + '/')
+            for doc in docs:
+                self._cachedMetaDatas.invalidate(doc.path)
+                self._completeListings.invalidate(doc.dirpath)
 
-            if self._cachedMetaDatas.has_key(oldkey):
-                self._cachedMetaDatas.invalidate(oldkey)
     cache_rename.op = 'rename'
     return cache_rename
 
@@ -319,6 +476,12 @@ def delete(func):
         for doc in docs:
             if self._cachedMetaDatas.has_key(doc.path):
                 self._cachedMetaDatas.invalidate(doc.path)
+
+            # Forget the whole subtree of a directory
+            if doc.isdir():
+                self._cachedMetaDatas.invalidate_prefix(doc.path + '/')
+                self._completeListings.invalidate(doc.path)
+                self._completeListings.invalidate_prefix(doc.path + '/')
         return docs
     cache_delete.op = 'delete'
     return cache_delete
@@ -331,6 +494,9 @@ class CouchedFile(Debugger):
     filesystem = None
     fixed = False
 
+    # First bytes written to the file, kept for the mimetype detection
+    head = ""
+
     @normpath
     def __init__(self, path, flags, uid, gid, mode, filesystem, document=None):
         self.filesystem = filesystem
@@ -345,8 +511,8 @@ class CouchedFile(Debugger):
           self.file_ptr = self.filesystem.realfs.open(*open_args)
 
         except (OSError, IOError), e:
-          self.debug("Could not open %s, %s"
-                     % (path, e.message))
+          self.debug("Could not open %s, %s",
+                     path, e.message)
           raise
 
         try:
@@ -354,7 +520,7 @@ class CouchedFile(Debugger):
         except Exception, e:
             if flags & os.O_CREAT:
                 if document:
-                    self.debug("Using document %s" % document)
+                    self.debug("Using document %s", document)
                     document._data['_id'] = document.id
                     self.filesystem.doc_helper.database.save(document._data)
                     self.document = document
@@ -384,14 +550,20 @@ class CouchedFile(Debugger):
             newstats = self.filesystem.realfs.lstat(path)
 
         except (OSError, IOError), e:
-            self.debug("Could not close %s (%s), %s" % (path, realpath, e.message))
+            self.debug("Could not close %s (%s), %s", path, realpath, e.message)
             raise
 
         if release and not self.fixed and self.flags & (os.O_RDWR | os.O_WRONLY | os.O_TRUNC | os.O_APPEND):
-            self.debug("Updating document %s because it has been modified" % path)
+            self.debug("Updating document %s because it has been modified", path)
 
-            newstats = self.filesystem.realfs.lstat(path)
-            mimetype = self.filesystem.realfs.get_mime_type(path).basic()
+            # The written head is enough if it covers the whole file
+            # or at least what the detection needs
+            buffer = None
+            if self.head is not None and \
+               len(self.head) in (newstats.st_size, MimeDetector.head_size):
+                buffer = self.head
+
+            mimetype = self.filesystem.realfs.get_mime_type(path, buffer, newstats).basic()
             stats = self.document.get_stats()
 
             self.document.type = mimetype
@@ -402,6 +574,18 @@ class CouchedFile(Debugger):
 
             return self.filesystem.doc_helper.update(self.document)
 
+    def write(self, data):
+        if self.head is not None:
+            offset = self.file_ptr.tell()
+            if offset < MimeDetector.head_size:
+                if offset == len(self.head):
+                    self.head += data[:MimeDetector.head_size - len(self.head)]
+                else:
+                    # Not written sequentially from the beginning
+                    self.head = None
+
+        return self.file_ptr.write(data)
+
     def __getattr__(self, attr):
       return getattr(self.file_ptr, attr)
 
@@ -428,45 +612,152 @@ class CouchedFileSystem(Debugger):
     '''
 
     doc_helper = None
+    _filename_index = None
+
+    # Number of rows fetched per view request and of documents sent per
+    # _bulk_docs request when processing a whole subtree, and number of
+    # _bulk_docs requests in flight.
+    page_size = 1000
+    bulk_size = 500
+    bulk_workers = 4
 
     def __init__(self, mount_point, db_name, server="http://localhost:5984",
-                 auth=None, db_metadatas=False, fstype="auto", caching=True):
+                 auth=None, db_metadatas=False, fstype="auto", caching=True,
+                 cache_size=10000, negative_timeout=5, watch_changes=True,
+                 compact_views=False):
 
         self.mount_point = mount_point
+        self.server = server
+        self.auth = auth
         self.db_metadatas = db_metadatas
         self.fstype = fstype
         self.caching = caching
 
         if fstype == "nfs4":
             from ufo.fsbackend.nfs4 import NFS4FileSystem
-            self.realfs = NFS4FileSystem(mount_point)
+            realfs = NFS4FileSystem(mount_point)
         else:
             from ufo.fsbackend import GenericFileSystem
-            self.realfs = GenericFileSystem(mount_point)
+            realfs = GenericFileSystem(mount_point)
 
-        self._cachedMetaDatas = CacheDict(60)  # Dict to keep database docs in memory during
-        self._cachedRevisions = CacheDict(60)  # a system call sequence to avoid database
-                                               # access overheads.
+        # Time the calls to the backend filesystem
+        self.realfs = TimedObject(realfs)
+
+        # Keep database docs in memory to avoid database access overheads.
+        # When following the changes feed, the cached documents are only
+        # invalidated by the changes made to the database, otherwise
+        # they expire after a minute.
+        if watch_changes:
+            timeout = None
+        else:
+            timeout = 60
+
+        self._cachedMetaDatas = LRUCache(max_size=cache_size,
+                                         timeout=timeout,
+                                         negative_timeout=negative_timeout,
+                                         identify=lambda doc: doc.id,
+                                         on_evict=self._document_evicted)
+
+        # Directories whose whole content is in the metadata cache,
+        # a cache miss for one of their entries means it does not exist.
+        # Without the changes feed, that is only trusted as long as a
+        # failed lookup.
+        if watch_changes:
+            listing_timeout = None
+        else:
+            listing_timeout = negative_timeout
+
+        self._completeListings = LRUCache(max_size=cache_size / 10 + 1,
+                                          timeout=listing_timeout)
+        self._cachedRevisions = CacheDict(60)
 
         # Instantiate couchdb document helper
-        self.doc_helper = DocumentHelper(SyncDocument, db_name, server, auth=auth, batch=False)
+        if compact_views:
+            doc_class = CompactSyncDocument
+        else:
+            doc_class = SyncDocument
+
+        self.doc_helper = DocumentHelper(doc_class, db_name, server, auth=auth, batch=False)
+
+        self._watcher = None
+        if watch_changes:
+            self._watcher = ChangesWatcher(self.doc_helper.database,
+                                           self._document_changed,
+                                           include_docs=True)
+            self._watcher.start()
 
+        # The metrics are global to the process, so is their dump
+        if config.metrics_dump and not metrics.dumping():
+            metrics.start_dump(config.metrics_dump, config.metrics_dump_interval)
+
+    def _document_changed(self, change):
+        revs = [ rev['rev'] for rev in change.get('changes', []) ]
+
+        # Skip the changes we already know, most likely our own
+        document = self._cachedMetaDatas.find(change['id'])
+        if document is not None and document.rev in revs:
+            return
+
+        if document is not None:
+            self._cachedMetaDatas.invalidate_id(change['id'])
+            self._completeListings.invalidate(document.dirpath)
+
+        # A document may have been created where we cached a negative lookup
+        doc = change.get('doc')
+        if doc and doc.get('doctype') == "SyncDocument":
+            dirpath = doc['dirpath'].encode('utf-8')
+            path = posixpath.join(dirpath, doc['filename'].encode('utf-8'))
+            if self._cachedMetaDatas.has_key(path):
+                self._cachedMetaDatas.invalidate(path)
+            self._completeListings.invalidate(dirpath)
+
+    def _document_evicted(self, path, document):
+        # The listing of the parent directory is not complete anymore
+        if document is not None:
+            self._completeListings.invalidate(document.dirpath)
+
+    def listing_complete(self, path):
+        '''
+        Tell if all the entries of the directory are in the metadata cache.
+        '''
 
+        return self._completeListings.lookup(posixpath.normpath(path))[0]
+
+    def close(self):
+        if self._watcher:
+            self._watcher.stop()
+            self._watcher = None
+
+    def cache_stats(self):
+        return self._cachedMetaDatas.stats()
+
+    def metrics_snapshot(self, reset=False):
+        '''
+        Return the latency statistics of the operations, see ufo.metrics.
+        '''
+
+        return metrics.snapshot(reset)
+
+
+    @operation("makedirs")
     @create
     @normpath
     def makedirs(self, path, mode, uid=None, gid=None):
         updated = []
         p = ""
-        dirs = path.split(os.sep)[1:]
-        for d in dirs:
+        ancestors = []
+        for d in path.split(os.sep)[1:]:
             p += os.sep + d
-            try:
-                self[p]
-            except OSError, e:
+            ancestors.append(p)
+
+        existing, missing = self.get_many(ancestors)
+        for p in ancestors:
+            if not existing.has_key(p):
                 updated.extend(self.mkdir(p, mode, uid, gid))
 
         return updated
 
+    @operation("mkdir")
     @create
     @normpath
     def mkdir(self, path, mode=0700, uid=None, gid=None, document=None):
@@ -507,6 +798,7 @@ class CouchedFileSystem(Debugger):
         
         return updated
 
+    @operation("symlink")
     @norm2path
     @create
     def symlink(self, dest, symlink, uid=None, gid=None, document=None):
@@ -547,6 +839,7 @@ class CouchedFileSystem(Debugger):
 
         return updated
 
+    @operation("chmod")
     @update
     @normpath
     def chmod(self, path, mode):
@@ -564,6 +857,7 @@ class CouchedFileSystem(Debugger):
 
         return self.doc_helper.update(document)
 
+    @operation("chown")
     @update
     @normpath
     def chown(self, path, uid, gid):
@@ -582,6 +876,7 @@ class CouchedFileSystem(Debugger):
 
         return self.doc_helper.update(document)
 
+    @operation("tag")
     @update
     @normpath
     def tag(self, path, tag, remove=False):
@@ -598,6 +893,7 @@ class CouchedFileSystem(Debugger):
 
         return self.doc_helper.update(document)
 
+    @operation("setxattr")
     @update
     @normpath
     def setxattr(self, path, key, value=None, db_only=True):
@@ -617,21 +913,18 @@ class CouchedFileSystem(Debugger):
             from ufo.user import user
             set_acl = False
 
-            old_acl = document.posix_acl
             # If there is any existing ACL, we compute a 'diff'
             # between the old ACL and new one to detect the entry to remove
-            s1 = map(repr, old_acl)
-            s2 = map(repr, new_acl)
-            diff = difflib.context_diff(s1, s2)
-            for ace_str in filter(lambda x: x[0] == '-' and x[-1] != '\n', diff):
-                ace = acl.ACE.from_string(ace_str[2:])
-                if ace.kind & acl.ACL_USER or ace.kind & acl.ACL_GROUP:
+            old_acl = document.frozen_acl
+            changes = acl.diff(old_acl, new_acl)
+            for ace in changes.removed:
+                if ace.kind in (acl.ACL_USER, acl.ACL_GROUP):
                     set_acl = True
 
             # Now we detect if one of the person to share the file with
             # is a not a friend yet, in this case we issue a friend request
             # and do not set the corresponding ACE
-            file_acl = acl.ACL()
+            pending = set()
             for ace in new_acl:
                 if ace.kind & acl.ACL_USER:
                     if ace.qualifier != "public" and not user.friends.has_key(ace.qualifier):
@@ -639,8 +932,9 @@ class CouchedFileSystem(Debugger):
                         if not friend:
                             friend = user.request_friend(ace.qualifier)
                         friend.pending_shares[document.id] = ace.perms.upper().replace('-', '')
-                        self.debug("Adding %s to the pending shares for %s" % (document.id, ace.qualifier))
+                        self.debug("Adding %s to the pending shares for %s", document.id, ace.qualifier)
                         user.friend_helper.update(friend)
+                        pending.add((ace.kind, ace._qualifier))
                         continue
 
                     set_acl = True
@@ -648,15 +942,29 @@ class CouchedFileSystem(Debugger):
                 elif ace.kind & acl.ACL_GROUP:
                     set_acl = True
 
-                file_acl.append(ace)
-
+            # The differences are applied to the old ACL, without the
+            # pending shares, and the mask is computed again
+            changes.added = [ ace for ace in changes.added
+                              if (ace.kind, ace._qualifier) not in pending ]
+            changes.changed = [ (before, after) for before, after in changes.changed
+                                if (after.kind, after._qualifier) not in pending ]
+            file_acl = changes.apply(old_acl)
+
+            # The parent directories must be traversable by everyone
+            # the file is shared with
+            if file_acl:
+                ancestors = []
                 current = document.dirpath
                 while current != os.sep:
-                    parent = self[current]
-                    if not (parent.mode & stat.S_IXOTH):
-                        self.chmod(current, (self[current].mode & 0777) | stat.S_IXOTH)
+                    ancestors.append(current)
                     current = os.path.dirname(current)
 
+                parents, missing = self.get_many(ancestors)
+                for current in ancestors:
+                    parent = parents.get(current) or self[current]
+                    if not (parent.mode & stat.S_IXOTH):
+                        self.chmod(current, (parent.mode & 0777) | stat.S_IXOTH)
+
             if value != None:
                 if not set_acl:
                     return []
@@ -695,6 +1003,7 @@ class CouchedFileSystem(Debugger):
 
         return self.doc_helper.update(document)
 
+    @operation("getxattr")
     @normpath
     def getxattr(self, path, key):
         '''
@@ -707,13 +1016,14 @@ class CouchedFileSystem(Debugger):
             return acl.ACL.from_mode(0700)
 
         elif key == "system.posix_acl_access":
-            return document.posix_acl.to_xattr()
+            return document.frozen_acl.to_xattr()
 
         if type(document.xattrs[key]) == unicode:
             return eval(repr(document.xattrs[key])[1:])
         else:
             return document.xattrs[key]
 
+    @operation("listxattr")
     @normpath
     def listxattr(self, path):
         '''
@@ -723,6 +1033,7 @@ class CouchedFileSystem(Debugger):
         return [ "system.posix_acl_default",
                  "system.posix_acl_access" ] + self[path].xattrs.keys()
         
+    @operation("utime")
     @update
     @normpath
     def utime(self, path, times):
@@ -743,22 +1054,27 @@ class CouchedFileSystem(Debugger):
 
         return self.doc_helper.update(document)
 
+    @operation("rename")
     @rename
     @norm2path
-    def rename(self, old, new, overwrite=False):
+    def rename(self, old, new, overwrite=False, progress=None):
         '''
         Call type : "Update"
+
+        The documents of a directory subtree are streamed from the database
+        and sent back by chunks, 'progress' is called with the number of
+        subtree documents renamed so far.
         '''
 
         # Updating directory and filename of the document
-        document = self[old]
-        try:
-            dest = self[new]
-            if not overwrite:
-                raise OSError(errno.EEXIST, os.strerror(errno.EEXIST))
+        documents, missing = self.get_many([old, new])
+        document = documents.get(old) or self[old]
 
-        except Exception, e:
-            dest = None
+        # An existing destination is only taken into account when
+        # overwriting, it is silently replaced otherwise
+        dest = None
+        if overwrite:
+            dest = documents.get(new)
 
         if dest and stat.S_ISDIR(dest.mode):
             document.dirpath = new
@@ -767,23 +1083,31 @@ class CouchedFileSystem(Debugger):
             document.filename = posixpath.basename(new)
             document.dirpath  = posixpath.dirname(new)
 
-        documents = [ document ]
-
         if dest:
             self.unlink(new)
 
         # Firstly rename the file on the filesystem
         self.realfs.rename(old, new)
 
+        documents = self.doc_helper.update(document)
+
         # Updating directory subtree documents
         if stat.S_ISDIR(document.mode):
-            # TODO: make this smarter
-            for doc in self.doc_helper.by_dir_prefix(key=old):
-                doc.dirpath = doc.dirpath.replace(old, new, 1)
-                documents.append(doc)
+            def renamed_subtree():
+                for doc in self.doc_helper.iterview('by_dir_prefix', self.page_size,
+                                                    prefetch=True, key=old,
+                                                    wrapper=self.doc_helper.doc_class._wrap_row):
+                    doc.dirpath = doc.dirpath.replace(old, new, 1)
+                    yield doc
+
+            self.doc_helper.bulk_update(renamed_subtree(),
+                                        chunk_size=self.bulk_size,
+                                        workers=self.bulk_workers,
+                                        progress=progress)
 
-        return self.doc_helper.update(documents)
+        return documents
 
+    @operation("unlink")
     @delete
     @normpath
     def unlink(self, path, nodb=False):
@@ -805,11 +1129,16 @@ class CouchedFileSystem(Debugger):
 
         return []
 
+    @operation("rmdir")
     @delete
     @normpath
-    def rmdir(self, path, nodb=False, force=False):
+    def rmdir(self, path, nodb=False, force=False, progress=None):
         '''
         Call type : "Update"
+
+        The documents of the subtree are deleted with _bulk_docs requests,
+        'progress' is called with the number of documents deleted so far.
+        Only the document of the directory itself is returned.
         '''
 
         deleted = []
@@ -823,20 +1152,49 @@ class CouchedFileSystem(Debugger):
         if not nodb:
             folder = self[path]
 
-            # Updating directory subtree documents  
-            if stat.S_ISDIR(folder.mode):
-
-                # TODO: make this smarter
-                for doc in self.doc_helper.by_dir_prefix(key=path):
-                    self.doc_helper.delete(doc)
-                    deleted.append(doc)
+            # Updating directory subtree documents, unless the directory
+            # is known to be empty: its listing is complete and none of
+            # its entries is cached, which is only reliable when following
+            # the changes made by the other clients
+            known_empty = self._watcher is not None and self.listing_complete(path) and \
+                          not self._cachedMetaDatas.has_prefix(path + '/')
+            if stat.S_ISDIR(folder.mode) and not known_empty:
+                def deletion_stub(row):
+                    return { '_id' : row.id, '_rev' : row.value, '_deleted' : True }
+
+                try:
+                    self.doc_helper.bulk_update(self.doc_helper.iterview('revs_by_dir_prefix',
+                                                                         self.page_size,
+                                                                         prefetch=True,
+                                                                         wrapper=deletion_stub,
+                                                                         key=path),
+                                                chunk_size=self.bulk_size,
+                                                workers=self.bulk_workers,
+                                                progress=progress)
+
+                except BulkUpdateError, e:
+                    # Some documents of the subtree are gone
+                    self._cachedMetaDatas.invalidate_prefix(path + '/')
+                    self._completeListings.invalidate(path)
+                    self._completeListings.invalidate_prefix(path + '/')
+                    raise
 
+            if stat.S_ISDIR(folder.mode):
                 # Then remove the document from the database
                 self.doc_helper.delete(folder)
                 deleted.append(folder)
 
         return deleted
 
+    @operation("rmtree")
+    def rmtree(self, path, nodb=False, progress=None):
+        '''
+        Call type : "Update"
+        '''
+
+        return self.rmdir(path, nodb, force=True, progress=progress)
+
+    @operation("stat")
     @normpath
     def stat(self, path):
         '''
@@ -845,6 +1203,7 @@ class CouchedFileSystem(Debugger):
 
         return self[path].get_stats()
 
+    @operation("listdir")
     @read
     @normpath
     def listdir(self, path):
@@ -855,6 +1214,7 @@ class CouchedFileSystem(Debugger):
         for doc in self.doc_helper.by_dir(key=path):
             yield doc
 
+    @operation("truncate")
     @normpath
     @update  
     def truncate(self, path, length):
@@ -867,11 +1227,45 @@ class CouchedFileSystem(Debugger):
 
         return self.doc_helper.update(document)
 
+    @operation("readdirplus")
+    @normpath
+    def readdirplus(self, path):
+        '''
+        Call type : "Read"
+
+        Return the (name, stats) tuples of the entries of a directory
+        with a single database request, and load their documents into
+        the metadata cache so that the following stat calls are free.
+        '''
+
+        documents = list(self.doc_helper.by_dir(key=path))
+
+        if self.caching:
+            self._cachedMetaDatas.acquire()
+            try:
+                for doc in documents:
+                    self._cachedMetaDatas.cache(doc.path, doc)
+
+                # Do not pretend to know a directory that does not fit in
+                # the cache, or that may not exist: an empty listing is
+                # only complete if the directory itself is known
+                exists = documents or path == '/' or \
+                         self._cachedMetaDatas.lookup(path)[1] is not None
+                if exists and len(documents) < self._cachedMetaDatas.max_size / 2:
+                    self._completeListings.cache(path, True)
+
+            finally:
+                self._cachedMetaDatas.release()
+
+        return [ (doc.filename, doc.get_stats()) for doc in documents ]
+
+    @operation("open")
     @create_file
     @normpath
     def open(self, path, flags, uid=None, gid=None, mode=0700, document=None):
         return CouchedFile(path, flags, uid, gid, mode, self, document)
 
+    @operation("populate")
     @create
     @normpath
     def populate(self, path):
@@ -880,7 +1274,7 @@ class CouchedFileSystem(Debugger):
         '''
 
         stats = self.realfs.lstat(path)
-        mimetype = self.realfs.get_mime_type(path).basic()
+        mimetype = self.realfs.get_mime_type(path, stats=stats).basic()
 
         fields = { 'filename' : posixpath.basename(path),
                    'dirpath'  : posixpath.dirname(path),
@@ -890,6 +1284,18 @@ class CouchedFileSystem(Debugger):
 
         return [ self.doc_helper.create(**fields) ]
 
+    def populate_tree(self, path='/', processes=None, checkpoint=None, progress=None):
+        '''
+        Call type : "Create"
+
+        Create the documents of all the files below 'path' that do not have
+        one yet, see ufo.importer.Importer.
+        '''
+
+        from ufo.importer import Importer
+
+        return Importer(self, processes, checkpoint).run(path, progress)
+
     @normpath
     def walk(self, top, topdown=True, onerror=None, followlinks=False):
         # Copied from Python 'os' module
@@ -902,7 +1308,7 @@ class CouchedFileSystem(Debugger):
         try:
             # Note that listdir and error are globals in this module due
             # to earlier import-*.
-            names = self.doc_helper.by_dir(key=top)
+            names = self.doc_helper.by_dir(key=top, page_size=self.page_size)
                                 
         except error, err:
             if onerror is not None:
@@ -925,6 +1331,69 @@ class CouchedFileSystem(Debugger):
         if not topdown:
             yield self[top], dirs, nondirs
 
+    @operation("get_many")
+    def get_many(self, paths):
+        '''
+        Call type : "Read"
+
+        Resolve several paths with at most one database request, returns
+        a dict of the found documents indexed by path and the list of the
+        missing paths. The metadata cache is filled with the results.
+        '''
+
+        found = {}
+        missing = []
+        unknown = []
+        for path in set(map(posixpath.normpath, paths)):
+            if path == '/':
+                found[path] = self._get(path)
+                continue
+
+            cached, document = self._cachedMetaDatas.lookup(path)
+            if not cached and self._completeListings.lookup(posixpath.dirname(path))[0]:
+                cached = True
+
+            metrics.cached(cached)
+
+            if not cached:
+                unknown.append(path)
+            elif document is None:
+                missing.append(path)
+            else:
+                found[path] = document
+
+        if unknown:
+            documents = self.doc_helper.get_many('by_path', unknown)
+            for path in unknown:
+                document = documents.get(path)
+                self._cachedMetaDatas.cache(path, document)
+                if document is None:
+                    missing.append(path)
+                else:
+                    found[path] = document
+
+        return found, missing
+
+    @operation("search")
+    def search(self, query, prefix=False, limit=50, skip=0):
+        '''
+        Call type : "Read"
+
+        Return the documents whose filename contains, or starts with if
+        'prefix' is set, the given query.
+        '''
+
+        if self._filename_index is None:
+            from ufo.search import FilenameIndex
+            self._filename_index = FilenameIndex(self.doc_helper.database, self.server,
+                                                 auth=self.auth)
+
+        if prefix:
+            return self._filename_index.search_prefix(query, limit, skip)
+
+        return self._filename_index.search(query, limit, skip)
+
+    @operation("exists")
     @normpath
     def exists(self, path):
         try:
@@ -939,7 +1408,14 @@ class CouchedFileSystem(Debugger):
         if path == '/':
             return RootSyncDocument(self.realfs.lstat(path))
                   
-        if self._cachedMetaDatas.isObsolete(path):
+        found, document = self._cachedMetaDatas.lookup(path)
+        if not found and self._completeListings.lookup(posixpath.dirname(path))[0]:
+            self._cachedMetaDatas.cache(path, None)
+            found = True
+
+        metrics.cached(found)
+
+        if not found:
             try:
                 document = self.doc_helper.by_path(key=path, pk=True)
                 self._cachedMetaDatas.cache(path, document)
@@ -949,18 +1425,38 @@ class CouchedFileSystem(Debugger):
                 self._cachedMetaDatas.cache(path, None)
                 raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
 
-        if self._cachedMetaDatas.get(path):
-            return self._cachedMetaDatas.get(path)
+        if document is not None:
+            return document
 
         raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
 
+    @operation("usage")
+    @normpath
+    def usage(self, path):
+        '''
+        Call type : "Read"
+
+        Return the number of bytes, files and directories contained in
+        a directory subtree, as maintained by the usage_by_dir view.
+        '''
+
+        # Raise ENOENT for a missing directory
+        self[path]
+
+        size, files, directories = 0, 0, 0
+        for key, value in self.doc_helper.usage_by_dir(key=path, reduce=True):
+            size, files, directories = value
+
+        return { 'bytes' : size, 'files' : files, 'directories' : directories }
+
     @normpath
     def du(self, path):
-        try:
-            return self.doc_helper.by_dir_prefix(key=path, pk=True, reduce=True)['value']
-        except:
-            return 0
+        return self.usage(path)['bytes']
+
+    def df(self):
+        return self.usage('/')
 
+    @operation("copy")
     def copy(self, src, dest, document=None):
         return self.realfs.copy(src, dest, document)
 
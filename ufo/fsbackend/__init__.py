@@ -82,8 +82,8 @@ class GenericFileSystem(Debugger):
         os.ftruncate(fd, length)
         os.close(fd)
 
-    def get_mime_type(self, path):
-        return MimeType(self.real_path(path))
+    def get_mime_type(self, path, buffer=None, stats=None):
+        return MimeType(self.real_path(path), buffer, stats)
 
     def removexattr(self, path, key):
         import xattr
@@ -5,11 +5,14 @@ import errno
 import httplib
 import simplejson
 import base64
+import socket
+import weakref
+import threading
 
 import ufo.acl as acl
 import ufo.auth
 from ufo.fsbackend import GenericFileSystem
-from ufo.utils import MutableStat
+from ufo.utils import MutableStat, LRUCache
 
 from webdav.WebdavResponse import PropertyResponse
 from webdav import WebdavClient
@@ -77,11 +80,55 @@ class GrantAcl(ChangeAcl):
 
 
 class WebDAVFile:
-    def __init__(self, resource, flags, mode):
+    '''
+    File handle on a WebDAV resource.
+
+    Reads are served from a ranged GET response kept open on a connection
+    dedicated to the handle, as long as they are sequential, and the
+    response is consumed by chunks of 'readahead' bytes. A read at another
+    offset closes the stream and sends a single range request, a new stream
+    being opened once the reads are sequential again.
+
+    Contiguous writes are buffered and sent by ranged PUT requests of up to
+    'write_chunk_size' bytes, when the buffer is full, on a read or a write
+    elsewhere, and on 'flush', 'fsync' or 'close'. With 'chunked_upload',
+    a file written sequentially from its beginning is instead uploaded by a
+    single PUT request with a chunked body, that is ended on close.
+    '''
+
+    readahead = 256 * 1024
+
+    # Number of consecutive reads needed to switch to streaming
+    sequential_threshold = 2
+
+    write_chunk_size = 4 * 1024 * 1024
+    chunked_upload = False
+
+    def __init__(self, resource, flags, mode, filesystem=None, path=None):
         self.flags = flags
         self.mode = mode
         self.offset = 0
         self.resource = resource
+        self.filesystem = filesystem
+        self.path = path
+
+        self._size = None
+        self._lock = threading.Lock()
+
+        self._connection = None
+        self._stream = None
+        self._buffer = ""
+        self._buffer_offset = 0
+        self._last_read = None
+        self._sequential = 0
+
+        self._pending = []
+        self._pending_offset = 0
+        self._pending_length = 0
+        self._upload = False
+
+        if flags & os.O_TRUNC:
+            self._size = 0
 
     def seek(self, offset, whence=0):
         if whence == 0:
@@ -89,25 +136,279 @@ class WebDAVFile:
         elif whence == 1:
             self.offset += offset
         else:
-            self.offset = self.size - offset
+            self.offset = self.size + offset
+
+    def tell(self):
+        return self.offset
 
     @property
     def size(self):
-        return 0
+        if self._size is None:
+            if self.filesystem:
+                try:
+                    self._size = self.filesystem.lstat(self.path).st_size
+                except OSError, e:
+                    # Created by O_CREAT, the resource only exists
+                    # once written
+                    if e.errno != errno.ENOENT or not self.flags & os.O_CREAT:
+                        raise
+                    self._size = 0
+            else:
+                self._size = 0
+        return self._size
 
-    @davexcept_to_errno
     def write(self, data):
+        if self.filesystem is None:
+            return self._write_resource(data)
+
+        self._lock.acquire()
+        try:
+            self._close_stream()
+            self._buffer = ""
+
+            if self._pending and self.offset != self._pending_offset + self._pending_length:
+                self._flush()
+
+            if not self._pending:
+                self._pending_offset = self.offset
+
+            self._pending.append(data)
+            self._pending_length += len(data)
+            self.offset += len(data)
+            self._size = max(self.size, self.offset)
+
+            if self._pending_length >= self.write_chunk_size:
+                self._flush()
+
+            return len(data)
+
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self._flush()
+
+        finally:
+            self._lock.release()
+
+    def fsync(self, isfsyncfile=None):
+        self._lock.acquire()
+        try:
+            self._flush()
+            self._end_upload()
+
+        finally:
+            self._lock.release()
+
+    def _flush(self):
+        if not self._pending:
+            return
+
+        data = "".join(self._pending)
+        offset = self._pending_offset
+        self._pending = []
+        self._pending_length = 0
+
+        if self._upload and offset != self._upload:
+            self._end_upload()
+
+        if self.chunked_upload and (self._upload or (offset == 0 and self._size == len(data))):
+            # Sequential writes from the beginning, keep sending the body
+            if not self._upload:
+                self._start_upload()
+            self._connection.send("%x\r\n%s\r\n" % (len(data), data))
+            self._upload = offset + len(data)
+            return
+
+        self._end_upload()
+        self._put(data, { "Content-Range" : "bytes %d-%d/%d"
+                                            % (offset, offset + len(data) - 1, self._size) })
+
+    def _start_upload(self):
+        if self._connection is None:
+            self._connection = self.filesystem.get_connection()
+
+        self._connection.putrequest("PUT", self.resource.path)
+        self._connection.putheader("Transfer-Encoding", "chunked")
+        self._connection.endheaders()
+
+    def _end_upload(self):
+        if not self._upload:
+            return
+
+        self._upload = False
+        self._connection.send("0\r\n\r\n")
+        self._check_response(self._connection.getresponse())
+        self.filesystem.invalidate(self.path)
+
+    def _put(self, data, headers):
+        self._check_response(self._send("PUT", data, headers))
+        self.filesystem.invalidate(self.path)
+
+    def _send(self, method, body=None, headers={}):
+        '''
+        Send a request on the connection of the handle and return the
+        response. A connection that already served requests may have been
+        closed by the server since, the request is then sent once again on
+        a new connection, which is fine for the GET and the ranged PUT
+        requests that are idempotent.
+        '''
+
+        if self._connection is None:
+            self._connection = self.filesystem.get_connection()
+
+        reused = getattr(self._connection, "sock", None) is not None
+        try:
+            self._connection.request(method, self.resource.path, body, headers)
+            return self._connection.getresponse()
+
+        except (httplib.BadStatusLine, socket.error), e:
+            if not reused or (isinstance(e, socket.error) and
+                              e.errno not in (errno.EPIPE, errno.ECONNRESET)):
+                raise
+
+            self._connection.close()
+            self._connection.request(method, self.resource.path, body, headers)
+            return self._connection.getresponse()
+
+    def _check_response(self, response):
+        response.read()
+        if response.status >= 400:
+            raise OSError(dav_errors_mappings.get(response.status, errno.EIO),
+                          "%s: %s" % (self.path, response.reason))
+
+    @davexcept_to_errno
+    def _write_resource(self, data):
         length = len(data)
-        extra_hdrs= { "Content-Range" : "bytes %d-%d/%d" % (self.offset, self.offset + length, self.size) }
+        extra_hdrs= { "Content-Range" : "bytes %d-%d/%d" % (self.offset, self.offset + length - 1,
+                                                             max(self.size, self.offset + length)) }
         self.resource.uploadContent(data, extra_hdrs=extra_hdrs)
         self.offset += length
         return length
 
-    @davexcept_to_errno
     def read(self, length=None):
+        self._lock.acquire()
+        try:
+            if self.filesystem is None:
+                return self._read_resource(length)
+
+            # Read what was written
+            self._flush()
+            self._end_upload()
+
+            if self._size is not None and self.offset >= self._size:
+                data = ""
+
+            elif length is None:
+                data = self._read_range(self.offset, None)
+
+            else:
+                if self._last_read == self.offset:
+                    self._sequential += 1
+                else:
+                    self._sequential = 0
+
+                start = self.offset - self._buffer_offset
+                end = self._buffer_offset + len(self._buffer)
+
+                if start >= 0 and self.offset + length <= end:
+                    data = self._buffer[start:start + length]
+
+                elif self._stream and start >= 0 and self.offset <= end:
+                    data = self._read_stream(length)
+
+                elif self._sequential >= self.sequential_threshold:
+                    self._open_stream(self.offset)
+                    data = self._read_stream(length)
+
+                else:
+                    data = self._read_range(self.offset, length)
+
+            self.offset += len(data)
+            self._last_read = self.offset
+            return data
+
+        finally:
+            self._lock.release()
+
+    def _read_stream(self, length):
+        data = self._buffer[self.offset - self._buffer_offset:]
+        while len(data) < length and self._stream:
+            chunk = self._stream.read(max(length - len(data), self.readahead))
+            if not chunk:
+                # The end of the stream is the end of the file
+                self._size = self._buffer_offset + len(self._buffer)
+                self._close_stream()
+                break
+
+            self._buffer_offset += len(self._buffer)
+            self._buffer = chunk
+            data += chunk
+
+        return data[:length]
+
+    def _open_stream(self, offset):
+        self._close_stream()
+        self._stream = self._request(offset, None)
+        self._buffer = ""
+        self._buffer_offset = offset
+
+    def _close_stream(self):
+        if self._stream is not None:
+            if not self._stream.isclosed():
+                # The rest of the body is pending, the connection can not
+                # be reused as is
+                self._connection.close()
+            self._stream = None
+
+    def _read_range(self, offset, length):
+        self._close_stream()
+        response = self._request(offset, length)
+        if response is None:
+            return ""
+
+        data = response.read(length)
+        if not response.isclosed():
+            self._connection.close()
+        return data
+
+    def _request(self, offset, length):
+        headers = {}
+        if length is not None:
+            headers["Range"] = "bytes=%d-%d" % (offset, offset + length - 1)
+        elif offset:
+            headers["Range"] = "bytes=%d-" % offset
+
+        response = self._send("GET", headers=headers)
+
+        if response.status == 416:
+            # Reading past the end of the file
+            response.read()
+            return None
+
+        if response.status >= 400:
+            response.read()
+            raise OSError(dav_errors_mappings.get(response.status, errno.EIO),
+                          "%s: %s" % (self.path, response.reason))
+
+        if response.status != 206 and offset:
+            # The server ignored the range
+            skipped = 0
+            while skipped < offset:
+                chunk = response.read(min(offset - skipped, self.readahead))
+                if not chunk:
+                    break
+                skipped += len(chunk)
+
+        return response
+
+    @davexcept_to_errno
+    def _read_resource(self, length):
         headers = {}
         if length:
-            headers["Range"] = "bytes=%d-%d" % (self.offset, self.offset + length)
+            headers["Range"] = "bytes=%d-%d" % (self.offset, self.offset + length - 1)
         try:
             data = self.resource.downloadContent(headers).read(length)
         except httplib.IncompleteRead, e:
@@ -116,17 +417,164 @@ class WebDAVFile:
         return data
 
     def close(self):
-        pass
+        self._lock.acquire()
+        try:
+            if self.filesystem is None:
+                return
+
+            try:
+                self._flush()
+                self._end_upload()
+
+            except:
+                # The connection may be in the middle of a request
+                if self._connection is not None:
+                    self._connection.close()
+                raise
+
+            finally:
+                self._upload = False
+                self._close_stream()
+                if self._connection is not None:
+                    self.filesystem.release_connection(self._connection)
+                    self._connection = None
+                self._buffer = ""
+
+        finally:
+            self._lock.release()
 
 
 class WebDAVFileSystem(GenericFileSystem):
+    # Number of idle connections kept for the file handles
+    max_idle_connections = 8
+
+    # Number of storer objects kept by every thread, and number of seconds
+    # the stats of a file are cached, they are also invalidated by our own
+    # changes
+    storers_cache_size = 1000
+    stats_timeout = 5
+
     def __init__(self, url, auth=None):
         self.url = url
-        self.client = WebdavClient.CollectionStorer(url)
-        self.connection = self.client.connection
+        self.auth = auth
         self.locks = {}
-        if auth:
-            auth.bind(self.connection, "webdav")
+        self.idle_connections = []
+        self.connections_lock = threading.Lock()
+        self.local = threading.local()
+        self.storer_caches = weakref.WeakSet()
+        self.stats = LRUCache(max_size=self.storers_cache_size * 10,
+                              timeout=self.stats_timeout,
+                              negative_timeout=self.stats_timeout)
+
+    def _storers(self):
+        '''
+        Return the storer caches of the current thread. Its storers share
+        a connection of their own, a connection can not be used by several
+        threads at once.
+        '''
+
+        local = self.local
+        if not hasattr(local, "connection"):
+            local.connection = WebdavClient.CollectionStorer(self.url).connection
+            if self.auth:
+                self.auth.bind(local.connection, "webdav")
+
+            local.resources = LRUCache(max_size=self.storers_cache_size)
+            local.collections = LRUCache(max_size=self.storers_cache_size)
+
+            # Known to 'invalidate' as long as the thread is alive
+            self.connections_lock.acquire()
+            try:
+                self.storer_caches.add(local.resources)
+                self.storer_caches.add(local.collections)
+
+            finally:
+                self.connections_lock.release()
+
+        return local
+
+    def _resource(self, path):
+        local = self._storers()
+        storer = local.resources.get(path)
+        if storer is None:
+            storer = WebdavClient.ResourceStorer(self.url + path, local.connection)
+            local.resources.cache(path, storer)
+        return storer
+
+    def _collection(self, path):
+        local = self._storers()
+        storer = local.collections.get(path)
+        if storer is None:
+            storer = WebdavClient.CollectionStorer(self.url + path, local.connection)
+            local.collections.cache(path, storer)
+        return storer
+
+    def invalidate(self, path, subtree=False):
+        '''
+        Forget what is cached about a path, and about its parent directory
+        whose stats change too.
+        '''
+
+        for path in (path, os.path.dirname(path)):
+            self.stats.invalidate(path)
+
+        if subtree:
+            self.connections_lock.acquire()
+            try:
+                caches = list(self.storer_caches)
+
+            finally:
+                self.connections_lock.release()
+
+            for cache in [ self.stats ] + caches:
+                cache.invalidate(path)
+                cache.invalidate_prefix(path.rstrip('/') + '/')
+
+    @staticmethod
+    def _parse_stats(element):
+        stats = MutableStat()
+        for item in element.children:
+            if item.name.endswith("time"):
+                setattr(stats, item.name, float(item.textof()))
+            else:
+                setattr(stats, item.name, int(item.textof()))
+        return stats
+
+    def get_connection(self):
+        '''
+        Return a connection for the exclusive use of a file handle,
+        to give back with 'release_connection'.
+        '''
+
+        self.connections_lock.acquire()
+        try:
+            if self.idle_connections:
+                return self.idle_connections.pop()
+
+        finally:
+            self.connections_lock.release()
+
+        scheme, netloc = urlparse.urlsplit(self.url)[:2]
+        if scheme == "https":
+            connection = httplib.HTTPSConnection(netloc)
+        else:
+            connection = httplib.HTTPConnection(netloc)
+
+        if self.auth:
+            self.auth.bind(connection, "webdav")
+
+        return connection
+
+    def release_connection(self, connection):
+        self.connections_lock.acquire()
+        try:
+            if len(self.idle_connections) < self.max_idle_connections:
+                self.idle_connections.append(connection)
+            else:
+                connection.close()
+
+        finally:
+            self.connections_lock.release()
 
     def real_path(self, path):
         return path
@@ -140,30 +588,65 @@ class WebDAVFileSystem(GenericFileSystem):
 
     @davexcept_to_errno
     def mkdir(self, path, mode=0700, document=None, *args, **kw):
-        col = WebdavClient.CollectionStorer(self.url + os.path.dirname(path), self.connection)
+        col = self._collection(os.path.dirname(path))
         col.addCollection(os.path.basename(path), extra_hdrs=self._document_to_headers(document))
+        self.invalidate(path)
 
     @davexcept_to_errno
     def rmdir(self, path, *args, **kw):
-        col = WebdavClient.CollectionStorer(self.url + os.path.dirname(path), self.connection)
+        col = self._collection(os.path.dirname(path))
         col.deleteResource(os.path.basename(path))
+        self.invalidate(path, subtree=True)
 
     @davexcept_to_errno
     def unlink(self, path, *args, **kw):
-        col = WebdavClient.CollectionStorer(self.url + os.path.dirname(path), self.connection)
+        col = self._collection(os.path.dirname(path))
         col.deleteResource(os.path.basename(path))
+        self.invalidate(path)
 
-    @davexcept_to_errno
     def lstat(self, path):
-        storer = WebdavClient.ResourceStorer(self.url + path, self.connection)
-        stats = MutableStat()
-        for item in storer.readProperty(NS_MY, "stats").children:
-            if item.name.endswith("time"):
-                setattr(stats, item.name, float(item.textof()))
-            else:
-                setattr(stats, item.name, int(item.textof()))
+        found, stats = self.stats.lookup(path)
+        if not found:
+            try:
+                stats = self._lstat(path)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    self.stats.cache(path, None)
+                raise
+            self.stats.cache(path, stats)
+
+        elif stats is None:
+            raise OSError(errno.ENOENT, "No such file or directory: '%s'" % path)
+
         return stats
 
+    @davexcept_to_errno
+    def _lstat(self, path):
+        return self._parse_stats(self._resource(path).readProperty(NS_MY, "stats"))
+
+    @davexcept_to_errno
+    def listdir(self, path):
+        '''
+        Return the names of the files of a directory, fetching their
+        stats in the same PROPFIND request to answer the following lstat.
+        '''
+
+        base = urlparse.urlsplit(self.url + path.rstrip('/'))[2].rstrip('/')
+        names = []
+        for href, properties in self._collection(path).findProperties((NS_MY, "stats")).items():
+            href = urllib.unquote(urlparse.urlsplit(href)[2]).rstrip('/')
+            if href == base or not href.startswith(base + '/'):
+                continue
+
+            name = href[len(base) + 1:]
+            names.append(name)
+
+            element = properties.get((NS_MY, "stats"))
+            if element is not None:
+                self.stats.cache(os.path.join(path, name), self._parse_stats(element))
+
+        return names
+
     @davexcept_to_errno
     def chmod(self, path, mode):
         pass
@@ -175,53 +658,61 @@ class WebDAVFileSystem(GenericFileSystem):
 
     @davexcept_to_errno
     def copy(self, src, dest, document=None):
-        storer = WebdavClient.ResourceStorer(self.url + dest, self.connection)
+        storer = self._resource(dest)
         storer.uploadFile(src, extra_hdrs=self._document_to_headers(document))
+        self.invalidate(dest)
 
-    def get_mime_type(self, path):
+    def get_mime_type(self, path, buffer=None, stats=None):
         raise Exception("Not implemented")
 
     @davexcept_to_errno
     def set_acl(self, path, posix_acl):
         users = []
         webdav_acl = GrantAcl(posix_acl)
-        storer = WebdavClient.ResourceStorer(self.url + path, self.connection)
+        storer = self._resource(path)
         storer.setAcl(webdav_acl)
 
     @davexcept_to_errno
     def get_acl(self, path):
-        storer = WebdavClient.ResourceStorer(self.url + path, self.connection)
+        storer = self._resource(path)
         storer.getAcl()
 
     @davexcept_to_errno
     def rename(self, old, new):
-        storer = WebdavClient.ResourceStorer(self.url + old, self.connection)
+        storer = self._resource(old)
         storer.move(self.url + new)
+        self.invalidate(old, subtree=True)
+        self.invalidate(new, subtree=True)
 
     @davexcept_to_errno
     def symlink(self, src, dst, document=None):
-        storer = WebdavClient.ResourceStorer(self.url + dst, self.connection)
+        storer = self._resource(dst)
         storer.mkRedirectRef(self.url + src, extra_hdrs=self._document_to_headers(document))
+        self.invalidate(dst)
 
     @davexcept_to_errno
     def open(self, path, flags, mode=0700):
-        return WebDAVFile(WebdavClient.ResourceStorer(self.url + path, self.connection), flags, mode)
+        if flags & (os.O_CREAT | os.O_TRUNC):
+            self.invalidate(path)
+        return WebDAVFile(self._resource(path),
+                          flags, mode, self, path)
 
     @davexcept_to_errno
     def ftruncate(self, path, length):
-        storer = WebdavClient.ResourceStorer(self.url + path, self.connection)
+        storer = self._resource(path)
         storer.writeProperties({ (NS_MY, "size") : str(length) })
+        self.invalidate(path)
 
     @davexcept_to_errno
     def lock(self, path):
-        storer = WebdavClient.ResourceStorer(self.url + path, self.connection)
+        storer = self._resource(path)
         lock = storer.lock(PRINCIPALS_BASE + str(os.getuid()))
         self.locks[path] = lock
         return lock
 
     @davexcept_to_errno
     def unlock(self, path):
-        storer = WebdavClient.ResourceStorer(self.url + path, self.connection)
+        storer = self._resource(path)
         lock = self.locks.get(path)
         if lock:
             del self.locks[path]
@@ -1,24 +1,69 @@
+import os
+import errno
 import subprocess
 from ufo.fsbackend import GenericFileSystem
+from ufo.acl import NFS4_ACL_XATTR
 
 patched_acl = False
 
 class NFS4FileSystem(GenericFileSystem):
+    # Whether the NFSv4 ACL extended attribute can be written directly,
+    # probed on the first ACL change
+    native_acl = None
+
     def set_acl(self, path, acl):
+        self.set_acl_many([ path ], acl)
+
+    def set_acl_many(self, paths, acl):
+        '''
+        Set the same ACL on several files, encoding it only once.
+        '''
+
         if patched_acl:
+            from ufo.user import user
+
             # We just set the whole set of ACL's on the remote file by using... setfacl
-            # NFSv4 uses special ACLs so we need a patched version of getfacl/setfacl
-            input = "# file: %s\n# owner: %s\n# group: %s\n%s\n" % \
-                    (path, user.login, user.login, repr(acl))
-            process = subprocess.Popen([ "setfacl", "--restore=-" ],
-                                       stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-            _, err = process.communicate(input)
+            # NFSv4 uses special ACLs so we need a patched version of getfacl/setfacl,
+            # which must not be bypassed by writing the attribute directly
+            text = repr(acl)
+            for path in paths:
+                self._setfacl([ "setfacl", "--restore=-" ],
+                              "# file: %s\n# owner: %s\n# group: %s\n%s\n" % \
+                              (path, user.login, user.login, text))
+
+        elif self.supports_native_acl():
+            import xattr
+            value = acl.to_nfs4_xattr()
+            for path in paths:
+                xattr.setxattr(self.real_path(path), NFS4_ACL_XATTR, value)
 
         else:
-            # TODO: Convert the POSIX ACL to an NFS4 ACL using Python bindings
-            process = subprocess.Popen([ "nfs4_setfacl", "-S", "-", self.real_path(path) ],
-                                       stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-            _, err = process.communicate(acl.to_nfs4())
+            text = acl.to_nfs4()
+            for path in paths:
+                self._setfacl([ "nfs4_setfacl", "-S", "-", self.real_path(path) ], text)
+
+    def supports_native_acl(self):
+        if self.native_acl is None:
+            try:
+                import xattr
+                xattr.getxattr(self.mount_point, NFS4_ACL_XATTR)
+                self.native_acl = True
+
+            except ImportError:
+                self.native_acl = False
+
+            except (IOError, OSError), e:
+                # No ACL yet is fine, an unknown attribute is not
+                self.native_acl = e.errno == errno.ENODATA
+
+            self.debug("Native NFSv4 ACL support on %s: %s",
+                       self.mount_point, self.native_acl)
+
+        return self.native_acl
+
+    def _setfacl(self, args, input):
+        process = subprocess.Popen(args, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = process.communicate(input)
 
         if err:
             raise OSError(process.returncode, err)
@@ -40,4 +85,3 @@ class NFS4FileSystem(GenericFileSystem):
             return True
 
         return False
-
@@ -0,0 +1,275 @@
+# Copyright (C) 2010  Agorabox. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''UFO bulk import of an existing tree into the database.'''
+
+import os
+import stat
+import time
+import multiprocessing
+from uuid import uuid4
+
+# Fuse paths are UNIX-like whatever the operating system
+import posixpath
+
+from ufo.debugger import Debugger
+from ufo.database import BulkUpdateError
+from ufo.utils import mime_detector
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+def _detect_mime_type(path):
+    # Run in the processes of the pool, that each load their own libmagic
+    try:
+        return mime_detector.detect(path)
+    except Exception:
+        return "application/octet-stream"
+
+def _decode(name):
+    # The walked paths are raw bytes, the documents hold unicode
+    if isinstance(name, str):
+        return name.decode('utf-8')
+    return name
+
+def _path_key(path):
+    # Order of the paths in a depth first walk of sorted directories
+    return path.split('/')
+
+
+class Importer(Debugger):
+    '''
+    Create the documents of all the files of an existing tree of the real
+    filesystem.
+
+    The tree is walked depth first in the order of the sorted filenames,
+    by batches of 'batch_size' files. The paths of a batch that already
+    have a document are skipped, the mimetypes of the others are detected
+    in a pool of 'processes' processes, and their documents are sent with
+    _bulk_docs requests. The last path of every batch written is saved in
+    the 'checkpoint' file, if given, and the walk resumes after it when the
+    import is run again.
+    '''
+
+    batch_size = 5000
+
+    # Number of seconds between two throughput reports
+    report_interval = 10
+
+    def __init__(self, filesystem, processes=None, checkpoint=None):
+        self.filesystem = filesystem
+        self.doc_helper = filesystem.doc_helper
+        self.realfs = filesystem.realfs
+        self.processes = processes
+        self.checkpoint = checkpoint
+
+        self.scanned = 0
+        self.skipped = 0
+        self.imported = 0
+        self.failed = 0
+
+    def run(self, top='/', progress=None):
+        '''
+        Import the tree below 'top', calling 'progress' with the statistics
+        of the import after every batch. Returns the statistics.
+        '''
+
+        top = posixpath.normpath(top)
+        resume = self._load_checkpoint()
+
+        self.debug("%s: Importing %s (resuming after %s)", self, top, resume)
+
+        pool = None
+        if self.processes != 0:
+            pool = multiprocessing.Pool(self.processes)
+
+        self.started = self.reported = time.time()
+        try:
+            batch = []
+            for path, stats in self._walk(top, resume):
+                batch.append((path, stats))
+                if len(batch) == self.batch_size:
+                    self._import(batch, pool)
+                    batch = []
+                    if progress:
+                        progress(self.stats())
+
+            if batch:
+                self._import(batch, pool)
+                if progress:
+                    progress(self.stats())
+
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        self._report()
+        self._remove_checkpoint()
+
+        return self.stats()
+
+    def stats(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        return { 'scanned'  : self.scanned,
+                 'skipped'  : self.skipped,
+                 'imported' : self.imported,
+                 'failed'   : self.failed,
+                 'elapsed'  : elapsed,
+                 'rate'     : self.scanned / elapsed }
+
+    def _import(self, batch, pool):
+        self.scanned += len(batch)
+        last = batch[-1][0]
+
+        # The documents can only hold the names that are valid UTF-8
+        valid = []
+        for path, stats in batch:
+            try:
+                _decode(path)
+            except UnicodeDecodeError:
+                self.failed += 1
+                self.debug("%s: Skipping %r, not a UTF-8 path", self, path)
+                continue
+            valid.append((path, stats))
+        batch = valid
+
+        existing = self.doc_helper.get_many('by_path', [ path for path, stats in batch ])
+        self.skipped += len(existing)
+        batch = [ (path, stats) for path, stats in batch if not existing.has_key(path) ]
+
+        files = [ self.realfs.real_path(path) for path, stats in batch
+                  if not stat.S_ISDIR(stats.st_mode) ]
+        if pool:
+            mimetypes = pool.map(_detect_mime_type, files, chunksize=64)
+        else:
+            mimetypes = map(_detect_mime_type, files)
+        mimetypes.reverse()
+
+        documents = []
+        for path, stats in batch:
+            if stat.S_ISDIR(stats.st_mode):
+                mimetype = "application/x-directory"
+            else:
+                mimetype = mimetypes.pop()
+
+            document = self.doc_helper.doc_class(filename=_decode(posixpath.basename(path)),
+                                                 dirpath=_decode(posixpath.dirname(path)),
+                                                 mode=stats.st_mode,
+                                                 type=mimetype,
+                                                 stats=stats)
+            document._data['_id'] = uuid4().hex
+            documents.append(document)
+
+        if documents:
+            try:
+                self.doc_helper.bulk_update(documents,
+                                            chunk_size=self.filesystem.bulk_size,
+                                            workers=self.filesystem.bulk_workers)
+                self.imported += len(documents)
+
+            except BulkUpdateError, e:
+                self.failed += len(e.failures)
+                self.imported += len(documents) - len(e.failures)
+                self.debug("%s: %s", self, e)
+
+        self._save_checkpoint(last)
+
+        if time.time() - self.reported > self.report_interval:
+            self._report()
+
+    def _walk(self, top, resume=None):
+        if top != '/' and (not resume or _path_key(top) > _path_key(resume)):
+            yield top, self.realfs.lstat(top)
+
+        stack = [ (top, iter(self._listdir(top))) ]
+        while stack:
+            dirpath, entries = stack[-1]
+            try:
+                name, isdir = entries.next()
+            except StopIteration:
+                stack.pop()
+                continue
+
+            path = posixpath.join(dirpath, name)
+
+            if resume and _path_key(path) <= _path_key(resume):
+                # Only walk through the directories leading to the
+                # checkpoint, the others were entirely imported
+                if resume == path or resume.startswith(path + '/'):
+                    if isdir is None:
+                        isdir = stat.S_ISDIR(self.realfs.lstat(path).st_mode)
+                    if isdir:
+                        stack.append((path, iter(self._listdir(path))))
+                continue
+
+            try:
+                stats = self.realfs.lstat(path)
+            except OSError:
+                continue
+
+            yield path, stats
+
+            if stat.S_ISDIR(stats.st_mode):
+                stack.append((path, iter(self._listdir(path))))
+
+    def _listdir(self, dirpath):
+        realpath = self.realfs.real_path(dirpath)
+        try:
+            if scandir:
+                entries = [ (entry.name, entry.is_dir(follow_symlinks=False))
+                            for entry in scandir(realpath) ]
+            else:
+                entries = [ (name, None) for name in os.listdir(realpath) ]
+
+        except OSError, e:
+            self.debug("%s: Could not list %s (%s)", self, dirpath, e)
+            return []
+
+        entries.sort()
+        return entries
+
+    def _load_checkpoint(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            return open(self.checkpoint, "rb").read() or None
+
+    def _save_checkpoint(self, path):
+        if not self.checkpoint:
+            return
+
+        # The path as walked, the filenames are raw bytes compared as is
+        # with the walked paths on resume
+        temp = self.checkpoint + ".tmp"
+        checkpoint = open(temp, "wb")
+        checkpoint.write(path)
+        checkpoint.close()
+        os.rename(temp, self.checkpoint)
+
+    def _remove_checkpoint(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def _report(self):
+        self.reported = time.time()
+        stats = self.stats()
+        self.debug("%s: %d scanned, %d imported, %d skipped, %d failed, %.1f files/s",
+                   self, stats['scanned'], stats['imported'], stats['skipped'],
+                   stats['failed'], stats['rate'])
+
+    def __str__(self):
+        return '<Importer %s>' % self.realfs.mount_point
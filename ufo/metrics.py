@@ -0,0 +1,396 @@
+# Copyright (C) 2010  Agorabox. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''UFO latency instrumentation.'''
+
+import os
+import time
+import math
+import types
+import threading
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from ufo import config
+from ufo.debugger import Debugger
+
+# Parts of an operation, the time spent outside of the backend
+# filesystem and the database is the rest of the total
+FS = 0
+DB = 1
+HITS = 2
+MISSES = 3
+ELAPSED = 4
+
+_local = threading.local()
+
+
+class Histogram(object):
+    '''
+    Latency histogram with power of two buckets of microseconds, the
+    percentiles are the upper bounds of the buckets they fall in.
+    '''
+
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.buckets = {}
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+        bucket = math.frexp(seconds * 1000000)[1]
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2 ** bucket / 1000000.0, self.max)
+
+        return self.max
+
+    def snapshot(self):
+        return { 'count'   : self.count,
+                 'total'   : self.total,
+                 'mean'    : self.count and self.total / self.count,
+                 'min'     : self.min or 0.0,
+                 'max'     : self.max,
+                 'p50'     : self.percentile(50),
+                 'p90'     : self.percentile(90),
+                 'p99'     : self.percentile(99),
+                 'buckets' : dict([ (2 ** bucket, count)
+                                    for bucket, count in self.buckets.items() ]) }
+
+
+class Metrics(object):
+    '''
+    Thread safe registry of latency histograms and counters.
+
+    The histograms are named after what they measure:
+      - 'op.<operation>' for the total latency of a filesystem operation,
+        and 'op.<operation>.fs' and 'op.<operation>.db' for the time it
+        spent in the backend filesystem and in the database,
+      - 'fs.<method>' for every call to the backend filesystem,
+      - 'db.<view>.<verb>' for every database request.
+
+    The 'op.<operation>.cache_hits' and 'op.<operation>.cache_misses'
+    counters count the metadata cache lookups of the operations.
+    '''
+
+    def __init__(self):
+        self.enabled = config.metrics_enabled
+
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+        self._dumper = None
+
+    def record(self, name, seconds):
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.record(seconds)
+
+        finally:
+            self.lock.release()
+
+    def count(self, name, value=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+        finally:
+            self.lock.release()
+
+    def frame(self):
+        '''
+        Return the frame of the operation running in the current thread,
+        for the threads working on its behalf, or None.
+        '''
+
+        return getattr(_local, 'frame', None)
+
+    def timed(self, kind, name, started, frame=None):
+        '''
+        Record a backend filesystem or database call started at 'started',
+        and account its time to the current operation, or to the operation
+        of 'frame' for the calls made by other threads. As these calls run
+        concurrently, the parts of an operation may add up to more than
+        its total.
+        '''
+
+        if not self.enabled:
+            return
+
+        elapsed = time.time() - started
+        self.record(kind + '.' + name, elapsed)
+
+        if frame is not None:
+            self.lock.acquire()
+            try:
+                frame[kind == 'db' and DB or FS] += elapsed
+
+            finally:
+                self.lock.release()
+            return
+
+        frame = getattr(_local, 'frame', None)
+        if frame is not None:
+            frame[kind == 'db' and DB or FS] += elapsed
+
+    def cached(self, hit):
+        '''
+        Account a metadata cache lookup to the current operation.
+        '''
+
+        if not self.enabled:
+            return
+
+        frame = getattr(_local, 'frame', None)
+        if frame is not None:
+            frame[hit and HITS or MISSES] += 1
+
+    def operation_done(self, name, frame):
+        self.lock.acquire()
+        try:
+            for suffix, seconds in (('', frame[ELAPSED]), ('.fs', frame[FS]), ('.db', frame[DB])):
+                histogram = self.histograms.get('op.' + name + suffix)
+                if histogram is None:
+                    histogram = self.histograms['op.' + name + suffix] = Histogram()
+                histogram.record(seconds)
+
+            for suffix, value in (('.cache_hits', frame[HITS]), ('.cache_misses', frame[MISSES])):
+                if value:
+                    self.counters['op.' + name + suffix] = \
+                        self.counters.get('op.' + name + suffix, 0) + value
+
+        finally:
+            self.lock.release()
+
+    def snapshot(self, reset=False):
+        '''
+        Return the statistics of all the histograms and counters, and
+        start over if 'reset' is set.
+        '''
+
+        self.lock.acquire()
+        try:
+            now = time.time()
+            snapshot = { 'time'       : now,
+                         'since'      : self.started,
+                         'histograms' : dict([ (name, histogram.snapshot())
+                                               for name, histogram in self.histograms.items() ]),
+                         'counters'   : self.counters.copy() }
+
+            if reset:
+                self.histograms = {}
+                self.counters = {}
+                self.started = now
+
+            return snapshot
+
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.snapshot(reset=True)
+
+    def dump(self, path, reset=False):
+        '''
+        Write a snapshot to a file as JSON, atomically.
+        '''
+
+        temp = path + ".tmp"
+        dump = open(temp, "w")
+        try:
+            json.dump(self.snapshot(reset), dump, indent=1, sort_keys=True)
+        finally:
+            dump.close()
+        os.rename(temp, path)
+
+    def start_dump(self, path, interval=60, reset=False):
+        '''
+        Dump a snapshot to 'path' every 'interval' seconds from a
+        background thread.
+        '''
+
+        self.stop_dump()
+        self._dumper = MetricsDumper(self, path, interval, reset)
+        self._dumper.start()
+
+    def dumping(self):
+        return self._dumper is not None
+
+    def stop_dump(self):
+        if self._dumper:
+            self._dumper.stop()
+            self._dumper = None
+
+
+class MetricsDumper(Debugger, threading.Thread):
+    '''
+    Thread periodically dumping the metrics to a file.
+    '''
+
+    def __init__(self, metrics, path, interval=60, reset=False):
+        threading.Thread.__init__(self, name="MetricsDumper")
+        self.setDaemon(True)
+
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.reset = reset
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            self.stopped.wait(self.interval)
+            if self.stopped.isSet():
+                break
+
+            try:
+                self.metrics.dump(self.path, self.reset)
+            except (IOError, OSError), e:
+                self.debug("%s: Could not dump the metrics to %s (%s)",
+                           self.name, self.path, e)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class TimedObject(object):
+    '''
+    Proxy timing the method calls of an object, the backend filesystem
+    of a CouchedFileSystem, as 'fs.<method>'.
+    '''
+
+    def __init__(self, obj, kind='fs'):
+        self.__dict__['_obj'] = obj
+        self.__dict__['_kind'] = kind
+
+    def __getattr__(self, attr):
+        value = getattr(self._obj, attr)
+        if not callable(value) or attr.startswith('_'):
+            return value
+
+        kind = self._kind
+        def timed_method(*args, **kw):
+            if not metrics.enabled:
+                return value(*args, **kw)
+
+            started = time.time()
+            try:
+                return value(*args, **kw)
+            finally:
+                metrics.timed(kind, attr, started)
+
+        return timed_method
+
+    def __setattr__(self, attr, value):
+        setattr(self._obj, attr, value)
+
+
+def operation(name):
+    '''
+    Decorator recording the latency of a filesystem operation, along with
+    the time it spent in the backend filesystem and the database and its
+    cache lookups. The operations called by another one are recorded on
+    their own and accounted to the calling operation as well.
+
+    The operations returning a generator are timed while it is consumed.
+    '''
+
+    def decorator(func):
+        def timed_operation(*args, **kw):
+            if not metrics.enabled:
+                return func(*args, **kw)
+
+            # The calling operation, a generator may be exhausted long
+            # after it returned
+            parent = getattr(_local, 'frame', None)
+            frame = [ 0.0, 0.0, 0, 0, 0.0 ]
+            try:
+                result = _run(frame, func, args, kw)
+            except:
+                _done(name, frame, parent)
+                raise
+
+            if isinstance(result, types.GeneratorType):
+                return _iterate(name, frame, parent, result)
+
+            _done(name, frame, parent)
+            return result
+
+        timed_operation.__name__ = func.__name__
+        timed_operation.__doc__ = func.__doc__
+        timed_operation.__dict__.update(func.__dict__)
+        return timed_operation
+
+    return decorator
+
+def _run(frame, func, args, kw):
+    parent = getattr(_local, 'frame', None)
+    _local.frame = frame
+    started = time.time()
+    try:
+        return func(*args, **kw)
+
+    finally:
+        frame[ELAPSED] += time.time() - started
+        _local.frame = parent
+
+def _iterate(name, frame, parent, generator):
+    try:
+        while True:
+            try:
+                item = _run(frame, generator.next, (), {})
+            except StopIteration:
+                break
+            yield item
+
+    finally:
+        _done(name, frame, parent)
+
+def _done(name, frame, parent):
+    metrics.operation_done(name, frame)
+
+    if parent is not None:
+        for part in (FS, DB, HITS, MISSES):
+            parent[part] += frame[part]
+
+metrics = Metrics()
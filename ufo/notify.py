@@ -129,22 +129,22 @@ class NewFriendshipNotification(NotificationDocument):
 
     @action(_("Accept"))
     def accept_invitation(self):
-        self.debug("Accepting the friend invitation from '%s' to '%s'"
-                   % (self.initiator, self.target))
+        self.debug("Accepting the friend invitation from '%s' to '%s'",
+                   self.initiator, self.target)
 
         user.accept_friend(self.initiator)
 
     @action(_("Refuse"))
     def refuse_invitation(self):
-        self.debug("Refusing the friend invitation from '%s' to '%s'"
-                   % (self.initiator, self.target))
+        self.debug("Refusing the friend invitation from '%s' to '%s'",
+                   self.initiator, self.target)
 
         user.refuse_friend(self.initiator)
 
     @action(_("Block user"))
     def block_invitation(self):
-        self.debug("Blocking the friend invitation from '%s' to '%s'"
-                   % (self.initiator, self.target))
+        self.debug("Blocking the friend invitation from '%s' to '%s'",
+                   self.initiator, self.target)
 
         user.block_user(self.initiator)
 
@@ -159,22 +159,22 @@ class FollowRequestNotification(NotificationDocument):
 
     @action(_("Accept"))
     def accept_invitation(self):
-        self.debug("Accepting the follow request from '%s' to '%s'"
-                   % (self.initiator, self.target))
+        self.debug("Accepting the follow request from '%s' to '%s'",
+                   self.initiator, self.target)
 
         user.accept_following(self.initiator)
 
     @action(_("Refuse"))
     def refuse_invitation(self):
-        self.debug("Refusing the follow request from '%s' to '%s'"
-                   % (self.initiator, self.target))
+        self.debug("Refusing the follow request from '%s' to '%s'",
+                   self.initiator, self.target)
 
         user.refuse_following(self.initiator)
 
     @action(_("Block user"))
     def block_invitation(self):
-        self.debug("Blocking the follow request from '%s' to '%s'"
-                   % (self.initiator, self.target))
+        self.debug("Blocking the follow request from '%s' to '%s'",
+                   self.initiator, self.target)
 
         user.block_user(self.initiator)
 
@@ -190,7 +190,7 @@ class AcceptedFriendshipNotification(NotificationDocument):
 
     @action
     def accept_friend(self):
-        self.debug("Proceed pending shares from '%s' to '%s'" % (self.initiator, self.target))
+        self.debug("Proceed pending shares from '%s' to '%s'", self.initiator, self.target)
         # user.accept_friend(self.initiator)
 
 
@@ -0,0 +1,171 @@
+# Copyright (C) 2010  Agorabox. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''UFO filename search.'''
+
+from ufo.debugger import Debugger
+from ufo.database import DocumentHelper, ViewField
+from ufo.filesystem import SyncDocument
+
+# Filenames can not contain slashes, they are used to pad the end of the
+# names so that the substrings shorter than a trigram can be found too.
+PADDING = "//"
+
+def trigrams(name):
+    '''
+    Return the set of the trigrams of a lowercased unicode string.
+    '''
+
+    return set([ name[i:i + 3] for i in range(len(name) - 2) ])
+
+
+class FilenameSearchDocument(SyncDocument):
+    '''
+    SyncDocument with the views of the filename search index. Both views
+    emit a few rows of null values per document, the documents are fetched
+    with 'include_docs' only for the final results.
+    '''
+
+    keys_only_views = ( 'by_filename', )
+
+    by_trigram = ViewField('search',
+                           language = 'javascript',
+                           map_fun = "function (doc) {" \
+                                       "if (doc.doctype === 'SyncDocument') {" \
+                                         "var name = doc.filename.toLowerCase() + '" + PADDING + "';" \
+                                         "var seen = {};" \
+                                         "for (var i=0; i<name.length-2; i++) {" \
+                                           "var trigram = name.substr(i, 3);" \
+                                           "if (!seen[trigram]) {" \
+                                             "seen[trigram] = true;" \
+                                             "emit(trigram, null);" \
+                                           "}" \
+                                         "}" \
+                                       "}" \
+                                     "}")
+
+    by_filename = ViewField('search',
+                            language = 'javascript',
+                            map_fun = "function (doc) {" \
+                                        "if (doc.doctype === 'SyncDocument') {" \
+                                          "emit(doc.filename.toLowerCase(), null);" \
+                                        "}" \
+                                      "}")
+
+
+class FilenameIndex(Debugger):
+    '''
+    Substring and prefix search of filenames across a whole database.
+
+    Substring queries look up the trigrams of the query in a single
+    multi-key request, intersect the matching document ids and then fetch
+    the candidates by batches of 'fetch_size' until enough of them are
+    confirmed to contain the query. Queries shorter than a trigram read
+    the trigrams starting with them by pages of 'fetch_size' rows, until
+    enough documents are found.
+
+    The views of the index are synced when it is created, unless 'sync'
+    is unset.
+    '''
+
+    fetch_size = 100
+
+    def __init__(self, db, server="http://localhost:5984", auth=None, sync=True):
+        self.helper = DocumentHelper(FilenameSearchDocument, db, server, auth=auth)
+        if sync:
+            self.sync()
+
+    def sync(self):
+        self.helper.sync()
+
+    def search(self, query, limit=50, skip=0):
+        '''
+        Return the documents whose filename contains 'query', ignoring
+        case, sorted by document id, or in the order of the index for the
+        queries shorter than a trigram.
+        '''
+
+        query = self._normalize(query)
+        if not query:
+            return []
+
+        self.debug("%s: Searching '%s' (limit=%d, skip=%d)",
+                   self, query.encode('utf-8'), limit, skip)
+
+        database = self.helper.database
+        if len(query) < 3:
+            # Any trigram starting with the query, thanks to the padding.
+            # They all contain the query, so the index is only read until
+            # enough distinct documents are found.
+            candidates = []
+            found = set()
+            for docid in self.helper.iterview('by_trigram', self.fetch_size,
+                                              startkey=query, endkey=query + u"\ufff0",
+                                              wrapper=lambda row: row.id):
+                if docid not in found:
+                    found.add(docid)
+                    candidates.append(docid)
+                    if len(candidates) >= skip + limit:
+                        break
+
+        else:
+            postings = {}
+            for row in database.view('search/by_trigram', keys=list(trigrams(query))):
+                postings.setdefault(row.key, set()).add(row.id)
+
+            if len(postings) < len(trigrams(query)):
+                return []
+
+            postings = sorted(postings.values(), key=len)
+            candidates = postings[0]
+            for posting in postings[1:]:
+                candidates = candidates.intersection(posting)
+            candidates = sorted(candidates)
+
+        # The trigrams may match in the wrong order, check the filenames
+        results = []
+        for index in range(0, len(candidates), self.fetch_size):
+            for row in database.view('_all_docs',
+                                     keys=candidates[index:index + self.fetch_size],
+                                     include_docs=True):
+                doc = row.get('doc')
+                if doc and query in doc['filename'].lower():
+                    results.append(self.helper.doc_class._wrap_row(row))
+
+            if len(results) >= skip + limit:
+                break
+
+        return results[skip:skip + limit]
+
+    def search_prefix(self, prefix, limit=50, skip=0):
+        '''
+        Return the documents whose filename starts with 'prefix', ignoring
+        case, sorted by filename.
+        '''
+
+        prefix = self._normalize(prefix)
+
+        return list(self.helper.by_filename(startkey=prefix,
+                                            endkey=prefix + u"\ufff0",
+                                            limit=limit, skip=skip))
+
+    def _normalize(self, query):
+        if isinstance(query, str):
+            query = query.decode('utf-8')
+        return query.lower()
+
+    def __str__(self):
+        return '<FilenameIndex database: %s>' % self.helper.database.name
@@ -1,6 +1,7 @@
 import os
+import threading
 from new import instancemethod
-from ufo.database import DocumentHelper
+from ufo.database import DocumentHelper, ChangesWatcher
 from ufo.constants import Notification, FriendshipStatus
 from ufo.sharing import FriendDocument
 from ufo.debugger import Debugger
@@ -13,8 +14,17 @@ class FriendFilter:
 
     def __call__(self, *args):
         def friend_filter_func(_self):
+            contacts = _self.contacts
+
+            # Use the indexes of the contacts when possible
+            if self.key == "login" and self.kw.keys() == [ "status" ]:
+                return contacts.with_status(self.kw["status"])
+
+            if self.key == "uid" and not self.kw:
+                return contacts.with_uid()
+
             items = { }
-            for login, friend in _self.contacts.items():
+            for login, friend in contacts.items():
                 match = True
                 for key, value in self.kw.items():
                     if getattr(friend, key) != value:
@@ -37,6 +47,8 @@ class Friend(Debugger):
     def __setattr__(self, attr, value):
         if hasattr(FriendDocument, attr):
             setattr(self.doc, attr, value)
+            if attr in ContactStore.indexed and self.__dict__.get('_store'):
+                self._store.reindex(self)
         else:
             self.__dict__[attr] = value
 
@@ -49,8 +61,185 @@ class Friend(Debugger):
     def __repr__(self):
         return self.login
 
+class ContactStore(Debugger):
+    '''
+    Contacts of a user indexed by login, and also by status and by uid.
+
+    The indexes are maintained when contacts are added, removed or when
+    the status or the uid of a contact changes, so that the friendship
+    checks do not scan all the contacts. If 'watch_changes' is set, the
+    changes made by other clients are applied from the changes feed.
+    '''
+
+    indexed = ( 'status', 'uid' )
+
+    def __init__(self, friend_helper, watch_changes=False):
+        self.friend_helper = friend_helper
+        self.by_login = {}
+        self.by_status = {}
+        self.by_uid = {}
+        self.by_id = {}
+        self._keys = {}
+        self._lock = threading.RLock()
+
+        self.watcher = None
+        if watch_changes:
+            self.watcher = ChangesWatcher(friend_helper.database,
+                                          self._document_changed,
+                                          include_docs=True)
+
+        for doc in friend_helper.by_login():
+            self[doc.login] = Friend(doc)
+
+        if self.watcher:
+            self.watcher.start()
+
+    def with_status(self, status):
+        '''
+        Return a copy of the contacts with the given status, by login.
+        '''
+
+        self._lock.acquire()
+        try:
+            return self.by_status.get(status, {}).copy()
+
+        finally:
+            self._lock.release()
+
+    def with_uid(self):
+        '''
+        Return a copy of the contacts having a uid, by uid.
+        '''
+
+        self._lock.acquire()
+        try:
+            return self.by_uid.copy()
+
+        finally:
+            self._lock.release()
+
+    def reindex(self, friend):
+        self._lock.acquire()
+        try:
+            login = friend.login
+            self._unindex(login)
+            self._index(login, friend)
+
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        if self.watcher:
+            self.watcher.stop()
+
+    def _index(self, login, friend):
+        status = getattr(friend, 'status', None)
+        uid = getattr(friend, 'uid', None)
+
+        self.by_login[login] = friend
+        self.by_status.setdefault(status, {})[login] = friend
+        if uid is not None:
+            self.by_uid[uid] = friend
+
+        id = getattr(friend, 'id', None)
+        if id:
+            self.by_id[id] = login
+
+        self._keys[login] = (status, uid, id)
+
+        if isinstance(friend, Friend):
+            friend.__dict__['_store'] = self
+
+    def _unindex(self, login):
+        friend = self.by_login.pop(login, None)
+        if friend is None:
+            return None
+
+        status, uid, id = self._keys.pop(login)
+        self.by_status.get(status, {}).pop(login, None)
+        if uid is not None and self.by_uid.get(uid) is friend:
+            del self.by_uid[uid]
+        if id:
+            self.by_id.pop(id, None)
+
+        if isinstance(friend, Friend):
+            friend.__dict__['_store'] = None
+
+        return friend
+
+    def _document_changed(self, change):
+        self._lock.acquire()
+        try:
+            if change.get('deleted'):
+                login = self.by_id.get(change['id'])
+                if login:
+                    self._unindex(login)
+                return
+
+            doc = change.get('doc')
+            if not doc or doc.get('doctype') != 'FriendDocument':
+                return
+
+            friend = self.by_login.get(doc['login'])
+            if friend and getattr(friend, 'rev', None) == doc['_rev']:
+                return
+
+            self.debug("%s: Refreshing contact %s", self, doc['login'])
+            self[doc['login']] = Friend(FriendDocument.wrap(doc))
+
+        finally:
+            self._lock.release()
+
+    def __getitem__(self, login):
+        return self.by_login[login]
+
+    def __setitem__(self, login, friend):
+        self._lock.acquire()
+        try:
+            self._unindex(login)
+            self._index(login, friend)
+
+        finally:
+            self._lock.release()
+
+    def __delitem__(self, login):
+        self._lock.acquire()
+        try:
+            if self._unindex(login) is None:
+                raise KeyError(login)
+
+        finally:
+            self._lock.release()
+
+    def get(self, login, default=None):
+        return self.by_login.get(login, default)
+
+    def has_key(self, login):
+        return self.by_login.has_key(login)
+
+    __contains__ = has_key
+
+    def keys(self):
+        return self.by_login.keys()
+
+    def values(self):
+        return self.by_login.values()
+
+    def items(self):
+        return self.by_login.items()
+
+    def __iter__(self):
+        return iter(self.by_login.keys())
+
+    def __len__(self):
+        return len(self.by_login)
+
+    def __str__(self):
+        return '<ContactStore database: %s>' % self.friend_helper.database.name
+
 class User(Friend):
     _user_cache = {}
+    _contact_stores = {}
     _contacts = None
 
     def __init__(self, db, login, dry_run=False, reuse_cache=False):
@@ -59,6 +248,7 @@ class User(Friend):
 
         if not reuse_cache:
             self._user_cache = {}
+        self.reuse_cache = reuse_cache
 
         friend_helper = DocumentHelper(FriendDocument, db)
         document = self._user_cache.get(login)
@@ -112,7 +302,10 @@ class User(Friend):
         document = self.friend_helper.create(login=unicode(friend),
                                              status=status)
         self._user_cache[friend] = document
-        return Friend(document)
+        friend = Friend(document)
+        if self._contacts is not None:
+            self._contacts[friend.login] = friend
+        return friend
 
     def remove_friend(self, friend):
         friendship_status = self.get_friendship_status(friend)
@@ -121,6 +314,7 @@ class User(Friend):
             self.friend_helper.delete(self.contacts[friend])
             if self._user_cache.has_key(friend):
                 del self._user_cache[friend]
+            del self.contacts[friend]
         else:
             raise BadFriendshipStatus()
 
@@ -221,15 +415,18 @@ class User(Friend):
 
     @property
     def contacts(self):
-        if not self._contacts:
-            contacts = {}
-            for doc in self.friend_helper.by_login():
-                self._user_cache[doc.login] = doc
-                contacts[doc.login] = Friend(doc)
-            self._contacts = True
-            return contacts
-        else:
-            return self._user_cache
+        if self._contacts is None:
+            name = self.friend_helper.database.name
+            if self.reuse_cache and User._contact_stores.has_key(name):
+                self._contacts = User._contact_stores[name]
+            else:
+                # Only the shared stores follow the changes of the other clients
+                self._contacts = ContactStore(self.friend_helper,
+                                              watch_changes=self.reuse_cache)
+                if self.reuse_cache:
+                    User._contact_stores[name] = self._contacts
+
+        return self._contacts
 
     @property
     @FriendFilter(status=FriendshipStatus.PENDING_FRIEND)
@@ -248,10 +445,88 @@ class User(Friend):
     def friends_id(self): pass
 
 class LazyUser:
+    '''
+    Proxy to the User of the current login, taken from the REMOTE_USER or
+    USER environment variables at every access so that a web server can
+    serve several users. The User of a login is created once and then
+    shared by all the threads, until it is invalidated or evicted by the
+    'max_users' most recently used ones.
+    '''
+
+    max_users = 64
+
+    def __init__(self):
+        # The cache is created on first use, ufo.utils importing this module
+        self.__dict__['_users'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def get_login(self):
+        return os.environ.get("REMOTE_USER", os.environ.get("USER"))
+
+    def get_user(self, login=None):
+        if login is None:
+            login = self.get_login()
+
+        user = None
+        if self._users is not None:
+            user = self._users.get(login)
+
+        if user is None:
+            self._lock.acquire()
+            try:
+                if self._users is None:
+                    from ufo.utils import LRUCache
+                    self.__dict__['_users'] = LRUCache(max_size=self.max_users,
+                                                       on_evict=self._forget)
+
+                user = self._users.get(login)
+                if user is None:
+                    user = User(db=DocumentHelper(FriendDocument, login).database,
+                                login=login, reuse_cache=True)
+                    self._users.cache(login, user)
+
+            finally:
+                self._lock.release()
+
+        return user
+
+    def invalidate(self, login=None):
+        '''
+        Forget the User of a login, or of all the logins if None.
+        '''
+
+        self._lock.acquire()
+        try:
+            if login is not None:
+                logins = [ login ]
+            elif self._users is not None:
+                logins = self._users.keys()
+            else:
+                logins = []
+
+            for login in logins:
+                user = None
+                if self._users is not None:
+                    user = self._users.invalidate(login)
+                self._forget(login, user)
+
+        finally:
+            self._lock.release()
+
+    def _forget(self, login, user):
+        '''
+        Drop the cached document and stop the contact store of a login.
+        '''
+
+        User._user_cache.pop(login, None)
+        store = User._contact_stores.pop(login, None)
+        if store:
+            store.stop()
+
     def __getattr__(self, attr):
-        login = os.environ.get("REMOTE_USER", os.environ.get("USER"))
-        return getattr(User(db=DocumentHelper(FriendDocument, login).database,
-                            login=login, reuse_cache=True),
-                       attr)
+        return getattr(self.get_user(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.get_user(), attr, value)
 
 user = LazyUser()
@@ -19,8 +19,11 @@ import sys
 import time
 import magic
 import string
+import mimetypes
+import threading
 
 from threading import RLock
+from collections import OrderedDict
 from ufo.user import user
 
 class MutableStat(object):
@@ -70,30 +73,6 @@ class MutableStat(object):
         return repr(self[0:len(self._keys)])
 
 
-class MimeType(object):
-    '''
-    Object to get various mimetype forms of a file.
-    '''
-
-    _magic = None
-    _path  = None
-
-    def __init__(self, path):
-        if sys.platform == "win32":
-            self._magic = magic.Magic(True, magic_file=os.path.join('.', 'magic.mgc'))
-        else:
-            self._magic = magic.open(magic.MAGIC_MIME)
-            self._magic.load()
-
-        self._path = path
-
-    def basic(self):
-        if sys.platform == "win32":
-            return str(self._magic.from_file(self._path).split(" ")[0])
-        else:
-            return str(self._magic.file(self._path).split(";")[0])
-
-
 class CacheDict(dict):
   
   _cacheTimeout = 0
@@ -124,42 +103,465 @@ class CacheDict(dict):
     self._accesslock.release()
 
 
-def get_user_infos(login=None, uid=None):
-    assert login != None or uid != None
+class LRUCache(object):
+    '''
+    Bounded and thread safe cache evicting the least recently used entries.
+
+    An entry whose value is None is a negative entry, it records that a
+    lookup failed and expires after 'negative_timeout' seconds. Positive
+    entries expire after 'timeout' seconds, or never if 'timeout' is None,
+    in which case the cache relies on explicit invalidation.
+
+    If an 'identify' function is given, it is called on every positive
+    value to get an identifier that can be used to invalidate the entry
+    without knowing its key. The 'on_evict' function is called with the
+    key and the value of every entry evicted or expired.
+    '''
 
-    if type(login) == int:
-        uid = login
-        login = None
+    def __init__(self, max_size=10000, timeout=None, negative_timeout=5,
+                 identify=None, on_evict=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.negative_timeout = negative_timeout
+        self.identify = identify
+        self.on_evict = on_evict
 
-    try:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._keys_by_id = {}
+        self._lock = RLock()
+
+    def lookup(self, key):
+        '''
+        Return a (found, value) tuple, 'value' being None for a negative entry.
+        '''
+
+        self._lock.acquire()
         try:
-            import pwd
-            import grp
+            entry = self._entries.pop(key, None)
+            if entry is None or (entry[1] and entry[1] < time.time()):
+                if entry is not None:
+                    self._forget(key, entry[0])
+                    if self.on_evict:
+                        self.on_evict(key, entry[0])
+                self.misses += 1
+                return False, None
+
+            # Move the entry at the end of the LRU order
+            self._entries[key] = entry
+            self.hits += 1
+            return True, entry[0]
+
+        finally:
+            self._lock.release()
+
+    def get(self, key, default=None):
+        found, value = self.lookup(key)
+        if found:
+            return value
+        return default
+
+    def cache(self, key, value, timeout=None):
+        if timeout is None:
+            if value is None:
+                timeout = self.negative_timeout
+            else:
+                timeout = self.timeout
 
-            if login:
-                pw = pwd.getpwnam(login)
+        expires = 0
+        if timeout is not None:
+            expires = time.time() + timeout
+
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._forget(key, old[0])
+
+            self._entries[key] = (value, expires)
+            if value is not None and self.identify:
+                self._keys_by_id[self.identify(value)] = key
+
+            while len(self._entries) > self.max_size:
+                oldkey, oldentry = self._entries.popitem(last=False)
+                self._forget(oldkey, oldentry[0])
+                self.evictions += 1
+                if self.on_evict:
+                    self.on_evict(oldkey, oldentry[0])
+
+        finally:
+            self._lock.release()
+
+    def find(self, ident):
+        '''
+        Return the value cached for the identifier 'ident', or None.
+        '''
+
+        self._lock.acquire()
+        try:
+            key = self._keys_by_id.get(ident)
+            if key is not None:
+                return self._entries[key][0]
+
+        finally:
+            self._lock.release()
+
+    def invalidate(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._forget(key, entry[0])
+                return entry[0]
+
+        finally:
+            self._lock.release()
+
+    def invalidate_id(self, ident):
+        self._lock.acquire()
+        try:
+            key = self._keys_by_id.get(ident)
+            if key is not None:
+                return self.invalidate(key)
+
+        finally:
+            self._lock.release()
+
+    def has_prefix(self, prefix):
+        '''
+        Tell if a positive entry has a key starting with 'prefix'.
+        '''
+
+        self._lock.acquire()
+        try:
+            for key, entry in self._entries.iteritems():
+                if entry[0] is not None and key.startswith(prefix):
+                    return True
+            return False
+
+        finally:
+            self._lock.release()
+
+    def invalidate_prefix(self, prefix):
+        self._lock.acquire()
+        try:
+            for key in [ key for key in self._entries if key.startswith(prefix) ]:
+                self.invalidate(key)
+
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._keys_by_id.clear()
+
+        finally:
+            self._lock.release()
+
+    def acquire(self):
+        self._lock.acquire()
+
+    def release(self):
+        self._lock.release()
+
+    def stats(self):
+        return { 'size'      : len(self._entries),
+                 'hits'      : self.hits,
+                 'misses'    : self.misses,
+                 'evictions' : self.evictions }
+
+    def _forget(self, key, value):
+        if value is not None and self.identify:
+            ident = self.identify(value)
+            if self._keys_by_id.get(ident) == key:
+                del self._keys_by_id[ident]
+
+    def keys(self):
+        self._lock.acquire()
+        try:
+            return self._entries.keys()
+
+        finally:
+            self._lock.release()
+
+    def has_key(self, key):
+        return self._entries.has_key(key)
+
+    __contains__ = has_key
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MimeDetector(object):
+    '''
+    Detection of the mimetype of files with libmagic.
+
+    Loading the magic database is expensive, so every thread keeps its own
+    loaded handle, libmagic handles not being thread safe. The results are
+    cached by path along with the size, mtime and inode of the file, and
+    reused as long as they do not change. If the caller already holds the
+    first bytes of the file, the detection is done on them instead of
+    reading the file again. The mimetype may also be guessed from the
+    extension of the file if 'use_extensions' is set.
+    '''
+
+    # Number of bytes of the beginning of a file needed for the detection
+    head_size = 65536
+
+    def __init__(self, max_size=10000, use_extensions=False):
+        self.use_extensions = use_extensions
+        self._local = threading.local()
+        self._cache = LRUCache(max_size=max_size)
+
+    def detect(self, path, buffer=None, stats=None):
+        if self.use_extensions:
+            mimetype = mimetypes.guess_type(path, strict=False)[0]
+            if mimetype:
+                return mimetype
+
+        if stats is None:
+            try:
+                stats = os.stat(path)
+            except OSError:
+                stats = None
+
+        if stats is not None:
+            signature = (stats.st_size, stats.st_mtime, stats.st_ino)
+            cached = self._cache.get(path)
+            if cached and cached[0] == signature:
+                return cached[1]
+
+        if buffer is not None:
+            mimetype = self._detect_buffer(buffer)
+        else:
+            mimetype = self._detect_file(path)
+
+        if stats is not None:
+            self._cache.cache(path, (signature, mimetype))
+
+        return mimetype
+
+    def _get_magic(self):
+        handle = getattr(self._local, 'magic', None)
+        if handle is None:
+            if sys.platform == "win32":
+                handle = magic.Magic(True, magic_file=os.path.join('.', 'magic.mgc'))
             else:
-                pw = pwd.getpwuid(uid)
+                handle = magic.open(magic.MAGIC_MIME)
+                handle.load()
+            self._local.magic = handle
+
+        return handle
+
+    def _detect_file(self, path):
+        if sys.platform == "win32":
+            return str(self._get_magic().from_file(path).split(" ")[0])
+        else:
+            return str(self._get_magic().file(path).split(";")[0])
+
+    def _detect_buffer(self, buffer):
+        if sys.platform == "win32":
+            return str(self._get_magic().from_buffer(buffer).split(" ")[0])
+        else:
+            return str(self._get_magic().buffer(buffer).split(";")[0])
+
+
+mime_detector = MimeDetector()
+
+class MimeType(object):
+    '''
+    Object to get various mimetype forms of a file.
+    '''
+
+    _path  = None
+
+    def __init__(self, path, buffer=None, stats=None):
+        self._path = path
+        self._buffer = buffer
+        self._stats = stats
 
+    def basic(self):
+        return mime_detector.detect(self._path, self._buffer, self._stats)
+
+
+class UserInfos(dict):
+    '''
+    Identity of a user, whose 'groups' are only looked up when requested.
+    '''
+
+    def __init__(self, resolver, **infos):
+        dict.__init__(self, **infos)
+        self._resolver = resolver
+
+    def __getitem__(self, key):
+        if key == 'groups' and not self.has_key(key):
+            self['groups'] = self._resolver.get_groups(self['login'], self['gid'])
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class IdentityCache(object):
+    '''
+    Process wide cache of the identities of the users, looked up in the
+    system databases and then in the contacts of the current user.
+
+    The identities are cached by login and by uid, the failed lookups for
+    'negative_timeout' seconds only. Group membership requires a scan of
+    all the groups, it is computed for all the users at once the first
+    time the groups of a user are requested, and then cached for
+    'timeout' seconds.
+    '''
+
+    # Above this number of unknown users, a bulk resolution
+    # enumerates the users database instead of looking them up
+    enumerate_threshold = 32
+
+    def __init__(self, max_size=4096, timeout=600, negative_timeout=30):
+        self.timeout = timeout
+        self._infos = LRUCache(max_size=max_size, timeout=timeout,
+                               negative_timeout=negative_timeout)
+        self._members = None
+        self._members_expire = 0
+        self._lock = RLock()
+
+    def resolve(self, login=None, uid=None):
+        assert login != None or uid != None
+
+        if type(login) == int:
+            uid = login
+            login = None
+
+        if login:
+            key = ('login', login)
+        else:
+            key = ('uid', uid)
+
+        found, infos = self._infos.lookup(key)
+        if not found:
+            infos = self._lookup(login, uid)
+            if infos:
+                self._store(infos)
+            else:
+                self._infos.cache(key, None)
+
+        if not infos:
+            if not login: login = "nobody"
+            if not uid: uid = -1
+
+            return UserInfos(self,
+                             login=login,
+                             uid=uid,
+                             gid=uid,
+                             fullname='The one who talks loud to say nothing',
+                             groups=[])
+
+        return infos
+
+    def resolve_many(self, uids=(), logins=()):
+        '''
+        Return a dictionary of the identities of several users, indexed
+        by uid and by login.
+        '''
+
+        keys = [ ('uid', uid) for uid in uids ] + \
+               [ ('login', login) for login in logins ]
+
+        missing = [ key for key in set(keys) if not self._infos.lookup(key)[0] ]
+        if len(missing) > self.enumerate_threshold:
             try:
-                firstname, lastname = pw.pw_gecos.split(' ')
-            except:
-                firstname = pw.pw_gecos
-                lastname = ""
+                import pwd
 
-            groups = [ pw.pw_gid ]
+                wanted = set(missing)
+                for pw in pwd.getpwall():
+                    if ('uid', pw.pw_uid) in wanted or ('login', pw.pw_name) in wanted:
+                        self._store(self._from_passwd(pw))
 
-            for group in grp.getgrall():
-                if pw.pw_name in group.gr_mem:
-                    groups.append(group.gr_gid)
+            except ImportError:
+                pass
+
+        result = {}
+        for kind, value in keys:
+            if kind == 'uid':
+                result[value] = self.resolve(uid=value)
+            else:
+                result[value] = self.resolve(login=value)
 
-            return { 'login' : pw.pw_name,
-                     'uid' : pw.pw_uid,
-                     'gid' : pw.pw_gid,
-                     'fullname' : pw.pw_gecos,
-                     'groups' : groups }
+        return result
+
+    def get_groups(self, login, gid):
+        self._lock.acquire()
+        try:
+            if self._members is None or self._members_expire < time.time():
+                members = {}
+                try:
+                    import grp
+
+                    for group in grp.getgrall():
+                        for member in group.gr_mem:
+                            members.setdefault(member, []).append(group.gr_gid)
+
+                except ImportError:
+                    pass
+
+                self._members = members
+                self._members_expire = time.time() + self.timeout
+
+            return [ gid ] + self._members.get(login, [])
+
+        finally:
+            self._lock.release()
+
+    def invalidate(self, login=None, uid=None):
+        for key in (('login', login), ('uid', uid)):
+            infos = self._infos.invalidate(key)
+            if infos:
+                self._infos.invalidate(('login', infos['login']))
+                self._infos.invalidate(('uid', infos['uid']))
+
+    def clear(self):
+        self._infos.clear()
+        self._lock.acquire()
+        self._members = None
+        self._lock.release()
+
+    def stats(self):
+        return self._infos.stats()
+
+    def _store(self, infos):
+        self._infos.cache(('login', infos['login']), infos)
+        self._infos.cache(('uid', infos['uid']), infos)
+
+    def _from_passwd(self, pw):
+        return UserInfos(self,
+                         login=pw.pw_name,
+                         uid=pw.pw_uid,
+                         gid=pw.pw_gid,
+                         fullname=pw.pw_gecos)
+
+    def _lookup(self, login, uid):
+        try:
+            import pwd
+
+            if login:
+                return self._from_passwd(pwd.getpwnam(login))
+            else:
+                return self._from_passwd(pwd.getpwuid(uid))
 
         except:
+            pass
+
+        try:
             if login:
                 if user.login == login:
                     friend = user
@@ -179,18 +581,21 @@ def get_user_infos(login=None, uid=None):
             if friend.lastname:
                 fullname += " " + friend.lastname
 
-            return { 'login' : friend.login,
-                     'uid' : friend.uid,
-                     'gid' : friend.gid,
-                     'fullname' : fullname,
-                     'groups' : [] }
-
-    except:
-        if not login: login = "nobody"
-        if not uid: uid = -1
-
-        return { 'login' : login,
-                 'uid' : uid,
-                 'gid' : uid,
-                 'fullname' : 'The one who talks loud to say nothing',
-                 'groups' : [] }
+            return UserInfos(self,
+                             login=friend.login,
+                             uid=friend.uid,
+                             gid=friend.gid,
+                             fullname=fullname,
+                             groups=[])
+
+        except:
+            return None
+
+
+identities = IdentityCache()
+
+def get_user_infos(login=None, uid=None):
+    return identities.resolve(login=login, uid=uid)
+
+def get_users_infos(uids=(), logins=()):
+    return identities.resolve_many(uids=uids, logins=logins)
@@ -25,6 +25,9 @@ from ufo.sharing import FriendDocument
 from ufo.utils import get_user_infos
 from ufo.database import DocumentHelper
 
+# Number of rows fetched per request when listing shared files
+PAGE_SIZE = 500
+
 
 class SortedByTypeSyncDocument(SyncDocument):
 
@@ -78,7 +81,8 @@ class BuddySharesSyncDocument(SyncDocument):
 
         if len(path) > 0:
             login = get_user_infos(uid=int(buddy))['login']
-            for doc in helper.by_dir(key="/" + "/".join([login] + list(path))):
+            for doc in helper.by_dir(key="/" + "/".join([login] + list(path)),
+                                     page_size=PAGE_SIZE):
                 yield doc
 
         elif buddy:
@@ -88,7 +92,8 @@ class BuddySharesSyncDocument(SyncDocument):
             startkey = [ provider, uid ]
             endkey = [ provider + 1, uid ]
             for key, doc in helper.by_provider_and_participant(startkey=startkey,
-                                                               endkey=endkey):
+                                                               endkey=endkey,
+                                                               page_size=PAGE_SIZE):
                 if doc.type == "application/x-directory":
                     shared_dirs[doc.path] = doc
                 else:
@@ -98,16 +103,20 @@ class BuddySharesSyncDocument(SyncDocument):
 
         else:
             uid = utils.get_user_infos(login=database.name)['uid']
-            for key, doc in helper.by_provider_and_participant(group_level=1, reduce=True):
-                if key[0] != uid:
-                    # Retrieve provider infos from gss api
-                    infos = utils.get_user_infos(uid=key[0])
-                    yield cls(filename=infos['login'],
-                              dirpath=os.sep,
-                              mode=0555 | stat.S_IFDIR,
-                              uid=infos['uid'],
-                              gid=infos['gid'],
-                              type="application/x-directory")
+            providers = [ key[0] for key, doc in helper.by_provider_and_participant(group_level=1,
+                                                                                   reduce=True)
+                          if key[0] != uid ]
+
+            # Retrieve all the providers infos at once
+            users = utils.get_users_infos(uids=providers)
+            for provider in providers:
+                infos = users[provider]
+                yield cls(filename=infos['login'],
+                          dirpath=os.sep,
+                          mode=0555 | stat.S_IFDIR,
+                          uid=infos['uid'],
+                          gid=infos['gid'],
+                          type="application/x-directory")
 
 
 class MySharesSyncDocument(SyncDocument):
@@ -118,7 +127,8 @@ class MySharesSyncDocument(SyncDocument):
 
         if len(path) > 0:
             login = get_user_infos(uid=int(buddy))['login']
-            for doc in helper.by_dir(key="/" + "/".join([login] + list(path))):
+            for doc in helper.by_dir(key="/" + "/".join([login] + list(path)),
+                                     page_size=PAGE_SIZE):
                 yield doc
 
         elif buddy:
@@ -128,7 +138,8 @@ class MySharesSyncDocument(SyncDocument):
             startkey = [ provider_id, uid ]
             endkey = [ provider_id, uid + 1 ]
             for key, doc in helper.by_provider_and_participant(startkey=startkey,
-                                                               endkey=endkey):
+                                                               endkey=endkey,
+                                                               page_size=PAGE_SIZE):
                 if doc.type == "application/x-directory":
                     shared_dirs[doc.path] = doc
                 else:
@@ -138,18 +149,21 @@ class MySharesSyncDocument(SyncDocument):
 
         else:
             uid = utils.get_user_infos(login=database.name)['uid']
-            for key, doc in helper.by_provider_and_participant(startkey=[uid],
-                                                               group_level=2,
-                                                               reduce=True):
-                if key != uid:
-                    # Retrieve participant infos from gss api
-                    infos = utils.get_user_infos(uid=key[1])
-                    yield cls(filename=infos['login'],
-                              dirpath=os.sep,
-                              mode=0555 | stat.S_IFDIR,
-                              uid=infos['uid'],
-                              gid=infos['gid'],
-                              type="application/x-directory")
+            participants = [ key[1] for key, doc in helper.by_provider_and_participant(startkey=[uid],
+                                                                                      group_level=2,
+                                                                                      reduce=True)
+                             if key != uid ]
+
+            # Retrieve all the participants infos at once
+            users = utils.get_users_infos(uids=participants)
+            for participant in participants:
+                infos = users[participant]
+                yield cls(filename=infos['login'],
+                          dirpath=os.sep,
+                          mode=0555 | stat.S_IFDIR,
+                          uid=infos['uid'],
+                          gid=infos['gid'],
+                          type="application/x-directory")
 
 
 class TaggedSyncDocument(SyncDocument):